@@ -60,15 +60,15 @@ def clamav_scan(payload):
     future = asyncio.Future()
     if payload:
         scanner = ClamAVProtocol(future, payload)
-        asyncio.async(loop.create_connection(lambda: scanner, host='127.0.0.1', port=3310))
+        asyncio.ensure_future(loop.create_connection(lambda: scanner, host='127.0.0.1', port=3310))
     else:
         future.set_result((False, None))
     return future
 
 
 @handler()
-def respmod(request):
-    found_virus, name = yield from clamav_scan(request.body_bytes)
+async def respmod(request):
+    found_virus, name = await clamav_scan(request.body_bytes)
 
     if found_virus:
         return HTTPResponse(body=b"A virus was found: " + name)
@@ -3,7 +3,9 @@ from lxml import html
 from icap import run, handler, DomainCriteria, ContentTypeCriteria
 
 
-@handler(DomainCriteria('twitter.com') & ContentTypeCriteria('text/html'))
+# parsing and rewriting HTML is CPU-bound, keep it off the event loop.
+@handler(DomainCriteria('twitter.com') & ContentTypeCriteria('text/html'),
+         executor='process')
 class Twitter:
     def respmod(request):
         doc = html.document_fromstring(request.body)
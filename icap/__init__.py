@@ -1,9 +1,10 @@
 # flake8: noqa
 
-from .asyncio import ICAPProtocol, ICAPProtocolFactory
+from .asyncio import BufferedICAPProtocol, ICAPProtocol, ICAPProtocolFactory
 from .criteria import *
 from .errors import abort
-from .models import (HTTPRequest, HTTPResponse, HeadersDict, ICAPRequest,
-                     ICAPResponse, RequestLine, StatusLine)
+from .forms import *
+from .models import (FileBody, HTTPRequest, HTTPResponse, HeadersDict,
+                     ICAPRequest, ICAPResponse, RequestLine, StatusLine)
 from .parsing import *
-from .server import run, stop, hooks
+from .server import run, stop, hooks, invalidate_is_tag
@@ -1,20 +1,19 @@
 import asyncio
 import logging
 import re
+import time
 
-try:
-    from asyncio.tasks import iscoroutine
-except ImportError:
-    from asyncio import iscoroutine
-from io import BytesIO, SEEK_END
+from inspect import isawaitable
 
-from .criteria import get_handler
+from .criteria import _HANDLERS, get_handler
 from .errors import abort, ICAPAbort, MalformedRequestError
-from .models import ICAPResponse, HTTPMessage
+from .forms import MultipartForm
+from .models import ICAPRequest, ICAPResponse, HTTPMessage, RequestLine
 from .parsing import ICAPRequestParser
-from .serialization import Serializer
-from .server import hooks, is_tag
-from .session import should_finalize_session, finalize_session, get_session
+from .serialization import (Serializer, ResponseTemplate, error_templates,
+                            write_chunk, write_last_chunk)
+from .server import config_version, hooks, is_tag
+from .session import should_finalize_session, load_session, unload_session
 
 
 log = logging.getLogger(__name__)
@@ -26,9 +25,17 @@ class ICAPProtocol(asyncio.Protocol):
     def __init__(self, factory):
         self.parser = ICAPRequestParser()
         self.factory = factory
-        self._buffer = BytesIO()
+        # the incomplete line at the end of the ICAP headers received so far
+        self._buffer = b''
         self.connected = False
 
+        # the state of header-time routing for the request being received,
+        # see `~icap.asyncio.ICAPProtocol.route_headers`.
+        self.routed = False
+        self.route = None
+        self.discarding = False
+        self.relay = None
+
     def connection_made(self, transport):
         self.transport = transport
         self.connected = True
@@ -36,14 +43,31 @@ class ICAPProtocol(asyncio.Protocol):
     def connection_lost(self, exc):
         self.connected = False
 
+    def pause_writing(self):
+        if self.relay is not None:
+            self.relay.pause_writing()
+
+    def resume_writing(self):
+        if self.relay is not None:
+            self.relay.resume_writing()
+
     def data_received(self, data):
         if self.parser.headers_complete():
             self.raw_data_received(data)
         else:
-            self._buffer.write(data)
-            self._buffer.seek(0)
-            self.lines_received()
+            self.lines_received(data)
+
+        return self.data_parsed()
+
+    def data_parsed(self):
+        """Act on the request being received, once data has been fed to the
+        parser: handle it if it's complete, or route it if its encapsulated
+        headers just were.
 
+        Returns None, or a task if handling it had to suspend, see
+        `~icap.asyncio.run_eagerly`.
+
+        """
         p = self.parser
 
         if ((p.headers_complete() and p.is_options and
@@ -51,112 +75,316 @@ class ICAPProtocol(asyncio.Protocol):
             p.complete(True)
 
         if p.complete():
-            return asyncio.async(self.handle_request())
+            if self.discarding:
+                # already answered, see route_headers.
+                self.reset_request()
+                return
+            if self.relay is not None:
+                self.relay.body_complete()
+                self.reset_request()
+                return
+            return run_eagerly(self.handle_request())
+
+        if not self.routed and p.headers_complete() and \
+                p.http_headers_complete():
+            return self.route_headers()
+
+    def lines_received(self, data, size=None):
+        """Feed the lines of the ICAP headers in ``data`` to the parser, and
+        anything after them to `~icap.asyncio.ICAPProtocol.raw_data_received`.
+
+        ``data`` is bytes, or a bytearray holding ``size`` bytes of data.
+        Only the header lines are copied out of it, the body is passed on
+        as a memoryview of it.
 
-    def lines_received(self):
+        """
         feed_line = self.parser.feed_line
         headers_complete = self.parser.headers_complete
+        start = 0
+
+        if size is None:
+            size = len(data)
 
         try:
-            for line in self._buffer:
+            while True:
+                end = data.find(b'\n', start, size) + 1
+                if not end:
+                    self._buffer += data[start:size]
+                    return
+
+                line, start = data[start:end], end
+                if self._buffer:
+                    line, self._buffer = self._buffer + line, b''
+
                 if not feed_line(line):
-                    self.reset_buffer(line)
-                    break
+                    self._buffer = line + data[start:size]
+                    return
                 if headers_complete():
-                    self.raw_data_received(self._buffer.read())
-                    self.reset_buffer()
+                    self.raw_data_received(memoryview(data)[start:size])
                     return
-            else:
-                self.reset_buffer()
         except ICAPAbort as e:
             self.respond_with_error(e, should_close=True)
         except (ICAPAbort, MalformedRequestError) as e:
             self.respond_with_error(400, should_close=True)
 
-    def reset_buffer(self, prefix=b''):
-        self._buffer = BytesIO(prefix+self._buffer.read())
-        self._buffer.seek(0, SEEK_END)
-
     def raw_data_received(self, data):
         assert self.parser.headers_complete()
 
         self.parser.feed_body(data)
 
+    def route_headers(self):
+        """Route the request being received as soon as its encapsulated
+        headers are parsed, before the body arrives.
+
+        If the criteria of the service may need the body to decide (see
+        `~icap.criteria.get_handler`), routing waits for the whole request
+        as usual. Otherwise the handler is kept for
+        `~icap.asyncio.ICAPProtocol.handle_request`, or if routing fails, the
+        error is written straight away and the rest of the body is discarded
+        as it arrives. That includes the 204 response for requests no
+        handler matches, when the client allows it.
+
+        Requests routed to a ``body=False`` handler (see
+        `~icap.criteria.handler`) are handled straight away, relaying the
+        body as it arrives. Returns None, or a task if the handler is still
+        running, as for `~icap.asyncio.ICAPProtocol.handle_request`.
+
+        """
+        self.routed = True
+        request = self.parser.to_icap()
+
+        try:
+            self.validate_request(request)
+            self.route = get_handler(request, headers_only=True)
+        except ICAPAbort as e:
+            if e.status_code == 204 and not request.allow_204:
+                # the message has to be sent back whole.
+                return
+
+            self.discarding = True
+            self.parser.discard_body()
+
+            should_close = request.headers.get('Connection') == 'close'
+            self.write_template(error_templates[e.status_code],
+                                is_tag(request), should_close=should_close)
+        except (SystemExit, KeyboardInterrupt):
+            raise  # pragma: no cover
+        except BaseException:
+            # leave it to handle_request to report.
+            return
+
+        if self.route is not None and \
+                not getattr(self.route[0], 'needs_body', True):
+            relay = self.relay = BodyRelay(self)
+            request.http.mark_body_pending()
+            self.parser.relay_body(relay.chunk_received)
+            return run_eagerly(self.handle_request(request, self.route, relay))
+
+    def reset_request(self):
+        """Start parsing a new request, returning the parser of the current
+        one and the handler it was routed to by
+        `~icap.asyncio.ICAPProtocol.route_headers`, if any.
+
+        """
+        parser, route = self.parser, self.route
+
+        self.parser, self._buffer = ICAPRequestParser(), b''
+        self.routed = self.discarding = False
+        self.route = self.relay = None
+
+        return parser, route
+
     def respond_with_error(self, error, should_close=False):
         """Write an error to the transport as a response to the request.
 
         ``error`` - either the ICAP error code or an instance of
                     `~icap.errors.ICAPAbort`.
         """
-        response = ICAPResponse.from_error(error)
-        self.write_response(response, is_tag(None),
+        if not isinstance(error, int):
+            error = error.status_code
+
+        self.write_template(error_templates[error], is_tag(None),
                             should_close=should_close)
 
-    @asyncio.coroutine
-    def handle_request(self):
+    async def handle_request(self, request=None, route=None, relay=None):
         """Handle a single request. Validate it, get a handler for it, and
         dispatch it to `~icap.asyncio.ICAPProtocol.handle_options~ or
         `~icap.asyncio.handle_mod`.
 
         This is also the principal exception handler.
-        """
-        parser, self.parser, self._buffer = \
-            self.parser, ICAPRequestParser(), BytesIO()
 
-        request = parser.to_icap()
+        Only awaits when a handler or session manager is asynchronous, so
+        when started with `run_eagerly` synchronous requests never suspend.
+
+        If ``request`` is given, only its encapsulated headers have been
+        received, and ``route`` is the ``body=False`` handler it was routed
+        to. The body is passed to ``relay``, a `~icap.asyncio.BodyRelay`,
+        and written into the response as it arrives, unless the response
+        doesn't take it.
+        """
+        if request is None:
+            parser, route = self.reset_request()
+            request = parser.to_icap()
 
         should_close = request.headers.get('Connection') == 'close'
         allow_204 = request.allow_204
 
+        # errors are written from prerendered templates instead of response
+        # objects, as they're cheaper to send.
+        error = None
+        response = None
+
         try:
-            self.validate_request(request)
-            handler, raw = get_handler(request)
+            try:
+                self.validate_request(request)
+                if route is None:
+                    route = get_handler(request)
+                handler, raw = route
+
+                if request.is_options:
+                    self.write_template(self.options_template(request),
+                                        is_tag(request),
+                                        should_close=should_close)
+                    return
+                else:
+                    result = hooks['before_handling'](request)
+                    if isawaitable(result):
+                        await result
+
+                    session = load_session(request)
+                    if isawaitable(session):
+                        session = await session
+                    request.session = session
+
+                try:
+                    response = self.dispatch_request(request, handler, raw,
+                                                     relay)
+                    if isawaitable(response):
+                        response = await response
+                finally:
+                    if should_finalize_session(request):
+                        result = unload_session(request.session['id'])
+                        if isawaitable(result):
+                            await result
+
+                result = hooks['before_serialization'](request, response)
+                if isawaitable(result):
+                    await result
+            except ICAPAbort as e:
+                if e.status_code == 204 and not allow_204:
+                    response = ICAPResponse(http=request.http)
+                else:
+                    error = e.status_code
+            except (SystemExit, KeyboardInterrupt):
+                raise  # pragma: no cover
+            except BaseException:
+                log.error("Error while processing %s request",
+                          request.request_line.method, exc_info=True)
+                error = 500
+
+            session_id = None
+
+            if not request.is_options and hasattr(request, 'session'):
+                try:
+                    session_id = request.session['id']
+                except KeyError as e:
+                    log.error('Error setting session header', exc_info=True)
+
+            if error is not None:
+                headers = b''
+                if session_id is not None:
+                    headers = ('X-Session-ID: %s\r\n' %
+                               session_id).encode('utf8')
+
+                self.write_template(error_templates[error], is_tag(request),
+                                    should_close=should_close, headers=headers)
+                if relay is not None:
+                    relay.cancel()
+                return
+
+            if session_id is not None:
+                response.headers['X-Session-ID'] = session_id
+
+            if relay is not None and not relay.takes(request, response.http):
+                relay.cancel()
+                relay = None
+
+            await self.write_response(response, is_tag(request),
+                                      is_options=request.is_options,
+                                      should_close=should_close, relay=relay)
+        finally:
+            # file bodies are closed once sent, but not on the other paths,
+            # and the spooled parts of forms not at all.
+            close_files(request.http)
+            if response is not None:
+                close_files(response.http)
+
+    async def write_response(self, response, is_tag, is_options=False,
+                             should_close=False, relay=None):
+        """Serialise the given response object to the transport.
+
+        If ``relay`` is given, only the headers are written here, and the
+        body is written by the `~icap.asyncio.BodyRelay` as it arrives.
+
+        Only suspends if the body is a `~icap.models.FileBody`, while
+        sending it, see `~icap.asyncio.ICAPProtocol.send_file`.
 
-            if not request.is_options:
-                hooks['before_handling'](request)
-                request.session = yield from maybe_coroutine(get_session,
-                                                             request)
+        """
 
-            try:
-                response = yield from self.dispatch_request(request, handler,
-                                                            raw)
-            finally:
-                if should_finalize_session(request):
-                    yield from maybe_coroutine(finalize_session,
-                                               request.session['id'])
-
-            hooks['before_serialization'](request, response)
-        except ICAPAbort as e:
-            if e.status_code == 204 and not allow_204:
-                response = ICAPResponse(http=request.http)
-            else:
-                response = ICAPResponse.from_error(e)
+        if not self.connected:
+            if relay is not None:
+                relay.cancel()
+            return
+
+        s = Serializer(response, is_tag, is_options=is_options,
+                       relay=relay is not None, sendfile=True)
+        s.serialize_to_stream(self.transport)
+
+        if s.file is not None:
+            await self.send_file(s, should_close=should_close)
+            return
+
+        if relay is not None:
+            relay.start(should_close=should_close)
+        elif should_close:
+            self.transport.close()
+
+    async def send_file(self, serializer, should_close=False):
+        """Send the file body of a response being written by
+        ``serializer``, after its headers, closing it once it's sent (see
+        `~icap.models.FileBody.close`).
+
+        The ICAP headers have already been sent, so if sending fails the
+        error is logged and the connection closed, which is the only way
+        left to tell the client the response is incomplete.
+
+        """
+        try:
+            await serializer.send_file(self.transport)
         except (SystemExit, KeyboardInterrupt):
             raise  # pragma: no cover
         except BaseException:
-            log.error("Error while processing %s request",
-                      request.request_line.method, exc_info=True)
-            response = ICAPResponse.from_error(500)
+            log.error("Error while sending %r", serializer.file,
+                      exc_info=True)
+            should_close = True
+        finally:
+            serializer.file.close()
 
-        if not request.is_options and hasattr(request, 'session'):
-            try:
-                response.headers['X-Session-ID'] = request.session['id']
-            except KeyError as e:
-                log.error('Error setting session header', exc_info=True)
+        if should_close:
+            self.transport.close()
 
-        self.write_response(response, is_tag(request),
-                            is_options=request.is_options,
-                            should_close=should_close)
+    def write_template(self, template, is_tag, should_close=False,
+                       headers=b''):
+        """Write a `~icap.serialization.ResponseTemplate` to the transport.
 
-    def write_response(self, response, is_tag, is_options=False,
-                       should_close=False):
-        """Serialise the given response object to the transport."""
+        ``headers`` are any extra, already serialized, headers to include.
+
+        """
 
         if not self.connected:
             return
 
-        s = Serializer(response, is_tag, is_options=is_options)
-        s.serialize_to_stream(self.transport)
+        self.transport.write(template.render(is_tag, headers))
 
         if should_close:
             self.transport.close()
@@ -185,56 +413,84 @@ class ICAPProtocol(asyncio.Protocol):
         if not request.is_options and (invalid_reqmod or invalid_respmod):
             abort(405)
 
-    @asyncio.coroutine
-    def dispatch_request(self, request, handler, raw):
+    def dispatch_request(self, request, handler, raw, relay=None):
         """Handle a single ICAP request.
 
         This is just a dispatcher for handle_options and handle_mod.
 
-        Returns an `~icap.models.ICAPResponse` suitable for serialization.
+        Returns an `~icap.models.ICAPResponse` suitable for serialization, or
+        an awaitable resolving to one if the handler is a coroutine.
 
         """
         if request.is_options:
-            response = yield from self.handle_options(request)
+            return self.handle_options(request)
         else:
-            response = yield from self.handle_mod(request, handler, raw)
-        return response
+            return self.handle_mod(request, handler, raw, relay)
 
-    @asyncio.coroutine
-    def handle_mod(self, request, handler, raw):
+    def handle_mod(self, request, handler, raw, relay=None):
         """Handle a single REQMOD or RESPMOD request.
 
-        Returns an `~icap.models.ICAPResponse` suitable for serialization.
+        Returns an `~icap.models.ICAPResponse` suitable for serialization, or
+        an awaitable resolving to one if the handler is a coroutine.
 
         """
         if raw:
-            coro = maybe_coroutine(handler, request)
+            response = handler(request)
         else:
-            coro = maybe_coroutine(handler, request.http)
+            response = handler(request.http)
+
+        if isawaitable(response):
+            return self._await_mod_response(request, response, relay)
+        return self.mod_response(request, response, relay)
 
-        response = yield from coro
+    async def _await_mod_response(self, request, response, relay=None):
+        return self.mod_response(request, await response, relay)
+
+    def mod_response(self, request, response, relay=None):
+        """Return the `~icap.models.ICAPResponse` for the value returned by
+        the handler of a REQMOD or RESPMOD request.
+
+        Aborts with 204 if the client allows it and the encapsulated message
+        was left unmodified.
+
+        If the response takes the body passed to ``relay``, its length is
+        unchanged and left as it is.
+
+        """
         if response is None:
             response = request.http
         elif isinstance(response, HTTPMessage):
             if request.is_respmod and response.is_request:
+                close_files(response)
                 abort(500)
         else:
             request.http.body = response
             response = request.http
 
         assert isinstance(response, HTTPMessage)
+
+        if ((request.allow_204 and response is request.http and
+             not response.modified)):
+            abort(204)
+
         http = response
         response = ICAPResponse(http=http)
 
-        l = len(http.body_bytes)
+        if relay is not None and relay.takes(request, http):
+            return response
+
+        http.pre_serialization()
+
+        length = http.received_length()
+        if length is None:
+            length = len(http.body_file or http.body_bytes)
 
-        if l:
-            http.headers.replace('Content-Length', str(l))
+        if length:
+            http.headers.replace('Content-Length', str(length))
         else:
             http.headers.pop('Content-Length', None)
         return response
 
-    @asyncio.coroutine
     def handle_options(self, request):
         """Handle an OPTIONS request, returning the ICAPResponse object to
         serialize.
@@ -256,31 +512,342 @@ class ICAPProtocol(asyncio.Protocol):
         if extra_headers:
             response.headers.update(extra_headers)
 
+        ttl = self.factory.options_ttl
+        if ttl is not None and 'Options-TTL' not in response.headers:
+            response.headers['Options-TTL'] = str(ttl)
+
         return response
 
+    def options_template(self, request):
+        """Return the `~icap.serialization.ResponseTemplate` answering the
+        OPTIONS request ``request``.
+
+        OPTIONS responses only depend on the service and the server's
+        configuration, so they are rendered once per service, calling
+        `~icap.asyncio.ICAPProtocol.handle_options` and the
+        'before_serialization' hook, and reused until handlers or hooks
+        change, or the factory's ``options_ttl`` passes.
+
+        """
+        cache = self.factory.options_cache
+        path = request.request_line.uri.path
+        version = config_version()
+        now = time.monotonic()
+
+        if path in cache:
+            cached_version, expires, template = cache[path]
+            if cached_version == version and now < expires:
+                return template
+
+        response = self.handle_options(request)
+
+        result = hooks['before_serialization'](request, response)
+        if isawaitable(result):
+            # OPTIONS responses may be rendered outside of the event loop.
+            result.close()
+            log.error("Asynchronous 'before_serialization' hooks are not "
+                      "supported for OPTIONS requests")
+        template = ResponseTemplate(response, is_options=True)
+
+        ttl = self.factory.options_ttl
+        expires = now + ttl if ttl else float('inf')
+        cache[path] = version, expires, template
+        return template
+
+
+class BodyRelay(object):
+    """Relays the encapsulated body of a request handled by a ``body=False``
+    handler into the response, chunk by chunk as it's received.
+
+    Chunks received before the response headers are written are held until
+    then. Reading from the transport is paused while more than ``limit``
+    bytes are held, or while the transport's write buffer is full, so the
+    memory used doesn't depend on the size of the body.
+
+    This class should never be used directly. It is for internal usage only.
+
+    """
+    limit = 65536
+
+    def __init__(self, protocol):
+        self.protocol = protocol
+        self.pending = []
+        self.pending_size = 0
+        self.started = False
+        self.cancelled = False
+        self.complete = False
+        self.should_close = False
+        self.reading_paused = False
+        self.writing_paused = False
+
+    def takes(self, request, http):
+        """Return True if ``http``, the message in the response to
+        ``request``, takes the relayed body. That's the case unless the
+        handler set a body, even an empty one, or returned a different
+        message (see `~icap.models.HTTPMessage.mark_body_pending`).
+
+        """
+        return http is request.http and http.received_chunks() is not None
+
+    def chunk_received(self, data):
+        if self.started:
+            self.write(data)
+        elif not self.cancelled:
+            self.pending.append(data)
+            self.pending_size += len(data)
+            self.update_reading()
+
+    def body_complete(self):
+        """Called once the last chunk of the body has been received."""
+        self.complete = True
+        if self.started:
+            self.finish()
+        self.update_reading()
+
+    def start(self, should_close=False):
+        """Start relaying the body, once the response headers have been
+        written. If ``should_close``, the transport is closed once the body
+        has been written.
+
+        """
+        self.started = True
+        self.should_close = should_close
+
+        pending, self.pending, self.pending_size = self.pending, [], 0
+        for data in pending:
+            self.write(data)
+
+        if self.complete:
+            self.finish()
+        self.update_reading()
+
+    def cancel(self):
+        """Stop keeping the body, as the response doesn't take it."""
+        self.cancelled = True
+        self.pending, self.pending_size = [], 0
+        self.update_reading()
+
+    def write(self, data):
+        if self.protocol.connected:
+            write_chunk(self.protocol.transport, data)
+
+    def finish(self):
+        if self.protocol.connected:
+            write_last_chunk(self.protocol.transport)
+            if self.should_close:
+                self.protocol.transport.close()
+
+    def pause_writing(self):
+        self.writing_paused = True
+        self.update_reading()
+
+    def resume_writing(self):
+        self.writing_paused = False
+        self.update_reading()
+
+    def update_reading(self):
+        if self.complete or self.cancelled:
+            pause = False
+        elif self.started:
+            pause = self.writing_paused
+        else:
+            pause = self.pending_size > self.limit
+
+        if pause != self.reading_paused and self.protocol.connected:
+            self.reading_paused = pause
+            if pause:
+                self.protocol.transport.pause_reading()
+            else:
+                self.protocol.transport.resume_reading()
+
+
+class BufferedICAPProtocol(ICAPProtocol, asyncio.BufferedProtocol):
+    """`~icap.asyncio.ICAPProtocol` reading straight into a receive buffer
+    kept for the connection, instead of a new bytes object for each read.
+
+    The parser keeps memoryviews of the buffer rather than copies of the
+    data, so the buffer is only reused once none of them are left, e.g.
+    after requests handled from their headers alone, or whose bodies were
+    relayed or discarded. Otherwise a new buffer is used for the next read.
+    Body data filling less than half the buffer is copied out of it instead,
+    so many small reads don't each keep a whole buffer alive. Buffers start
+    at ``buffer_size`` bytes, and double in size, up to ``max_buffer_size``,
+    whenever a read fills one.
+
+    """
+    buffer_size = 65536
+    max_buffer_size = 1048576
+
+    def __init__(self, factory):
+        super().__init__(factory)
+        self.receive_buffer = bytearray(self.buffer_size)
+        self.buffer_filled = False
+
+    def get_buffer(self, sizehint):
+        """Return a buffer of at least ``sizehint`` bytes, up to
+        ``max_buffer_size``, or of the current size if there's no hint
+        (asyncio's own transports pass -1).
+
+        """
+        buffer = self.receive_buffer
+        size = len(buffer)
+
+        if self.buffer_filled:
+            size *= 2
+        size = min(max(size, sizehint), self.max_buffer_size)
+
+        if size == len(buffer) and not buffer_in_use(buffer):
+            return buffer
+
+        buffer = self.receive_buffer = bytearray(size)
+        return buffer
+
+    def buffer_updated(self, nbytes):
+        buffer = self.receive_buffer
+        self.buffer_filled = nbytes == len(buffer)
+
+        if self.parser.headers_complete():
+            self.raw_data_received(memoryview(buffer)[:nbytes])
+        else:
+            self.lines_received(buffer, nbytes)
+
+        return self.data_parsed()
+
+    def raw_data_received(self, data):
+        if len(data) * 2 < len(self.receive_buffer):
+            data = bytes(data)
+
+        super().raw_data_received(data)
+
+
+def close_files(http):
+    """Close the `~icap.models.FileBody` the body of the HTTP message
+    ``http`` was set to, and the parts of its `~icap.forms.MultipartForm`
+    if it was parsed, if there are any.
+
+    """
+    if http is None:
+        return
+
+    if http.body_file is not None:
+        http.body_file.close()
+
+    if http.is_request and http.parsed_post_data and \
+            isinstance(http.post, MultipartForm):
+        http.post.close()
+
+
+def buffer_in_use(buffer):
+    """Return True if there are memoryviews of the bytearray ``buffer``."""
+    # bytearrays can't be resized while they're exported.
+    try:
+        buffer.append(0)
+    except BufferError:
+        return True
+
+    del buffer[-1]
+    return False
+
 
 class ICAPProtocolFactory(object):
-    """Factory class for creating ICAPProtocol objects."""
+    """Factory class for creating ICAPProtocol objects.
+
+    Keyword arguments:
+        ``options_ttl`` - seconds that clients may cache OPTIONS responses
+                          for, sent as the Options-TTL header unless the
+                          'options_headers' hook provides one. Cached
+                          OPTIONS responses are rendered again this often.
+                          If None, the header isn't sent and responses are
+                          only rendered again when handlers or hooks change.
+        ``buffered`` - if True, create
+                       `~icap.asyncio.BufferedICAPProtocol` objects, which
+                       read into a reusable buffer for each connection.
+
+    """
     protocol = ICAPProtocol
 
+    def __init__(self, options_ttl=None, buffered=False):
+        if buffered:
+            self.protocol = BufferedICAPProtocol
+
+        self.options_ttl = options_ttl
+        self.options_cache = {}
+        self.prerender_options()
+
     def __call__(self):
         return self.protocol(factory=self)
 
+    def prerender_options(self):
+        """Render the OPTIONS response of every service ahead of time."""
+        protocol = self()
+
+        for path in list(_HANDLERS):
+            request = ICAPRequest(RequestLine('OPTIONS', path, 'ICAP/1.0'))
+            protocol.options_template(request)
+
 
-def maybe_coroutine(callable, *args, **kwargs):
+async def maybe_coroutine(callable, *args, **kwargs):
     """Invoke a function that may or may not be a coroutine.
 
     This is analogous to `~twisted.internet.defer.maybeDeferred`, but for
     `asyncio`.
 
     """
-
     value = callable(*args, **kwargs)
 
-    if iscoroutine(value):
-        return value
+    if isawaitable(value):
+        value = await value
+    return value
+
+
+def run_eagerly(coro):
+    """Run the coroutine ``coro`` until it first suspends.
+
+    Returns None if it ran to completion without suspending, otherwise a task
+    that finishes running it. This saves creating a task, and a trip through
+    the event loop, for requests that can be handled synchronously.
+
+    Outside of a running event loop, e.g. when driving a protocol by hand,
+    this falls back to creating a task straight away.
+
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.ensure_future(coro)
+
+    try:
+        awaiting = coro.send(None)
+    except StopIteration:
+        return None
+    return asyncio.ensure_future(_resume(coro, awaiting))
+
+
+async def _resume(coro, awaiting):
+    return await _Started(coro, awaiting)
 
-    def coro():
-        yield
-        return value
-    return coro()
+
+class _Started:
+    """Awaitable continuing a coroutine started by `run_eagerly`, from the
+    point where it yielded ``awaiting``.
+
+    """
+    def __init__(self, coro, awaiting):
+        self.coro = coro
+        self.awaiting = awaiting
+
+    def __await__(self):
+        coro, awaiting = self.coro, self.awaiting
+
+        while True:
+            try:
+                value = yield awaiting
+            except BaseException as e:
+                step, value = coro.throw, e
+            else:
+                step = coro.send
+
+            try:
+                awaiting = step(value)
+            except StopIteration as e:
+                return e.value
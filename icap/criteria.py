@@ -1,25 +1,92 @@
 import fnmatch
 import functools
+import hashlib
+import heapq
+import math
 import re
+import time
 import urllib.parse
+import weakref
 
-from collections import defaultdict
+from collections import OrderedDict, defaultdict
+
+from werkzeug import cached_property
 
 from .errors import abort
+from .executors import in_executor, validate_executor
+from .listindex import ListIndex
+
+
+class HandlerRegistry(defaultdict):
+    """Mapping of service paths to lists of ``(criteria, handler, raw)``
+    tuples.
+
+    ``version`` is incremented whenever handlers are added or removed, so
+    anything derived from them can tell when it is out of date.
+
+    """
+    version = 0
+
+    def __init__(self):
+        super().__init__(list)
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.version += 1
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self.version += 1
+
+    def pop(self, *args):
+        self.version += 1
+        return super().pop(*args)
+
+    def clear(self):
+        super().clear()
+        self.version += 1
+
+    def add(self, key, item):
+        """Add ``item`` to the handlers for the service at ``key``."""
+        self[key].append(item)
+        self.version += 1
+
+
+_HANDLERS = HandlerRegistry()
 
-_HANDLERS = defaultdict(list)
+# compiled `RoutingTable` objects for each path in _HANDLERS, as of
+# _HANDLERS.version == _ROUTES_VERSION.
+_ROUTES = {}
+_ROUTES_VERSION = None
+
+# evaluations between reordering composite criteria, or None if adaptive
+# ordering is disabled.
+_ADAPTIVE_INTERVAL = None
+
+# maximum number of cached routing decisions per service, or None if routing
+# decisions aren't cached.
+_ROUTING_CACHE_SIZE = None
 
 
 __all__ = [
     'BaseCriteria',
+    'BloomFilterCriteria',
     'ContentTypeCriteria',
     'DomainCriteria',
+    'DomainListCriteria',
     'HTTPRequestCriteria',
     'HTTPResponseCriteria',
     'HeaderCriteria',
     'MethodCriteria',
     'RegexCriteria',
+    'RegexSetCriteria',
     'StatusCodeCriteria',
+    'URLListCriteria',
+    'criteria_stats',
+    'disable_adaptive_ordering',
+    'disable_routing_cache',
+    'enable_adaptive_ordering',
+    'enable_routing_cache',
     'handler',
 ]
 
@@ -31,12 +98,31 @@ class BaseCriteria(object):
     """
     priority = 1
 
+    # the names of the `RequestFacts` the result depends on, or None if it
+    # may depend on anything else, e.g. the body or session. Criteria which
+    # declare them can have their results cached, see
+    # `enable_routing_cache`, and are checked before the body is received.
+    # Whether the request is a REQMOD or RESPMOD is
+    # always assumed to be a dependency.
+    depends_on = None
+
     def __lt__(self, other):
         return self.priority < other.priority
 
     def __call__(self, request):
         raise NotImplementedError()
 
+    def constraints(self):
+        """Return a dict of facts about a request this criteria can only match
+        if true, used for indexing handlers. See `~icap.criteria.RoutingTable`.
+
+        Keys are the names of facts, ``'is_reqmod'``, ``'host'`` or
+        ``'content_type'``, and values are sets of the values the fact must
+        have for this criteria to match. By default there are no constraints.
+
+        """
+        return {}
+
     def __and__(self, other):
         return AllOfCriteria(self, other)
 
@@ -44,83 +130,595 @@ class BaseCriteria(object):
         return AnyOfCriteria(self, other)
 
 
-class AnyOfCriteria(BaseCriteria):
-    """Criteria that matches only if any given child criteria match."""
+class CompositeCriteria(BaseCriteria):
+    """Base class for criteria combining child criteria, which short circuit
+    once any child returns ``decisive``.
+
+    When adaptive ordering is enabled (see `enable_adaptive_ordering`), the
+    cost and match rate of each child is recorded, and children are
+    periodically reordered so that cheap checks likely to be decisive run
+    first. Children must not depend on being called in a particular order.
+    """
+    decisive = None
 
     def __init__(self, *criteria):
         super().__init__()
         self.criteria = criteria
 
-    def __call__(self, request):
-        return any(c(request) for c in self.criteria)
+        # evaluation order, as indexes into self.criteria, and the calls,
+        # matches and total seconds spent for each child.
+        self.order = list(range(len(criteria)))
+        self.calls = [0] * len(criteria)
+        self.matches = [0] * len(criteria)
+        self.cost = [0.0] * len(criteria)
+        self.evaluations = 0
+
+    @property
+    def depends_on(self):
+        depends_on = frozenset()
+        for child in self.criteria:
+            child_depends_on = get_depends_on(child)
+            if child_depends_on is None:
+                return None
+            depends_on |= child_depends_on
+        return depends_on
+
+    def adaptive_call(self, request):
+        decisive = self.decisive
+        calls, matches, cost = self.calls, self.matches, self.cost
+        result = not decisive
+
+        for i in self.order:
+            start = time.perf_counter()
+            matched = bool(self.criteria[i](request))
+            cost[i] += time.perf_counter() - start
+            calls[i] += 1
+            matches[i] += matched
+
+            if matched is decisive:
+                result = decisive
+                break
+
+        self.evaluations += 1
+        if self.evaluations >= _ADAPTIVE_INTERVAL:
+            self.reorder()
+
+        return result
+
+    def reorder(self):
+        """Order children by their expected cost per decisive result, and
+        halve the statistics, so the order follows changes in traffic.
+
+        """
+        def key(i):
+            calls = self.calls[i]
+            if not calls:
+                # never reached, as others before it were always decisive.
+                return float('inf')
+
+            decisive = self.matches[i] if self.decisive else \
+                calls - self.matches[i]
+            # smoothed, so a child that's never been decisive still sorts.
+            rate = (decisive + 1) / (calls + 2)
+            return (self.cost[i] / calls) / rate
+
+        self.order.sort(key=key)
+
+        self.calls = [c // 2 for c in self.calls]
+        self.matches = [m // 2 for m in self.matches]
+        self.cost = [c / 2 for c in self.cost]
+        self.evaluations = 0
+
+    def stats(self):
+        """Return the recorded statistics of each child, in evaluation order.
+
+        """
+        stats = []
+        for i in self.order:
+            calls = self.calls[i]
+            stats.append({
+                'criteria': str(self.criteria[i]),
+                'calls': calls,
+                'matches': self.matches[i],
+                'match_rate': self.matches[i] / calls if calls else None,
+                'mean_cost': self.cost[i] / calls if calls else None,
+            })
+        return stats
 
     def __str__(self):
         return '<%s (%s)>' % \
             (self.__class__.__name__, ', '.join(map(str, self.criteria)))
 
 
-class AllOfCriteria(BaseCriteria):
-    """Criteria that matches only if all given child criteria match."""
+class AnyOfCriteria(CompositeCriteria):
+    """Criteria that matches only if any given child criteria match."""
+    decisive = True
+
+    def __call__(self, request):
+        if _ADAPTIVE_INTERVAL:
+            return self.adaptive_call(request)
+        return any(c(request) for c in self.criteria)
+
+    def constraints(self):
+        # only facts constrained by every child constrain the whole.
+        children = [get_constraints(c) for c in self.criteria]
+        if not children:
+            return {}
+
+        facts = set.intersection(*(set(c) for c in children))
+        return {fact: frozenset().union(*(c[fact] for c in children))
+                for fact in facts}
 
-    def __init__(self, *criteria):
-        super().__init__()
-        self.criteria = criteria
+
+class AllOfCriteria(CompositeCriteria):
+    """Criteria that matches only if all given child criteria match."""
+    decisive = False
 
     def __call__(self, request):
+        if _ADAPTIVE_INTERVAL:
+            return self.adaptive_call(request)
         return all(c(request) for c in self.criteria)
 
-    def __str__(self):
-        return '<%s (%s)>' % \
-            (self.__class__.__name__, ', '.join(map(str, self.criteria)))
+    def constraints(self):
+        constraints = {}
+        for child in self.criteria:
+            for fact, values in get_constraints(child).items():
+                if fact in constraints:
+                    values = constraints[fact] & values
+                constraints[fact] = values
+        return constraints
+
+
+def enable_adaptive_ordering(interval=1000):
+    """Record statistics for the children of `AnyOfCriteria` and
+    `AllOfCriteria`, reordering them every ``interval`` evaluations.
+
+    Which handler is used for a request never changes, only the order
+    children of composite criteria are checked in. See `criteria_stats` for
+    exporting the statistics.
+
+    """
+    global _ADAPTIVE_INTERVAL
+    _ADAPTIVE_INTERVAL = interval
+
+
+def disable_adaptive_ordering():
+    """Stop recording statistics and reordering composite criteria. Their
+    current order is kept.
+
+    """
+    global _ADAPTIVE_INTERVAL
+    _ADAPTIVE_INTERVAL = None
+
+
+def criteria_stats():
+    """Return the statistics recorded by adaptive ordering for every composite
+    criteria in use, as a list of dicts suitable for e.g. JSON.
+
+    """
+    stats = []
+
+    def visit(path, handler, criteria):
+        if isinstance(criteria, CompositeCriteria):
+            stats.append({
+                'path': path,
+                'handler': getattr(handler, '__qualname__', str(handler)),
+                'criteria': str(criteria),
+                'children': criteria.stats(),
+            })
+            for child in criteria.criteria:
+                visit(path, handler, child)
+        elif isinstance(criteria, BloomFilterCriteria):
+            visit(path, handler, criteria.criteria)
+
+    for path, services in sorted(_HANDLERS.items()):
+        for criteria, handler, raw in services:
+            visit(path, handler, criteria)
+
+    return stats
 
 
 class RegexCriteria(BaseCriteria):
     """Criteria that processes requests based on the URL, by a regex."""
     priority = 3
+    depends_on = frozenset(['url'])
 
     def __init__(self, regex):
         super().__init__()
         self.regex = re.compile(regex)
 
     def __call__(self, request):
-        url = urllib.parse.urlunparse(request.session['url'])
-        return bool(self.regex.match(url))
+        return bool(self.regex.match(get_facts(request).url))
 
     def __str__(self):
         return '<%s (%r)>' % (self.__class__.__name__, self.regex.pattern)
 
 
+# inline flags that can be scoped to a group, for combining regexes.
+_scoped_flags = [(re.ASCII, 'a'), (re.IGNORECASE, 'i'), (re.MULTILINE, 'm'),
+                 (re.DOTALL, 's'), (re.VERBOSE, 'x')]
+_global_flags = re.compile(r'\(\?[aiLmsux]+\)')
+_numbered_reference = re.compile(r'\\[1-9]|\(\?\(\d')
+
+
+class RegexSetCriteria(BaseCriteria):
+    """Criteria that processes requests based on the URL, by any of a number
+    of regexes.
+
+    The regexes are combined into a single alternation with a named group
+    for each, so the URL is only scanned once however many there are. Their
+    flags, whether compiled in or inline, are scoped to their group. Regexes
+    with named groups or numbered backreferences can't be combined safely,
+    so they're matched one by one after it.
+    """
+    priority = 3
+    depends_on = frozenset(['url'])
+
+    def __init__(self, *regexes):
+        super().__init__()
+        compiled = [re.compile(r) for r in regexes]
+        self.patterns = [r.pattern for r in compiled]
+
+        combined = []
+        self.separate = []
+        for i, regex in enumerate(compiled):
+            if regex.groupindex or _numbered_reference.search(regex.pattern):
+                self.separate.append((i, regex))
+            else:
+                combined.append('(?P<_%d>%s)' % (i, _scoped(regex)))
+
+        self.regex = None
+        if combined:
+            try:
+                self.regex = re.compile('|'.join(combined))
+            except re.error:
+                self.separate = list(enumerate(compiled))
+
+    def __call__(self, request):
+        return self.matching(request) is not None
+
+    def matching(self, request):
+        """Return the regex that matched ``request``, or None."""
+        url = get_facts(request).url
+
+        found = None
+        if self.regex is not None:
+            match = self.regex.match(url)
+            if match is not None:
+                found = int(match.lastgroup[1:])
+
+        # the first regex to match wins, as in the alternation.
+        for i, regex in self.separate:
+            if found is not None and i > found:
+                break
+            if regex.match(url):
+                found = i
+                break
+
+        if found is None:
+            return None
+        return self.patterns[found]
+
+    def __str__(self):
+        return '<%s (%r)>' % (self.__class__.__name__, self.patterns)
+
+
+def _scoped(regex):
+    """Return the pattern of the compiled ``regex`` as a non-capturing group
+    with its flags scoped to it, for use in a larger regex.
+
+    """
+    # global inline flags are only allowed at the start of a regex, and are
+    # already part of ``regex.flags``.
+    pattern = regex.pattern
+    while True:
+        match = _global_flags.match(pattern)
+        if match is None:
+            break
+        pattern = pattern[match.end():]
+
+    flags = ''.join(flag for value, flag in _scoped_flags
+                    if regex.flags & value)
+    if regex.flags & re.VERBOSE:
+        # so a trailing comment doesn't swallow the closing parenthesis.
+        pattern += '\n'
+    return '(?%s:%s)' % (flags, pattern)
+
+
+class DomainIndex(object):
+    """A compiled set of domain patterns, as used by `DomainCriteria`.
+
+    Exact hosts are kept in a set, patterns like "*.example.com" in a trie of
+    reversed labels, and any other glob patterns are combined into a single
+    regex, so matching doesn't depend on the number of domains.
+
+    Patterns and hosts are normalized with `normalize_host`.
+
+    """
+    def __init__(self, patterns=()):
+        self.exact = set()
+
+        # nested dicts keyed by label, from the top level domain down. A None
+        # key marks a "*." pattern ending at that node.
+        self.suffixes = {}
+
+        # the globs are compiled into ``regex`` when they're first matched,
+        # rather than on every add, which would be quadratic.
+        self.globs = []
+        self.regex = None
+
+        for pattern in patterns:
+            self.add(pattern)
+
+        self.compile()
+
+    def add(self, pattern):
+        """Add ``pattern`` to the index."""
+        pattern = normalize_host(pattern)
+
+        if not _is_glob(pattern):
+            self.exact.add(pattern)
+        elif pattern.startswith('*.') and not _is_glob(pattern[2:]):
+            node = self.suffixes
+            for label in reversed(pattern[2:].split('.')):
+                node = node.setdefault(label, {})
+            node[None] = True
+        else:
+            self.globs.append(pattern)
+            self.regex = None
+
+    def compile(self):
+        """Compile the glob patterns into a single regex, if they've changed
+        since it was last compiled, and return it, or None if there are none.
+
+        """
+        if self.regex is None and self.globs:
+            self.regex = re.compile('|'.join(
+                fnmatch.translate(glob) for glob in self.globs))
+        return self.regex
+
+    def __contains__(self, host):
+        """Return True if the normalized ``host`` matches any pattern."""
+        if host in self.exact:
+            return True
+
+        if self.suffixes:
+            node = self.suffixes
+            labels = host.split('.')
+            # the last label can't match, "*.example.com" requires at least
+            # one label before "example.com".
+            for i in range(len(labels) - 1, 0, -1):
+                node = node.get(labels[i])
+                if node is None:
+                    break
+                if None in node:
+                    return True
+
+        regex = self.regex
+        if regex is None:
+            regex = self.compile()
+        return regex is not None and regex.match(host) is not None
+
+
 class DomainCriteria(BaseCriteria):
     """Criteria that processes requests based on the domain.
 
     Supports globbing, e.g. "*google.com" matches "www.google.com", and
     "go?gle.com" matches "goggle.com" and "google.com".
+
+    Matching ignores case, the port and any trailing dot. Patterns like
+    "*.google.com" are matched by suffix, so large lists of them are cheap.
     """
     priority = 2
+    depends_on = frozenset(['host'])
 
     def __init__(self, *domains):
         super().__init__()
         self.domains = domains
+        self.index = DomainIndex(domains)
 
     def __call__(self, request):
-        if request.is_reqmod:
-            headers = request.http.headers
-        else:
-            headers = request.http.request_headers
+        return get_facts(request).host in self.index
 
-        host = headers.get('Host', '')
-        match = functools.partial(fnmatch.fnmatch, host)
-
-        return any(match(pattern) for pattern in self.domains)
+    def constraints(self):
+        index = self.index
+        if index.suffixes or index.globs:
+            return {}
+        return {'host': frozenset(index.exact)}
 
     def __str__(self):
         return '<%s (%r)>' % (self.__class__.__name__, ', '.join(self.domains))
 
 
+class DomainListCriteria(BaseCriteria):
+    """Criteria that matches requests whose domain is in a list index file,
+    built with `~icap.listindex.build_index` or ``python -m icap.listindex``.
+
+    The file is memory mapped rather than loaded, so lists with millions of
+    domains open instantly and share memory between processes. Subdomains
+    of listed domains match too, unless ``subdomains`` is False.
+    """
+    priority = 2
+    depends_on = frozenset(['host'])
+
+    def __init__(self, path, subdomains=True):
+        super().__init__()
+        self.index = ListIndex(path)
+        self.subdomains = subdomains
+
+    def __call__(self, request):
+        host = get_facts(request).host
+        index = self.index
+
+        if host in index:
+            return True
+
+        if self.subdomains:
+            _, dot, host = host.partition('.')
+            while dot:
+                if host in index:
+                    return True
+                _, dot, host = host.partition('.')
+
+        return False
+
+    def __str__(self):
+        return '<%s (%r)>' % (self.__class__.__name__, self.index.path)
+
+
+class URLListCriteria(BaseCriteria):
+    """Criteria that matches requests whose URL is in a list index file,
+    built with `~icap.listindex.build_index` or ``python -m icap.listindex``.
+
+    URLs must match exactly. See `DomainListCriteria`.
+    """
+    priority = 3
+    depends_on = frozenset(['url'])
+
+    def __init__(self, path):
+        super().__init__()
+        self.index = ListIndex(path)
+
+    def __call__(self, request):
+        return get_facts(request).url in self.index
+
+    def __str__(self):
+        return '<%s (%r)>' % (self.__class__.__name__, self.index.path)
+
+
+class BloomFilter(object):
+    """A Bloom filter of strings, sized for ``capacity`` items with a
+    false positive rate of ``error_rate``.
+
+    """
+    def __init__(self, capacity, error_rate=0.01):
+        capacity = max(capacity, 1)
+        size = -capacity * math.log(error_rate) / math.log(2) ** 2
+
+        self.hashes = max(int(round(size / capacity * math.log(2))), 1)
+
+        # small filters are rounded up, it costs very little to make them far
+        # more accurate than asked for.
+        self.size = max(int(size), 1024)
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, item):
+        digest = hashlib.blake2b(item.encode('utf8'), digest_size=16).digest()
+        a = int.from_bytes(digest[:8], 'little')
+        b = int.from_bytes(digest[8:], 'little') | 1
+        size = self.size
+        return [(a + i * b) % size for i in range(self.hashes)]
+
+    def add(self, item):
+        bits = self.bits
+        for position in self._positions(item):
+            bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, item):
+        bits = self.bits
+        return all(bits[position >> 3] & (1 << (position & 7))
+                   for position in self._positions(item))
+
+
+class BloomFilterCriteria(BaseCriteria):
+    """Criteria wrapping an expensive ``criteria``, only calling it for
+    requests whose URL probably has one of ``keys``.
+
+    ``keys`` are domains, e.g. "example.com", or domains with a path prefix,
+    e.g. "example.com/ads", and must cover every URL ``criteria`` can match.
+    A request is checked if its host or a parent domain, with or without any
+    leading part of its path, is in a Bloom filter of ``keys``. Roughly
+    ``error_rate`` of requests matching none of them are checked regardless.
+
+    The ``checked``, ``skipped``, ``matched`` and ``false_positives`` counts
+    are kept, see `stats`.
+    """
+    def __init__(self, criteria, keys, error_rate=0.01):
+        super().__init__()
+        keys = [self.normalize_key(key) for key in keys]
+
+        self.criteria = criteria
+        self.filter = BloomFilter(len(keys), error_rate)
+        for key in keys:
+            self.filter.add(key)
+
+        self.checked = 0
+        self.skipped = 0
+        self.matched = 0
+        self.false_positives = 0
+
+    @property
+    def priority(self):
+        return getattr(self.criteria, 'priority', BaseCriteria.priority)
+
+    @staticmethod
+    def normalize_key(key):
+        host, slash, path = key.partition('/')
+        return normalize_host(host) + slash + path.rstrip('/')
+
+    def probes(self, request):
+        """Yield the keys ``request`` would match in the filter."""
+        facts = get_facts(request)
+        host = facts.host
+        segments = facts.parsed_url.path.strip('/').split('/')
+
+        while host:
+            yield host
+
+            path = host
+            for segment in segments:
+                if not segment:
+                    break
+                path = path + '/' + segment
+                yield path
+
+            host = host.partition('.')[2]
+
+    def __call__(self, request):
+        if not any(key in self.filter for key in self.probes(request)):
+            self.skipped += 1
+            return False
+
+        self.checked += 1
+        if self.criteria(request):
+            self.matched += 1
+            return True
+
+        self.false_positives += 1
+        return False
+
+    def constraints(self):
+        return get_constraints(self.criteria)
+
+    @property
+    def depends_on(self):
+        return get_depends_on(self.criteria)
+
+    def stats(self):
+        """Return a dict of the counts of requests skipped by the filter,
+        checked with the wrapped criteria, matched, and false positives, along
+        with the ratios of hits (checked) and misses (skipped) to requests.
+
+        """
+        total = self.checked + self.skipped
+        return {
+            'skipped': self.skipped,
+            'checked': self.checked,
+            'matched': self.matched,
+            'false_positives': self.false_positives,
+            'hit_rate': self.checked / total if total else 0.0,
+            'miss_rate': self.skipped / total if total else 0.0,
+        }
+
+    def __str__(self):
+        return '<%s (%s)>' % (self.__class__.__name__, self.criteria)
+
+
 class ContentTypeCriteria(BaseCriteria):
     """Criteria that matches responses based on the Content-Type header."""
 
     priority = 2
+    depends_on = frozenset(['content_type'])
 
     def __init__(self, *content_types):
         super().__init__()
@@ -129,10 +727,12 @@ class ContentTypeCriteria(BaseCriteria):
     def __call__(self, request):
         if request.is_reqmod:
             return False
-        headers = request.http.headers
-        content_type = headers.get('content-type', '')
 
-        return content_type in self.content_types
+        return get_facts(request).content_type in self.content_types
+
+    def constraints(self):
+        return {'is_reqmod': frozenset([False]),
+                'content_type': frozenset(self.content_types)}
 
     def __str__(self):
         return '<%s (%r)>' % \
@@ -141,25 +741,36 @@ class ContentTypeCriteria(BaseCriteria):
 
 class MethodCriteria(BaseCriteria):
     """Criteria that matches on the method of the encapsulated HTTP request."""
+    depends_on = frozenset(['method'])
 
     def __init__(self, *methods):
         self.methods = {s.upper() for s in methods}
 
     def __call__(self, request):
-        return request.http.request_line.method in self.methods
+        return get_facts(request).method in self.methods
 
 
 class HTTPRequestCriteria(BaseCriteria):
     """Criteria that matches if the request is a REQMOD."""
+    depends_on = frozenset()
+
     def __call__(self, request):
         return request.is_reqmod
 
+    def constraints(self):
+        return {'is_reqmod': frozenset([True])}
+
 
 class HTTPResponseCriteria(BaseCriteria):
     """Criteria that matches if the request is a RESPMOD."""
+    depends_on = frozenset()
+
     def __call__(self, request):
         return request.is_respmod
 
+    def constraints(self):
+        return {'is_reqmod': frozenset([False])}
+
 
 class StatusCodeCriteria(HTTPResponseCriteria):
     """Criteria that matches on the status code of the encapsulated HTTP
@@ -168,16 +779,15 @@ class StatusCodeCriteria(HTTPResponseCriteria):
     Never matches on HTTP requests.
 
     """
+    depends_on = frozenset(['status_code'])
 
     def __init__(self, *status_codes):
         self.status_codes = status_codes
 
     def __call__(self, request):
-        http = request.http
-
         # super isn't callable! The horror.
         return (super().__call__(request) and
-                http.status_line.code in self.status_codes)
+                get_facts(request).status_code in self.status_codes)
 
 
 class HeaderCriteria(BaseCriteria):
@@ -187,15 +797,16 @@ class HeaderCriteria(BaseCriteria):
     """
     def __init__(self, key, *values):
         self.key = key.lower()
-        self.values = set(values)
+        self.values = frozenset(values)
         self.check_values = bool(values)
+        self.depends_on = frozenset(['header:%s' % self.key])
 
     def __call__(self, request):
-        values = request.http.headers.getlist(self.key)
+        values = get_facts(request).header_values(self.key)
 
         if values:
             if self.check_values:
-                return bool(self.values & set(values))
+                return not self.values.isdisjoint(values)
             else:
                 return True
 
@@ -210,26 +821,370 @@ class AlwaysCriteria(BaseCriteria):
 
     """
     priority = 5
+    depends_on = frozenset()
 
     def __call__(self, request):
         return True
 
 
-def get_handler(request):
+def _is_glob(pattern):
+    return any(c in pattern for c in '*?[')
+
+
+def get_constraints(criteria):
+    """Return the constraints of ``criteria``, which may be any callable."""
+    constraints = getattr(criteria, 'constraints', None)
+    if constraints is None:
+        return {}
+    return constraints()
+
+
+def get_depends_on(criteria):
+    """Return the facts ``criteria`` depends on, which may be any callable, or
+    None if they are unknown.
+
+    """
+    return getattr(criteria, 'depends_on', None)
+
+
+def normalize_host(host):
+    """Return ``host`` lowercased, without any port or trailing dot."""
+    host = host.lower()
+
+    if host.startswith('['):
+        # IPv6 address, e.g. [::1]:8080
+        host = host[:host.find(']') + 1] or host
+    elif ':' in host:
+        host = host.split(':', 1)[0]
+
+    return host.rstrip('.')
+
+
+class RequestFacts(object):
+    """Facts about a request that criteria match on, each computed the first
+    time it is used.
+
+    `~icap.criteria.get_handler` attaches one to the request as ``facts`` for
+    the duration of routing, and afterwards, so however many criteria are
+    checked, each fact is only computed once. Use `get_facts` to get the
+    facts of a request in criteria.
+
+    Facts describe the request as it was received. They aren't updated if
+    it is modified.
+
+    If ``weak`` is True the facts only keep a weak reference to the request,
+    as when they're attached to it, so the two don't form a cycle and the
+    request is freed as soon as it's finished with.
+
+    """
+    def __init__(self, request, weak=False):
+        self._request = weakref.ref(request) if weak else request
+        self._weak = weak
+        self._header_values = {}
+
+    @property
+    def request(self):
+        return self._request() if self._weak else self._request
+
+    def __getstate__(self):
+        # weak references can't be pickled, e.g. for process executors.
+        state = self.__dict__.copy()
+        state['_request'], state['_weak'] = self.request, False
+        return state
+
+    @cached_property
+    def host(self):
+        """The normalized Host header of the encapsulated HTTP request."""
+        request = self.request
+        if request.is_reqmod:
+            headers = request.http.headers
+        else:
+            headers = request.http.request_headers
+
+        return normalize_host(headers.get('Host', ''))
+
+    @cached_property
+    def content_type(self):
+        """The Content-Type header of the encapsulated HTTP message."""
+        return self.request.http.headers.get('content-type', '')
+
+    @cached_property
+    def method(self):
+        """The method of the encapsulated HTTP request."""
+        return self.request.http.request_line.method
+
+    @cached_property
+    def status_code(self):
+        """The status code of the encapsulated HTTP response."""
+        return self.request.http.status_line.code
+
+    @cached_property
+    def parsed_url(self):
+        """The URL of the encapsulated HTTP request, as parsed by
+        `urllib.parse.urlparse`.
+
+        Taken from the session if there is one, see
+        `~icap.session.prepare_session`.
+
+        """
+        session = getattr(self.request, 'session', None)
+        if session is not None and 'url' in session:
+            return session['url']
+        return self.request.http.request_line.uri
+
+    @cached_property
+    def url(self):
+        """The URL of the encapsulated HTTP request, as a string."""
+        url = self.parsed_url
+        # request lines parse the query into a dict, see
+        # `~icap.models.RequestLine`.
+        if not isinstance(url.query, str):
+            url = url._replace(query=urllib.parse.urlencode(url.query,
+                                                            doseq=True))
+        return urllib.parse.urlunparse(url)
+
+    @cached_property
+    def client_ip(self):
+        """The IP address of the HTTP client, from the X-Client-IP header ICAP
+        clients such as Squid send, or an empty string.
+
+        """
+        return self.request.headers.get('X-Client-IP', '')
+
+    def get(self, name):
+        """Return the fact called ``name``. Names starting with "header:" are
+        the values of the header named by the rest, see `header_values`.
+
+        """
+        if name.startswith('header:'):
+            return self.header_values(name[7:])
+        return getattr(self, name)
+
+    def header_values(self, key):
+        """Return a frozenset of the values of header ``key`` in the
+        encapsulated HTTP message.
+
+        """
+        key = key.lower()
+        try:
+            return self._header_values[key]
+        except KeyError:
+            values = frozenset(self.request.http.headers.getlist(key))
+            self._header_values[key] = values
+            return values
+
+
+def get_facts(request):
+    """Return the `RequestFacts` for ``request``."""
+    facts = getattr(request, 'facts', None)
+    if isinstance(facts, RequestFacts) and facts.request is request:
+        return facts
+    return RequestFacts(request)
+
+
+class RoutingTable(object):
+    """The handlers for a single service, indexed by the facts their criteria
+    constrain (see `~icap.criteria.BaseCriteria.constraints`).
+
+    Handlers are split by whether they can match REQMOD or RESPMOD requests,
+    then by the exact host or content type they require, so only criteria
+    that can possibly match a request are called. Criteria which aren't
+    constrained on either are always called. Handler precedence is the order
+    of ``services``.
+
+    If every criteria declares the facts it depends on (see
+    `~icap.criteria.BaseCriteria.depends_on`), requests may be routed as soon
+    as their encapsulated headers are parsed. If ``cache_size`` is given too,
+    the results of routing, including no match, are kept in an LRU cache of
+    that size keyed by those facts.
+
+    This class should never be used directly. It is for internal usage only.
+
+    """
+    def __init__(self, services, cache_size=None):
+        self.services = list(services)
+
+        # is_reqmod -> (unindexed, by_host, by_content_type), each holding
+        # indexes into self.services, in order.
+        self.buckets = {}
+
+        for is_reqmod in (True, False):
+            unindexed, by_host, by_content_type = [], {}, {}
+
+            for i, (criteria, handler, raw) in enumerate(self.services):
+                constraints = get_constraints(criteria)
+
+                if is_reqmod not in constraints.get('is_reqmod', (is_reqmod,)):
+                    continue
+
+                if 'host' in constraints:
+                    index, keys = by_host, constraints['host']
+                elif 'content_type' in constraints:
+                    index, keys = by_content_type, constraints['content_type']
+                else:
+                    unindexed.append(i)
+                    continue
+
+                for key in keys:
+                    index.setdefault(key, []).append(i)
+
+            self.buckets[is_reqmod] = unindexed, by_host, by_content_type
+
+        # criteria that declare the facts they depend on don't read the
+        # body, so they can be checked once the encapsulated headers are in.
+        depends_on = self.depends_on()
+        self.headers_only = depends_on is not None
+
+        self.cache = None
+        self.cache_size = cache_size
+        self.cache_facts = None
+
+        if cache_size:
+            self.cache_facts = depends_on
+
+        if self.cache_facts is not None:
+            self.cache = OrderedDict()
+
+    def depends_on(self):
+        """Return the sorted names of the facts routing depends on, or None
+        if any criteria doesn't declare them.
+
+        """
+        facts = set()
+        for criteria, handler, raw in self.services:
+            depends_on = get_depends_on(criteria)
+            if depends_on is None:
+                return None
+            facts |= depends_on
+
+        # the index depends on the facts criteria are constrained on, too.
+        for unindexed, by_host, by_content_type in self.buckets.values():
+            if by_host:
+                facts.add('host')
+            if by_content_type:
+                facts.add('content_type')
+
+        return sorted(facts)
+
+    def candidates(self, request):
+        """Return the indexes of handlers whose criteria may match
+        ``request``, in order.
+
+        """
+        unindexed, by_host, by_content_type = \
+            self.buckets[bool(request.is_reqmod)]
+
+        if not by_host and not by_content_type:
+            return unindexed
+
+        indexes = [unindexed]
+
+        if by_host:
+            indexes.append(by_host.get(get_facts(request).host, ()))
+
+        if by_content_type:
+            indexes.append(by_content_type.get(
+                get_facts(request).content_type, ()))
+
+        return heapq.merge(*indexes)
+
+    def match(self, request):
+        """Return the ``(handler, raw)`` of the first handler matching
+        ``request``, or None.
+
+        """
+        cache = self.cache
+        if cache is None:
+            return self.evaluate(request)
+
+        facts = get_facts(request)
+        key = (bool(request.is_reqmod),) + tuple(
+            facts.get(name) for name in self.cache_facts)
+
+        try:
+            result = cache[key]
+        except KeyError:
+            result = cache[key] = self.evaluate(request)
+            if len(cache) > self.cache_size:
+                cache.popitem(last=False)
+        else:
+            cache.move_to_end(key)
+
+        return result
+
+    def evaluate(self, request):
+        """Return the ``(handler, raw)`` of the first handler whose criteria
+        match ``request``, or None.
+
+        """
+        services = self.services
+        for i in self.candidates(request):
+            criteria, handler, raw = services[i]
+            if criteria(request):
+                return handler, raw
+        return None
+
+
+def compile_routes():
+    """Compile a `~icap.criteria.RoutingTable` for each service in _HANDLERS.
+
+    Done by `~icap.criteria.sort_handlers`, and by
+    `~icap.criteria.get_handler` whenever handlers have changed since.
+
+    You should not use this directly.
+
+    """
+    global _ROUTES, _ROUTES_VERSION
+    _ROUTES = {path: RoutingTable(services, _ROUTING_CACHE_SIZE)
+               for path, services in _HANDLERS.items()}
+    _ROUTES_VERSION = _HANDLERS.version
+
+
+def enable_routing_cache(size=10000):
+    """Cache up to ``size`` routing decisions for each service, including
+    requests no handler matched.
+
+    Decisions are keyed by the facts the service's criteria depend on, so
+    only services whose criteria all declare them are cached (see
+    `~icap.criteria.BaseCriteria.depends_on`). Criteria that read anything
+    else, e.g. the body or session, must leave ``depends_on`` as None. The
+    cache is emptied whenever handlers change.
+
+    """
+    global _ROUTING_CACHE_SIZE, _ROUTES_VERSION
+    _ROUTING_CACHE_SIZE = size
+    _ROUTES_VERSION = None
+
+
+def disable_routing_cache():
+    """Stop caching routing decisions."""
+    global _ROUTING_CACHE_SIZE, _ROUTES_VERSION
+    _ROUTING_CACHE_SIZE = None
+    _ROUTES_VERSION = None
+
+
+def get_handler(request, headers_only=False):
     """Return the handler for a given request, and whether it should be given
     the raw ICAP request.
 
+    If ``headers_only`` is True, ``request`` has been parsed up to the end of
+    its encapsulated headers only, and None is returned if the criteria of
+    the service may need to look at the body to decide.
+
     Will abort with the following codes in given conditions:
 
         404: no handlers at a given endpoint.
         204: there are handlers at a given endpoint, but none of them matched.
 
     """
+    if _ROUTES_VERSION != _HANDLERS.version:
+        compile_routes()
+
     uri = request.request_line.uri
     path = uri.path
-    services = _HANDLERS.get(path)
+    table = _ROUTES.get(path)
 
-    if not services:
+    if table is None or not table.services:
         # RFC3507 says we should abort with 404 if there are no handlers at
         # a given resource. The most common ICAP client, Squid, doesn't handle
         # this very well - it relays them to the client as internal errors.
@@ -241,15 +1196,21 @@ def get_handler(request):
     if request.is_options:
         return None, True
 
-    for criteria, handler, raw in services:
-        if criteria(request):
-            return handler, raw
+    if headers_only and not table.headers_only:
+        return None
 
-    abort(204)
+    request.facts = RequestFacts(request, weak=True)
+
+    match = table.match(request)
+    if match is None:
+        abort(204)
+
+    return match
 
 
 def sort_handlers():
-    """Sort _HANDLERS values by priority.
+    """Sort _HANDLERS values by priority, and compile them into routing
+    tables.
 
     You should not use this directly.
 
@@ -257,8 +1218,23 @@ def sort_handlers():
     for key, items in _HANDLERS.items():
         _HANDLERS[key] = sorted(items, key=lambda f: f[0], reverse=True)
 
+    compile_routes()
+
+
+def without_body(func):
+    """Return a version of handler ``func`` marked as not needing the body
+    of the messages it's given, see the ``body`` argument of `handler`.
+
+    """
+    @functools.wraps(func)
+    def wrapper(message):
+        return func(message)
+
+    wrapper.needs_body = False
+    return wrapper
 
-def handler(criteria=None, name='', raw=False):
+
+def handler(criteria=None, name='', raw=False, executor='loop', body=True):
     """Decorator to be used on functions/methods/classes intended to be used
     for handling request or response modifications.
 
@@ -271,11 +1247,31 @@ def handler(criteria=None, name='', raw=False):
         ``raw`` - If True, the callable will receive an instance of
                   `~icap.models.ICAPRequest` instead of an instance of
                   `~icap.models.HTTPRequest` or `~icap.models.HTTPResponse`.
+        ``executor`` - where to run the callable if it isn't a coroutine.
+                       ``'loop'`` runs it directly on the event loop,
+                       ``'thread'`` in the loop's default thread pool and
+                       ``'process'`` in a shared process pool. An instance
+                       of `concurrent.futures.Executor` may also be given.
+                       Handlers run in processes must be picklable, and
+                       receive a copy of the message; changes to it are
+                       copied back once the handler returns.
+        ``body`` - If False, the callable only looks at the headers,
+                   cookies, request line or status line of the message,
+                   so it may be called as soon as those are parsed, before
+                   the body has been received. Unless it replaces the body,
+                   or returns a different message, the body is then relayed
+                   into the response as it arrives, without being kept.
+                   This only happens when the request can be routed before
+                   the body arrives, see
+                   `~icap.criteria.BaseCriteria.depends_on`; otherwise the
+                   message is complete as usual.
 
     """
 
     criteria = criteria or AlwaysCriteria()
 
+    validate_executor(executor)
+
     def inner(handler):
         orig_handler = handler
         if isinstance(handler, type):
@@ -286,15 +1282,25 @@ def handler(criteria=None, name='', raw=False):
             reqmod = handler if handler.__name__ == 'reqmod' else None
             respmod = handler if handler.__name__ == 'respmod' else None
 
+        if reqmod:
+            reqmod = in_executor(reqmod, executor)
+            if not body:
+                reqmod = without_body(reqmod)
+
+        if respmod:
+            respmod = in_executor(respmod, executor)
+            if not body:
+                respmod = without_body(respmod)
+
         if reqmod:
             key = '/'.join([name, 'reqmod'])
             key = key if key.startswith('/') else '/%s' % key
-            _HANDLERS[key].append((criteria, reqmod, raw))
+            _HANDLERS.add(key, (criteria, reqmod, raw))
 
         if respmod:
             key = '/'.join([name, 'respmod'])
             key = key if key.startswith('/') else '/%s' % key
-            _HANDLERS[key].append((criteria, respmod, raw))
+            _HANDLERS.add(key, (criteria, respmod, raw))
         return orig_handler
 
     return inner
@@ -0,0 +1,159 @@
+"""
+Helpers for running handlers outside of the event loop.
+
+CPU-bound or otherwise blocking handlers (e.g. HTML rewriting, gzip) stall
+every other connection when run on the event loop. The functions here wrap
+such handlers so they run in a thread or process pool instead. See the
+``executor`` argument of `~icap.criteria.handler`.
+
+"""
+
+import asyncio
+import concurrent.futures
+import functools
+import inspect
+import types
+
+__all__ = [
+    'in_executor',
+    'shutdown',
+]
+
+
+_process_pool = None
+
+EXECUTORS = ('loop', 'thread', 'process')
+
+
+def get_process_pool():
+    """Return the process pool shared by all ``executor='process'`` handlers,
+    creating it on first use.
+
+    """
+    global _process_pool
+    if _process_pool is None:
+        _process_pool = concurrent.futures.ProcessPoolExecutor()
+    return _process_pool
+
+
+def shutdown(wait=True):
+    """Shut down the shared process pool, if it was ever started."""
+    global _process_pool
+    if _process_pool is not None:
+        _process_pool.shutdown(wait=wait)
+        _process_pool = None
+
+
+def validate_executor(executor):
+    """Raise ValueError if ``executor`` isn't a valid handler executor."""
+    if ((not isinstance(executor, concurrent.futures.Executor) and
+         executor not in EXECUTORS)):
+        raise ValueError("executor must be one of %s or an Executor "
+                         "instance, received %r" % (', '.join(EXECUTORS),
+                                                    executor))
+
+
+def in_executor(func, executor='loop'):
+    """Return a version of handler ``func`` that runs in ``executor``.
+
+    ``executor`` may be ``'loop'``, ``'thread'``, ``'process'`` or an instance
+    of `concurrent.futures.Executor`. Coroutine handlers can't leave the event
+    loop, so they are always returned unchanged, as is anything given
+    ``'loop'``. Generator-based handlers are marked as coroutines so they can
+    be awaited.
+
+    """
+    validate_executor(executor)
+
+    target = getattr(func, '__func__', func)
+
+    if inspect.isgeneratorfunction(target):
+        # let generator-based handlers be awaited, and ``yield from`` native
+        # coroutines themselves.
+        types.coroutine(target)
+        return func
+
+    if executor == 'loop' or asyncio.iscoroutinefunction(target):
+        return func
+
+    remote = (executor == 'process' or
+              isinstance(executor, concurrent.futures.ProcessPoolExecutor))
+
+    @functools.wraps(func)
+    async def wrapper(message):
+        loop = asyncio.get_event_loop()
+
+        if executor == 'thread':
+            pool = None
+        elif executor == 'process':
+            pool = get_process_pool()
+        else:
+            pool = executor
+
+        if not remote:
+            return await loop.run_in_executor(pool, func, message)
+
+        copy, result = await loop.run_in_executor(
+            pool, call_remote, func, message)
+        merge_remote(message, copy)
+
+        # identity survives the round trip as the handler's result and the
+        # message were pickled together, so map it back to the original.
+        if result is copy:
+            result = message
+        return result
+
+    return wrapper
+
+
+def call_remote(func, message):
+    """Call ``func`` with ``message`` in a worker process.
+
+    Returns the message as well as the result, so modifications made by the
+    handler in place can be sent back to the event loop.
+
+    """
+    return message, func(message)
+
+
+def merge_remote(message, copy):
+    """Apply the state of ``copy``, a message returned from a worker process,
+    to ``message``.
+
+    For `~icap.models.ICAPRequest` objects the encapsulated HTTP message is
+    merged in place, and any changes to the session are copied back to the
+    original session.
+
+    """
+    from .models import ICAPRequest
+
+    if isinstance(message, ICAPRequest):
+        message.headers = copy.headers
+        merge_remote(message.http, copy.http)
+
+        session = getattr(message, 'session', None)
+        if session is not None:
+            session.update(copy.session)
+    else:
+        for name in slot_names(type(message)):
+            try:
+                setattr(message, name, getattr(copy, name))
+            except AttributeError:
+                # unset in the copy, e.g. lazily created defaults.
+                if hasattr(message, name):
+                    delattr(message, name)
+
+        if hasattr(message, '__dict__'):
+            state = vars(message)
+            state.clear()
+            state.update(vars(copy))
+
+
+def slot_names(cls):
+    """Return the names of the attributes in the ``__slots__`` of ``cls``
+    and its bases.
+
+    """
+    return [name for base in cls.__mro__
+            for name in base.__dict__.get('__slots__', ())
+            if name not in ('__dict__', '__weakref__')]
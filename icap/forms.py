@@ -0,0 +1,488 @@
+"""
+Incremental parsers for HTML form data, as used by
+`~icap.models.HTTPRequest.post`.
+
+Both parsers are fed the body a piece at a time, e.g. the chunks it was
+received in, so it never has to be joined. The content of each
+``multipart/form-data`` part is written to a `tempfile.SpooledTemporaryFile`
+as it's parsed, which moves to disk once it's larger than ``max_memory``
+bytes, so uploaded files don't have to fit in memory a second time.
+
+A `~icap.forms.MultipartForm` can be changed and written back out, e.g.
+
+    >>> form = request.post
+    >>> form.parts = [part for part in form if part.filename is None]
+    >>> form['comment'].text = 'redacted'
+
+and the body of the request is replaced when it's serialized. The files
+of the parts are closed once the request has been handled, see
+`~icap.forms.MultipartForm.close`.
+
+"""
+
+import tempfile
+
+from urllib.parse import parse_qsl
+
+from werkzeug import parse_options_header
+
+from .errors import MalformedRequestError
+
+__all__ = [
+    'FormPart',
+    'MultipartForm',
+    'MultipartParser',
+    'URLEncodedParser',
+]
+
+
+# parts larger than this are spooled to disk.
+DEFAULT_MAX_MEMORY = 1024 * 1024
+
+# the most bytes of part headers, or of the rest of a boundary line, that are
+# buffered while looking for their end.
+MAX_HEADER_SIZE = 16 * 1024
+
+BLOCK_SIZE = 65536
+
+
+class FormPart(object):
+    """A part of a ``multipart/form-data`` body.
+
+    ``headers`` is a `~icap.models.HeadersDict` of the headers of the part,
+    and its content is kept in ``file``, a `tempfile.SpooledTemporaryFile`
+    which is moved to disk once it's larger than ``max_memory`` bytes.
+
+    """
+    def __init__(self, headers=None, content=b'',
+                 max_memory=DEFAULT_MAX_MEMORY):
+        from .models import HeadersDict
+
+        self.headers = headers if headers is not None else HeadersDict()
+        self.max_memory = max_memory
+        self.file = tempfile.SpooledTemporaryFile(max_size=max_memory)
+        self.size = 0
+        self._original = None
+        if content:
+            self.write(content)
+
+    def __repr__(self):
+        return '<FormPart name=%r filename=%r size=%d>' % (
+            self.name, self.filename, self.size)
+
+    def __reduce__(self):
+        # temporary files can't be pickled, so the content is copied.
+        return (self.__class__, (self.headers, self.content, self.max_memory),
+                {'_original': self._original})
+
+    def write(self, data):
+        """Append ``data``, any bytes-like object, to the content."""
+        self.file.seek(0, 2)
+        self.file.write(data)
+        self.size += len(data)
+
+    @property
+    def disposition(self):
+        """The options of the Content-Disposition header, e.g. ``name``."""
+        return parse_options_header(
+            self.headers.get('Content-Disposition', ''))[1]
+
+    @property
+    def name(self):
+        """The name of the form field, or None."""
+        return self.disposition.get('name')
+
+    @property
+    def filename(self):
+        """The name of the uploaded file, or None if the part isn't a file."""
+        return self.disposition.get('filename')
+
+    @property
+    def content_type(self):
+        """The content type and charset of the Content-Type header, which
+        defaults to 'text/plain', as per RFC7578.
+
+        """
+        content_type, options = parse_options_header(
+            self.headers.get('Content-Type', 'text/plain'))
+        return content_type, options.get('charset', '')
+
+    @property
+    def content(self):
+        """The content of the part as bytes. Reads all of ``file``, so
+        `~icap.forms.FormPart.chunks` is better for large uploads.
+
+        """
+        self.file.seek(0)
+        return self.file.read()
+
+    @content.setter
+    def content(self, value):
+        self.file.close()
+        self.file = tempfile.SpooledTemporaryFile(max_size=self.max_memory)
+        self.size = 0
+        self.write(value)
+        # content isn't compared, so a new one is always a modification.
+        self._original = None
+
+    @property
+    def text(self):
+        """The content decoded using the charset of the Content-Type header
+        of the part, or UTF-8.
+
+        """
+        content_type, charset = self.content_type
+        return self.content.decode(charset or 'utf-8')
+
+    @text.setter
+    def text(self, value):
+        content_type, charset = self.content_type
+        self.content = value.encode(charset or 'utf-8')
+
+    def chunks(self, block_size=BLOCK_SIZE):
+        """Yield the content in pieces of at most ``block_size`` bytes."""
+        self.file.seek(0)
+        while True:
+            block = self.file.read(block_size)
+            if not block:
+                return
+            yield block
+
+    def mark_unmodified(self):
+        """Record the current state of the part, see
+        `~icap.forms.FormPart.modified`.
+
+        """
+        self._original = (self.headers, self.headers.version)
+
+    @property
+    def modified(self):
+        """Return True if the headers or content have changed since
+        `~icap.forms.FormPart.mark_unmodified` was called, or it never was.
+
+        """
+        original = self._original
+        return (original is None or original[0] is not self.headers or
+                original[1] != self.headers.version)
+
+    def close(self):
+        self.file.close()
+
+
+class MultipartForm(object):
+    """The parts of a ``multipart/form-data`` body, in order, and the
+    ``boundary`` separating them.
+
+    ``parts`` is a list of `~icap.forms.FormPart` objects which may be
+    changed, replaced, added to or removed from, and the form written back
+    out with `~icap.forms.MultipartForm.chunks`.
+
+    """
+    def __init__(self, boundary, parts=None, max_memory=DEFAULT_MAX_MEMORY):
+        if isinstance(boundary, bytes):
+            boundary = boundary.decode('latin-1')
+
+        self.boundary = boundary
+        self.parts = parts if parts is not None else []
+        self.max_memory = max_memory
+        self._original = None
+
+    def __iter__(self):
+        return iter(self.parts)
+
+    def __len__(self):
+        return len(self.parts)
+
+    def __getitem__(self, name):
+        """Return the first part named ``name``."""
+        for part in self.parts:
+            if part.name == name:
+                return part
+        raise KeyError(name)
+
+    def __contains__(self, name):
+        return any(part.name == name for part in self.parts)
+
+    def getlist(self, name):
+        """Return all parts named ``name``."""
+        return [part for part in self.parts if part.name == name]
+
+    @property
+    def fields(self):
+        """A dict of the names of the parts that aren't files to lists of
+        their decoded content, like `urllib.parse.parse_qs`.
+
+        """
+        fields = {}
+        for part in self.parts:
+            if part.filename is None:
+                fields.setdefault(part.name, []).append(part.text)
+        return fields
+
+    @property
+    def files(self):
+        """A dict of the names of the parts that are files to lists of the
+        parts.
+
+        """
+        files = {}
+        for part in self.parts:
+            if part.filename is not None:
+                files.setdefault(part.name, []).append(part)
+        return files
+
+    def chunks(self, block_size=BLOCK_SIZE):
+        """Yield the form serialized as a ``multipart/form-data`` body."""
+        delimiter = b'--' + self.boundary.encode('latin-1')
+
+        for part in self.parts:
+            yield b''.join([delimiter, b'\r\n', bytes(part.headers), b'\r\n'])
+            yield from part.chunks(block_size)
+            yield b'\r\n'
+
+        yield delimiter + b'--\r\n'
+
+    def __bytes__(self):
+        return b''.join(self.chunks())
+
+    def body(self):
+        """Return the form serialized for `~icap.models.HTTPMessage.body`.
+
+        That's bytes, unless the parts are larger than ``max_memory`` in
+        total, in which case the form is written to a temporary file and a
+        `~icap.models.FileBody` of it returned. The file belongs to the
+        body, and is removed when it's closed.
+
+        """
+        from .models import FileBody
+
+        if sum(part.size for part in self.parts) <= self.max_memory:
+            return bytes(self)
+
+        spool = tempfile.TemporaryFile()
+        for chunk in self.chunks():
+            spool.write(chunk)
+        spool.flush()
+        return FileBody(spool, 0, spool.tell())
+
+    def close(self):
+        """Close the files of all the parts."""
+        for part in self.parts:
+            part.close()
+
+    def mark_unmodified(self):
+        """Record the current state of the form and its parts, see
+        `~icap.forms.MultipartForm.modified`.
+
+        """
+        self._original = list(self.parts)
+        for part in self.parts:
+            part.mark_unmodified()
+
+    @property
+    def modified(self):
+        """Return True if parts have been added, removed, replaced or
+        modified since `~icap.forms.MultipartForm.mark_unmodified` was
+        called, or it never was.
+
+        """
+        original = self._original
+        if original is None or len(original) != len(self.parts):
+            return True
+
+        return any(part is not old or part.modified
+                   for part, old in zip(self.parts, original))
+
+
+class MultipartParser(object):
+    """Incremental parser of ``multipart/form-data`` bodies.
+
+    Feed the body to `~icap.forms.MultipartParser.feed` in pieces of any
+    size, then call `~icap.forms.MultipartParser.close` for the
+    `~icap.forms.MultipartForm`. If ``on_part`` is given, it's called with
+    each `~icap.forms.FormPart` as soon as its headers are parsed, before
+    its content is.
+
+    Content is written to the parts as it's parsed, so only the end of the
+    last piece, which might be the start of a boundary, is kept between
+    calls.
+
+    """
+    def __init__(self, boundary, max_memory=DEFAULT_MAX_MEMORY,
+                 on_part=None):
+        self.form = MultipartForm(boundary, max_memory=max_memory)
+        self.on_part = on_part
+        self.delimiter = b'\r\n--' + self.form.boundary.encode('latin-1')
+        self.part = None
+        self.complete = False
+
+        # the first boundary doesn't have to follow a line break, so parsing
+        # starts as if one had just been received. Until then, the content
+        # is the preamble, which is discarded.
+        self.buffer = bytearray(b'\r\n')
+        self.state = self.parse_content
+
+    def feed(self, data):
+        """Parse as much of the body as possible from ``data``, any
+        bytes-like object.
+
+        Raises `~icap.errors.MalformedRequestError` if the body is invalid.
+
+        """
+        if self.complete:
+            # the epilogue is discarded.
+            return
+
+        buffer = self.buffer
+        buffer += data
+
+        pos = 0
+        while not self.complete:
+            next_pos = self.state(buffer, pos)
+            if next_pos == pos:
+                break
+            pos = next_pos
+
+        del buffer[:pos]
+
+    def close(self):
+        """Return the `~icap.forms.MultipartForm` once the whole body has
+        been fed.
+
+        Raises `~icap.errors.MalformedRequestError` if the body ended before
+        the closing boundary.
+
+        """
+        if not self.complete:
+            raise MalformedRequestError(
+                'multipart body ended before its closing boundary')
+
+        self.form.mark_unmodified()
+        return self.form
+
+    # each state parses from ``pos`` of ``buffer``, returning the position
+    # to continue from, which is ``pos`` if more data is needed to get any
+    # further.
+
+    def parse_content(self, buffer, pos):
+        delimiter = self.delimiter
+        found = buffer.find(delimiter, pos)
+
+        if found == -1:
+            # keep what could be the start of the delimiter.
+            end = max(pos, len(buffer) - len(delimiter) + 1)
+            self.write_content(buffer, pos, end)
+            return end
+
+        self.write_content(buffer, pos, found)
+        self.state = self.parse_boundary
+        return found + len(delimiter)
+
+    def write_content(self, buffer, start, end):
+        if self.part is not None and end > start:
+            with memoryview(buffer) as view, view[start:end] as content:
+                self.part.write(content)
+
+    def parse_boundary(self, buffer, pos):
+        if len(buffer) - pos < 2:
+            return pos
+
+        if buffer.startswith(b'--', pos):
+            self.complete = True
+            return len(buffer)
+
+        end = buffer.find(b'\r\n', pos)
+        if end == -1:
+            self.check_size(buffer, pos)
+            return pos
+
+        # only whitespace may follow the boundary.
+        if buffer[pos:end].strip(b' \t'):
+            raise MalformedRequestError('Invalid multipart boundary line')
+
+        self.state = self.parse_headers
+        return end + 2
+
+    def parse_headers(self, buffer, pos):
+        if buffer.startswith(b'\r\n', pos):
+            end, lines = pos + 2, []
+        else:
+            end = buffer.find(b'\r\n\r\n', pos)
+            if end == -1:
+                self.check_size(buffer, pos)
+                return pos
+
+            try:
+                lines = buffer[pos:end].decode('utf8').split('\r\n')
+            except UnicodeDecodeError:
+                raise MalformedRequestError('Invalid multipart part headers')
+            end += 4
+
+        part = self.part = FormPart(self.parse_header_lines(lines),
+                                    max_memory=self.form.max_memory)
+        self.form.parts.append(part)
+        if self.on_part is not None:
+            self.on_part(part)
+
+        self.state = self.parse_content
+        return end
+
+    def parse_header_lines(self, lines):
+        from .models import HeadersDict
+
+        headers = HeadersDict()
+        for line in lines:
+            if line.startswith(('\t', ' ')) and headers:
+                headers.extend_last(line.lstrip())
+                continue
+
+            name, sep, value = line.partition(':')
+            if not sep:
+                raise MalformedRequestError(
+                    'Invalid multipart part header: %r' % line)
+            headers[name.rstrip()] = value.strip()
+
+        return headers
+
+    def check_size(self, buffer, pos):
+        if len(buffer) - pos > MAX_HEADER_SIZE:
+            raise MalformedRequestError('Multipart part headers too long')
+
+
+class URLEncodedParser(object):
+    """Incremental parser of ``application/x-www-form-urlencoded`` bodies.
+
+    Feed the body to `~icap.forms.URLEncodedParser.feed` in pieces of any
+    size, then call `~icap.forms.URLEncodedParser.close` for a dict of
+    names to lists of values, as returned by `urllib.parse.parse_qs`. Only
+    the last, possibly incomplete, field is kept between calls.
+
+    Names and values are decoded using ``encoding``, or if it's None, left
+    as bytes.
+
+    """
+    def __init__(self, encoding='utf-8'):
+        self.encoding = encoding
+        self.fields = {}
+        self.buffer = b''
+
+    def feed(self, data):
+        head, sep, self.buffer = (self.buffer + data).rpartition(b'&')
+        if sep:
+            self.parse(head)
+
+    def close(self):
+        self.parse(self.buffer)
+        self.buffer = b''
+        return self.fields
+
+    def parse(self, data):
+        if self.encoding is None:
+            pairs = parse_qsl(data)
+        else:
+            pairs = parse_qsl(data.decode(self.encoding),
+                              encoding=self.encoding)
+
+        fields = self.fields
+        for name, value in pairs:
+            fields.setdefault(name, []).append(value)
@@ -0,0 +1,155 @@
+"""
+Compact, sorted, on-disk lists of strings, for very large domain and URL lists.
+
+Indexes are built offline with `build_index`, or from the command line:
+
+    python -m icap.listindex --domains blocklist.idx domains.txt
+
+and read through a memory map by `ListIndex`, so opening one is near instant
+and the pages are shared between every process using the same file. See
+`~icap.criteria.DomainListCriteria` and `~icap.criteria.URLListCriteria`.
+
+The format is an 8 byte magic string, the number of entries as an unsigned
+64 bit little endian integer, an offset for each entry plus one for the end,
+in the same format and relative to the end of the offsets, and finally the
+UTF-8 entries themselves, sorted and without separators.
+
+"""
+
+import argparse
+import mmap
+import os
+import struct
+import sys
+
+__all__ = [
+    'ListIndex',
+    'build_index',
+]
+
+
+MAGIC = b'ICAPLST1'
+
+_header = struct.Struct('<8sQ')
+_offset = struct.Struct('<Q')
+_offsets = struct.Struct('<QQ')
+
+
+class ListIndex(object):
+    """A sorted list of strings in a file built by `build_index`, searched
+    with a binary search over a read-only memory map.
+
+    """
+    def __init__(self, path):
+        self.path = path
+
+        with open(path, 'rb') as f:
+            # empty files can't be mapped at all.
+            if os.fstat(f.fileno()).st_size < _header.size:
+                raise ValueError('%r is not a list index' % path)
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self.count = _header.unpack_from(self.map)
+        self.offsets = _header.size
+        self.data = self.offsets + (self.count + 1) * _offset.size
+
+        if magic != MAGIC or len(self.map) < self.data:
+            self.map.close()
+            raise ValueError('%r is not a list index' % path)
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        return self._entry(i).decode('utf8')
+
+    def _entry(self, i):
+        if not 0 <= i < self.count:
+            raise IndexError(i)
+
+        start, end = _offsets.unpack_from(self.map,
+                                          self.offsets + i * _offset.size)
+        return self.map[self.data + start:self.data + end]
+
+    def __contains__(self, value):
+        key = value.encode('utf8')
+        lo, hi = 0, self.count
+
+        # _entry inlined, this is the hot loop.
+        m, offsets, data = self.map, self.offsets, self.data
+        unpack_from = _offsets.unpack_from
+
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start, end = unpack_from(m, offsets + mid * _offset.size)
+            entry = m[data + start:data + end]
+            if entry < key:
+                lo = mid + 1
+            elif entry > key:
+                hi = mid
+            else:
+                return True
+
+        return False
+
+    def close(self):
+        self.map.close()
+
+
+def build_index(entries, path):
+    """Write the unique strings in ``entries`` to ``path`` as a list index,
+    returning the number written.
+
+    """
+    entries = sorted({e.encode('utf8') for e in entries})
+
+    with open(path, 'wb') as f:
+        f.write(_header.pack(MAGIC, len(entries)))
+
+        offset = 0
+        f.write(_offset.pack(offset))
+        for entry in entries:
+            offset += len(entry)
+            f.write(_offset.pack(offset))
+
+        for entry in entries:
+            f.write(entry)
+
+    return len(entries)
+
+
+def read_entries(files, normalize):
+    """Yield the normalized, non-empty and non-comment lines from ``files``."""
+    for f in files:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                yield normalize(line)
+
+
+def main(argv=None):
+    from .criteria import normalize_host
+
+    parser = argparse.ArgumentParser(
+        prog='python -m icap.listindex',
+        description='Build a list index for DomainListCriteria or '
+                    'URLListCriteria, from files with one entry per line.')
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('--domains', action='store_true',
+                       help='entries are domains, normalized like hosts')
+    group.add_argument('--urls', action='store_true',
+                       help='entries are URLs, stored as is')
+    parser.add_argument('output', help='path of the index to write')
+    parser.add_argument('inputs', nargs='*', type=argparse.FileType('r'),
+                        default=[sys.stdin],
+                        help='files to read entries from, defaults to stdin')
+    args = parser.parse_args(argv)
+
+    normalize = normalize_host if args.domains else str
+
+    count = build_index(read_entries(args.inputs, normalize), args.output)
+    print('wrote %d entries to %s' % (count, args.output))
+
+
+if __name__ == '__main__':
+    main()
@@ -4,19 +4,22 @@ comprising them.
 
 """
 
-from collections import namedtuple, OrderedDict
+import os
+
+from collections import namedtuple
+from collections.abc import MutableMapping
 from urllib.parse import urlencode, parse_qs, urlparse
 from http.cookies import SimpleCookie
 from datetime import datetime, timedelta
-from itertools import chain
 
-from werkzeug import cached_property, parse_options_header
+from werkzeug import parse_options_header
 
 from .errors import (
     icap_response_codes,
     http_response_codes)
 
-from .parsing import ICAPRequestParser
+from .forms import MultipartForm, MultipartParser, URLEncodedParser
+from .parsing import ICAPRequestParser, PendingBody
 
 
 class RequestLine(namedtuple('RequestLine', 'method uri version')):
@@ -53,6 +56,12 @@ class RequestLine(namedtuple('RequestLine', 'method uri version')):
         uri = uri._replace(query=urlencode(uri.query, doseq=True)).geturl()
         return ' '.join([method, uri, version]).encode('utf8')
 
+    def __getnewargs__(self):
+        # __new__ expects the unparsed uri, e.g. when unpickling.
+        method, uri, version = self
+        uri = uri._replace(query=urlencode(uri.query, doseq=True)).geturl()
+        return method, uri, version
+
     @property
     def query(self):
         """Proxy attribute for ``self.uri.query``.
@@ -104,13 +113,37 @@ class StatusLine(namedtuple('StatusLine', 'version code reason')):
         return ' '.join(map(str, self)).encode('utf8')
 
 
-class HeadersDict(OrderedDict):
+# status lines are immutable, so default ones are shared.
+_default_icap_status_line = StatusLine('ICAP/1.0', 200, 'OK')
+_default_http_status_line = StatusLine('HTTP/1.1', 200, 'OK')
+
+
+class HeadersDict(MutableMapping):
     """Multivalue, case-aware dictionary type used for headers of requests and
     responses.
 
+    Keys are compared case insensitively, iterate lowercased, in the order
+    they were first added, and map to the first value added for them. All
+    values are available from `~icap.models.HeadersDict.getlist`.
+
+    ``version`` is incremented on every modification, for cheaply detecting
+    changes.
+
+    Headers are stored as flat lists of names, in their original case, and
+    values, in the order they were added, with an index from each lowercased
+    name to the position of its first value. Copies share those lists until
+    either is modified.
+
     """
+    __slots__ = ('_names', '_values', '_index', '_shared', 'version')
+
     def __init__(self, items=()):
-        OrderedDict.__init__(self)
+        self._names = []
+        self._values = []
+        self._index = {}
+        self._shared = False
+        self.version = 0
+
         for key, value in items:
             self[key] = value
 
@@ -122,85 +155,200 @@ class HeadersDict(OrderedDict):
         """
         key = self._checktype(key)
         value = self._checktype(value)
-        lkey = key.lower()
 
-        if lkey not in self:
-            OrderedDict.__setitem__(self, lkey, [(key, value)])
-        else:
-            OrderedDict.__getitem__(self, lkey).append((key, value))
+        if self._shared:
+            self._unshare()
+
+        values = self._values
+        self._index.setdefault(key.lower(), len(values))
+        self._names.append(key)
+        values.append(value)
+        self.version += 1
 
     def _checktype(self, value):
-        if isinstance(value, bytes):
-            return value.decode('utf8')
-        elif isinstance(value, str):
+        if isinstance(value, str):
             return value
+        elif isinstance(value, bytes):
+            return value.decode('utf8')
         else:
             raise TypeError("Value must be of type 'str' or 'bytes', "
                             "received '%s'" % type(value))
 
+    def _unshare(self):
+        self._names = self._names[:]
+        self._values = self._values[:]
+        self._index = self._index.copy()
+        self._shared = False
+
+    def _remove(self, lkey, keep=None):
+        """Remove the values at ``lkey``, except the one at position
+        ``keep``.
+
+        """
+        names, values = self._names, self._values
+        positions = [i for i, name in enumerate(names)
+                     if i == keep or name.lower() != lkey]
+
+        self._names = [names[i] for i in positions]
+        self._values = [values[i] for i in positions]
+        self._index = index = {}
+        for i, name in enumerate(self._names):
+            index.setdefault(name.lower(), i)
+        self._shared = False
+
     def __delitem__(self, key):
-        OrderedDict.__delitem__(self, key.lower())
+        lkey = self._checktype(key).lower()
+        if lkey not in self._index:
+            raise KeyError(key)
+
+        self._remove(lkey)
+        self.version += 1
 
     def __getitem__(self, key):
         """Return the first value stored at ``key``."""
-        return OrderedDict.__getitem__(self,
-                                       self._checktype(key).lower())[0][1]
+        return self._values[self._index[self._checktype(key).lower()]]
 
     def __contains__(self, key):
         """Check if header ``key`` is present. Case insensitive."""
-        return OrderedDict.__contains__(self, self._checktype(key).lower())
+        return self._checktype(key).lower() in self._index
+
+    def __iter__(self):
+        return iter(self._index)
+
+    def __len__(self):
+        return len(self._index)
 
     def get(self, key, default=None):
         """Return the first value stored at ``key``. Return ``default`` if no
         value is present."""
-        try:
-            return self.__getitem__(key)
-        except KeyError:
+        i = self._index.get(self._checktype(key).lower())
+        if i is None:
             return default
+        return self._values[i]
 
     def getlist(self, key, default=list):
         """Return all values stored at ``key``."""
-        try:
-            return [v for k, v in OrderedDict.__getitem__(self, key.lower())]
-        except KeyError:
+        lkey = self._checktype(key).lower()
+        i = self._index.get(lkey)
+        if i is None:
             return default()
 
-    def pop(self, key, *args, **kwargs):
-        return OrderedDict.pop(self, key.lower(), *args, **kwargs)
+        # no key has more than one value.
+        if len(self._index) == len(self._values):
+            return [self._values[i]]
+
+        return [v for k, v in zip(self._names, self._values)
+                if k.lower() == lkey]
+
+    def pop(self, key, *args):
+        """Remove all values stored at ``key``, returning the first. Return
+        the default if given and no value is present, otherwise raise
+        KeyError.
+
+        """
+        lkey = self._checktype(key).lower()
+        i = self._index.get(lkey)
+        if i is None:
+            if args:
+                return args[0]
+            raise KeyError(key)
+
+        value = self._values[i]
+        self._remove(lkey)
+        self.version += 1
+        return value
 
     def replace(self, key, value):
         """Replace all values at `key` with `value`."""
+        key = self._checktype(key)
+        value = self._checktype(value)
         lkey = key.lower()
-        OrderedDict.__setitem__(self, lkey, [(key, value)])
 
-    def __eq__(self, other):
-        if list(self.keys()) != list(other.keys()):
-            return False
+        i = self._index.get(lkey)
+        if i is None:
+            self[key] = value
+            return
+
+        # values before the first one at ``key`` keep their positions.
+        if len(self._index) != len(self._values):
+            self._remove(lkey, keep=i)
+        elif self._shared:
+            self._unshare()
+
+        self._names[i] = key
+        self._values[i] = value
+        self.version += 1
+
+    def extend_last(self, value):
+        """Append ``value`` to the value of the header added last, for header
+        values continued over several lines.
+
+        """
+        value = self._checktype(value)
+
+        if self._shared:
+            self._unshare()
+
+        self._values[-1] += value
+        self.version += 1
+
+    def clear(self):
+        self._names, self._values, self._index = [], [], {}
+        self._shared = False
+        self.version += 1
+
+    def items_multi(self):
+        """Return a list of every header as a ``(key, value)`` tuple, with
+        keys in their original case, in order.
+
+        Values at the same key are grouped together, at the position the key
+        was first added.
+
+        """
+        names, values, index = self._names, self._values, self._index
+
+        if len(index) == len(values):
+            return list(zip(names, values))
 
-        for key in list(self.keys()):
-            value = OrderedDict.__getitem__(self, key)
-            ovalue = OrderedDict.__getitem__(other, key)
+        order = sorted(range(len(values)),
+                       key=lambda i: index[names[i].lower()])
+        return [(names[i], values[i]) for i in order]
 
-            if value != ovalue:
-                return False
+    def __eq__(self, other):
+        if not isinstance(other, HeadersDict):
+            return NotImplemented
+        return self.items_multi() == other.items_multi()
+
+    __hash__ = None
 
-        return True
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self.items_multi())
 
     def __bytes__(self):
         """Return a string of the headers, suitable for writing to a stream."""
-        if not self:
+        if not self._values:
             return b''
 
-        s = b'\r\n'.join(
-            ': '.join(v).encode('utf8') for k in self
-            for v in OrderedDict.__getitem__(self, k)
-        ) + b'\r\n'
-
-        return s
+        return ''.join(['%s: %s\r\n' % item
+                        for item in self.items_multi()]).encode('utf8')
 
     def copy(self):
-        return HeadersDict(chain([i[0] for i in
-                           OrderedDict.values(self)]))
+        """Return a copy of the headers, sharing storage with them until
+        either is modified.
+
+        """
+        copy = self.__class__.__new__(self.__class__)
+        copy._names = self._names
+        copy._values = self._values
+        copy._index = self._index
+        copy._shared = self._shared = True
+        copy.version = 0
+        return copy
+
+    def __reduce__(self):
+        # no __dict__ to restore, so ``version`` is restored as a slot.
+        return (self.__class__, (self.items_multi(),),
+                (None, {'version': self.version}))
 
 
 class ICAPMessage(object):
@@ -211,6 +359,13 @@ class ICAPMessage(object):
     `~icap.models.ICAPResponse` instead.
 
     """
+    __slots__ = ('headers', 'http')
+
+    # shortcuts for ``isinstance(self, ICAPRequest)`` and
+    # ``isinstance(self, ICAPResponse)``.
+    is_request = False
+    is_response = False
+
     def __init__(self, headers=None, http=None):
         """If ``headers`` is not given, default to an empty instance of
         `~icap.models.HeadersDict`.
@@ -224,25 +379,7 @@ class ICAPMessage(object):
         # really not comfortable with this default...
         self.http = http
 
-    @cached_property
-    def is_request(self):
-        """Return True if this object is a request.
-
-        This is just a shortcut for ``isinstance(self, ICAPRequest)``.
-
-        """
-        return isinstance(self, ICAPRequest)
-
-    @cached_property
-    def is_response(self):
-        """Return True if this object is a response.
-
-        This is just a shortcut for ``isinstance(self, ICAPResponse)``.
-
-        """
-        return isinstance(self, ICAPResponse)
-
-    @cached_property
+    @property
     def has_body(self):
         """Return True if this object has a payload."""
         if ((self.is_request and self.is_options and
@@ -252,7 +389,16 @@ class ICAPMessage(object):
 
 
 class ICAPRequest(ICAPMessage):
-    """Representation of an ICAP request."""
+    """Representation of an ICAP request.
+
+    ``is_reqmod``, ``is_respmod`` and ``is_options`` are True if the method of
+    the request line is REQMOD, RESPMOD or OPTIONS respectively.
+
+    """
+    __slots__ = ('_request_line', 'is_reqmod', 'is_respmod', 'is_options',
+                 'session', 'facts', '__weakref__')
+
+    is_request = True
 
     def __init__(self, request_line=None, *args, **kwargs):
         """If no ``request_line`` is given, a default of "UNKNOWN / ICAP/1.0"
@@ -265,6 +411,19 @@ class ICAPRequest(ICAPMessage):
         self.request_line = request_line or RequestLine("UNKNOWN", "/",
                                                         "ICAP/1.0")
 
+    @property
+    def request_line(self):
+        return self._request_line
+
+    @request_line.setter
+    def request_line(self, request_line):
+        self._request_line = request_line
+
+        method = request_line.method
+        self.is_reqmod = method == 'REQMOD'
+        self.is_respmod = method == 'RESPMOD'
+        self.is_options = method == 'OPTIONS'
+
     @classmethod
     def from_parser(cls, parser):
         """Return an instance of `~icap.models.ICAPRequest` from ``parser``.
@@ -288,32 +447,21 @@ class ICAPRequest(ICAPMessage):
                 self.http.request_headers = request.headers
         return self
 
-    @cached_property
+    @property
     def allow_204(self):
         """Return True of the client supports a 204 response code."""
         # FIXME: this should parse the list.
         return ('204' in self.headers.get('allow', '') or
                 'preview' in self.headers)
 
-    @cached_property
-    def is_reqmod(self):
-        """Return True if the current request is a REQMOD request."""
-        return self.request_line.method == 'REQMOD'
-
-    @cached_property
-    def is_respmod(self):
-        """Return True if the current request is a RESPMOD request."""
-        return self.request_line.method == 'RESPMOD'
-
-    @cached_property
-    def is_options(self):
-        """Return True if the current request is an OPTIONS request."""
-        return self.request_line.method == 'OPTIONS'
-
 
 class ICAPResponse(ICAPMessage):
     """Representation of an ICAP response."""
 
+    __slots__ = ('status_line', 'is_options')
+
+    is_response = True
+
     def __init__(self, status_line=None, *args, **kwargs):
         """If no ``status_line`` is given, a default of "ICAP/1.0 200 OK" will
         be used.
@@ -322,7 +470,7 @@ class ICAPResponse(ICAPMessage):
 
         """
         super().__init__(*args, **kwargs)
-        self.status_line = status_line or StatusLine('ICAP/1.0', 200, 'OK')
+        self.status_line = status_line or _default_icap_status_line
 
     def __bytes__(self):
         return b'\r\n'.join((
@@ -330,17 +478,90 @@ class ICAPResponse(ICAPMessage):
             bytes(self.headers)
         ))
 
+    # status lines are immutable, so they're shared between error responses.
+    _error_status_lines = {}
+
     @classmethod
     def from_error(cls, error):
         if isinstance(error, int):
             status_code = error
         else:
             status_code = error.status_code
-        message = icap_response_codes[status_code]
-        self = cls(StatusLine('ICAP/1.0', status_code, message))
+
+        try:
+            status_line = cls._error_status_lines[status_code]
+        except KeyError:
+            message = icap_response_codes[status_code]
+            status_line = StatusLine('ICAP/1.0', status_code, message)
+            cls._error_status_lines[status_code] = status_line
+
+        self = cls(status_line)
         return self
 
 
+class FileBody(object):
+    """A body sent from a file, rather than held in memory.
+
+    ``file`` is the path of the file, a file descriptor open for reading,
+    or a binary file object, and the body is ``length`` bytes of it from
+    ``offset``, by default the rest of the file.
+
+    Set one as the body of a `~icap.models.HTTPMessage` to send e.g. a large
+    static block page without reading it. The server sends it with
+    `asyncio.AbstractEventLoop.sendfile`, so where the platform supports it
+    the content never passes through Python. Using
+    `~icap.models.HTTPMessage.body_bytes` reads the whole file.
+
+    File descriptors are left open, and are read from their current
+    position when sending falls back to reading. File objects belong to
+    the body, which keeps them open until
+    `~icap.models.FileBody.close` is called once it's been sent.
+
+    """
+    def __init__(self, file, offset=0, length=None):
+        if length is None:
+            if hasattr(file, 'fileno'):
+                length = os.fstat(file.fileno()).st_size - offset
+            else:
+                length = os.stat(file).st_size - offset
+
+        self.file = file
+        self.offset = offset
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def __repr__(self):
+        return 'FileBody(%r, offset=%d, length=%d)' % (
+            self.file, self.offset, self.length)
+
+    def open(self):
+        """Return a binary file object of the file, at ``offset``."""
+        if isinstance(self.file, int):
+            f = os.fdopen(self.file, 'rb', closefd=False)
+        elif hasattr(self.file, 'fileno'):
+            f = os.fdopen(self.file.fileno(), 'rb', closefd=False)
+        else:
+            f = open(self.file, 'rb')
+
+        f.seek(self.offset)
+        return f
+
+    def read(self):
+        """Return the content of the body as bytes."""
+        with self.open() as f:
+            return f.read(self.length)
+
+    def close(self):
+        """Close ``file`` if it's a file object. Paths and file descriptors
+        are left alone.
+
+        """
+        if hasattr(self.file, 'fileno'):
+            self.file.close()
+
+
 class HTTPMessage(object):
     """Base HTTP class for generalising certain properties of both requests and
     responses.
@@ -349,6 +570,27 @@ class HTTPMessage(object):
     `~icap.models.HTTPResponse` instead.
 
     """
+    # ``_received`` is the `~icap.parsing.ReceivedBody` of parsed messages,
+    # which the body is taken from when it's first used, as long as _body is
+    # None, or a `~icap.parsing.PendingBody` until the body is set, see
+    # mark_body_pending. ``_file`` is the `~icap.models.FileBody` the body is
+    # sent from, if it was set to one.
+    #
+    # ``_cookies`` and ``_set_cookies`` are None until the cookie headers are
+    # parsed, and ``_cookies_output`` and ``_set_cookies_output`` are their
+    # output when they were, or None if they were set instead.
+    #
+    # ``_content_type`` is the headers and their version the parsed
+    # Content-Type was cached for, followed by it, and ``_text`` the body
+    # bytes and charset the decoded body was cached for, followed by it.
+    __slots__ = ('headers', '_cookies', '_set_cookies', '_cookies_output',
+                 '_set_cookies_output', '_body', '_received', '_file',
+                 '_original', '_content_type', '_text')
+
+    # shortcuts for ``isinstance(self, HTTPRequest)`` and
+    # ``isinstance(self, HTTPResponse)``.
+    is_request = False
+    is_response = False
 
     def __init__(self, headers=None, cookies=None, set_cookies=None, body=b''):
         """If ``headers`` is not given, default to an empty instance of
@@ -356,11 +598,81 @@ class HTTPMessage(object):
 
         ``body`` is an iterable of the payload of the HTTP message. It can be a
         stream, list of strings, a generator or a string.
+
+        If ``cookies`` or ``set_cookies`` aren't given, they're parsed from
+        the Cookie and Set-Cookie headers when first used.
         """
         self.headers = headers or HeadersDict()
-        self.body = body
-        self.cookies = cookies if cookies else SimpleCookie()
-        self.set_cookies = set_cookies if set_cookies else SimpleCookie()
+        self._received = self._file = self._original = None
+        self._content_type = self._text = None
+        if type(body) is bytes:
+            self._body = body
+        else:
+            self.body = body
+        self._cookies, self._set_cookies = cookies, set_cookies
+        self._cookies_output = self._set_cookies_output = None
+
+    @property
+    def cookies(self):
+        """The cookies of the Cookie header, as a `~http.cookies.SimpleCookie`.
+
+        The header is only parsed when this is first used, and only written
+        again from the cookies if they are changed.
+
+        """
+        cookies = self._cookies
+        if cookies is None:
+            cookies = SimpleCookie('; '.join(self.headers.getlist('Cookie')))
+            self._cookies = cookies
+            self._cookies_output = cookies.output()
+        return cookies
+
+    @cookies.setter
+    def cookies(self, cookies):
+        self._cookies, self._cookies_output = cookies, None
+
+    @property
+    def set_cookies(self):
+        """The cookies of the Set-Cookie headers, as a
+        `~http.cookies.SimpleCookie`.
+
+        The headers are only parsed when this is first used, and only written
+        again from the cookies if they are changed.
+
+        """
+        set_cookies = self._set_cookies
+        if set_cookies is None:
+            set_cookies = SimpleCookie()
+            for set_cookie in self.headers.getlist('Set-Cookie'):
+                name, value = list(SimpleCookie(set_cookie).items())[0]
+                set_cookies[name] = value
+            self._set_cookies = set_cookies
+            self._set_cookies_output = set_cookies.output()
+        return set_cookies
+
+    @set_cookies.setter
+    def set_cookies(self, set_cookies):
+        self._set_cookies, self._set_cookies_output = set_cookies, None
+
+    def cookies_changed(self):
+        """Return True if the Cookie header has to be written again from
+        `~icap.models.HTTPMessage.cookies`, as they were set or changed since
+        they were parsed.
+
+        """
+        cookies = self._cookies
+        return (cookies is not None and
+                cookies.output() != self._cookies_output)
+
+    def set_cookies_changed(self):
+        """Return True if the Set-Cookie headers have to be written again
+        from `~icap.models.HTTPMessage.set_cookies`, see
+        `~icap.models.HTTPMessage.cookies_changed`.
+
+        """
+        set_cookies = self._set_cookies
+        return (set_cookies is not None and
+                set_cookies.output() != self._set_cookies_output)
 
     def set_cookie(self, name, value, path=None, domain=None):
         self.set_cookies[name] = value
@@ -385,22 +697,86 @@ class HTTPMessage(object):
 
         If the Content-Type header is completely missing, 'text/plain;
         charset=us-ascii' is assumed, as per RFC1341.
+
+        The decoded body is cached until the body or the charset change.
         """
         body = self.body_bytes
-
-        # FIXME: caching this in some way would be useful... be it the decoded
-        # string or the charset.
         content_type, charset = self.content_type
 
-        if charset:
-            body = body.decode(charset)
+        if not charset:
+            return body
 
-        return body
+        cached = self._text
+        if cached is not None and cached[0] is body and cached[1] == charset:
+            return cached[2]
+
+        text = body.decode(charset)
+        self._text = (body, charset, text)
+        return text
 
     @property
     def body_bytes(self):
         """Returns the body of the message as plain bytes with no decoding."""
-        return self._body
+        body = self._body
+        if body is None:
+            if self._file is not None:
+                body = self._body = self._file.read()
+            else:
+                body = self._received.payload
+                # a pending body is only replaced by setting one.
+                if not self._received.pending:
+                    self._body = body
+        return body
+
+    @property
+    def body_file(self):
+        """The `~icap.models.FileBody` the body was set to, if any,
+        otherwise None.
+
+        """
+        return self._file
+
+    @property
+    def has_body(self):
+        """Return True if the message has a non-empty body."""
+        if self._file is not None:
+            return bool(self._file.length)
+        if self._body is None:
+            return True
+        return bool(self._body)
+
+    def received_chunks(self):
+        """Return the chunks the body was received in, as
+        `~icap.parsing.BodyPart` objects, if neither the body nor its
+        Content-Encoding have changed since, otherwise None.
+
+        The chunks hold memoryviews of the buffers they were received in, so
+        they can be written back out without being copied.
+
+        """
+        received = self._received
+        if received is None:
+            return None
+
+        if self._body is not None and self._body is not received.joined:
+            return None
+
+        if received.gzipped != ('gzip' in self.headers.get(
+                'Content-Encoding', '')):
+            return None
+
+        return received.chunks
+
+    def received_length(self):
+        """Return the length of the body as it will be serialized, if it's
+        written back out as it was received, otherwise None. See
+        `~icap.models.HTTPMessage.received_chunks`.
+
+        """
+        chunks = self.received_chunks()
+        if chunks is None:
+            return None
+        return sum(len(chunk.content) for chunk in chunks)
 
     @body.setter
     def body(self, value):
@@ -419,8 +795,17 @@ class HTTPMessage(object):
         you have control of (i.e. modifying the body in a handler), it is your
         responsibility to ensure you handle this situation properly by encoding
         the string before setting it.
+
+        If ``value`` is a `~icap.models.FileBody`, the body is sent from the
+        file, and only read if it's used.
         """
 
+        self._text = None
+
+        if isinstance(value, FileBody):
+            self._body, self._received, self._file = None, None, value
+            return
+
         if isinstance(value, str):
             content_type, charset = self.content_type
 
@@ -435,7 +820,9 @@ class HTTPMessage(object):
             raise TypeError('Could not figure out body encoding. Encode '
                             'payload appropriately.')
 
-        self._body = value
+        self._body, self._file = value, None
+        if self._received is not None and self._received.pending:
+            self._received = None
 
     def __bytes__(self):
         if self.is_request:
@@ -443,46 +830,48 @@ class HTTPMessage(object):
         else:
             field = self.status_line
 
-        headers = self.headers.copy()
+        headers = self.headers
         # If the cookies collection was modified, we want the Cookie header to
         # reflect those changes. Reconstitute the header from the collection.
-        value = '; '.join([m.output().partition(': ')[2]
-                           for m in self.cookies.values()])
-        # It's possible there are no cookies, in which case we don't want to
-        # add the header.
-        if value:
-            headers['Cookie'] = value
+        if self.cookies_changed():
+            headers = headers.copy()
+            value = '; '.join([m.OutputString()
+                               for m in self._cookies.values()])
+            # It's possible there are no cookies, in which case we don't want
+            # the header.
+            if value:
+                headers.replace('Cookie', value)
+            else:
+                headers.pop('Cookie', None)
         # Ask the browser to save new cookies (or maybe delete some cookies).
-        for morsel in self.set_cookies.values():
-            name, _, value = str(morsel).partition(': ')
-            headers[name] = value
+        if self.set_cookies_changed():
+            if headers is self.headers:
+                headers = headers.copy()
+            headers.pop('Set-Cookie', None)
+            for morsel in self._set_cookies.values():
+                headers['Set-Cookie'] = morsel.OutputString()
 
         return b'\r\n'.join([bytes(field), bytes(headers)])
 
-    @cached_property
-    def is_request(self):
-        """Return True if this object is a request.
-
-        This is just a shortcut for ``isinstance(self, HTTPRequest)``.
-
-        """
-        return isinstance(self, HTTPRequest)
-
-    @cached_property
-    def is_response(self):
-        """Return True if this object is a response.
-
-        This is just a shortcut for ``isinstance(self, HTTPResponse)``.
+    @property
+    def content_type(self):
+        """The content type and charset of the Content-Type header, or ''
+        if it has no charset.
 
+        The header is only parsed again once the headers change.
         """
-        return isinstance(self, HTTPResponse)
+        headers = self.headers
+        cached = self._content_type
+        if (cached is not None and cached[0] is headers and
+                cached[1] == headers.version):
+            return cached[2]
 
-    @property
-    def content_type(self):
         content_type, options = parse_options_header(
-            self.headers.get('content-type', 'text/plain; charset=us-ascii'))
+            headers.get('content-type', 'text/plain; charset=us-ascii'))
         charset = options.get('charset', '')
-        return content_type, charset
+        result = (content_type, charset)
+        self._content_type = (headers, headers.version, result)
+        return result
 
     def pre_serialization(self):
         """Method called prior to serialisation. Useful for writing any
@@ -491,11 +880,74 @@ class HTTPMessage(object):
         """
         pass
 
+    def mark_body_pending(self):
+        """Record that the body hasn't been received yet, e.g. while it's
+        relayed (see `~icap.asyncio.BodyRelay`), and mark the message as
+        unmodified.
+
+        The body reads as empty until it's set, but setting it, even to
+        b'', counts as a modification and stops it being written back out
+        as it's received.
+
+        """
+        gzipped = 'gzip' in self.headers.get('Content-Encoding', '')
+        self._body, self._file = None, None
+        self._received = PendingBody(gzipped)
+        self._text = None
+        self.mark_unmodified()
+
+    def mark_unmodified(self):
+        """Record the current state of the message as its original state, for
+        `~icap.models.HTTPMessage.modified`.
+
+        Called on messages created by the parsers.
+
+        """
+        self._original = self._modification_state()
+
+    @property
+    def modified(self):
+        """Return True if the headers, body, cookies, request line or status
+        line have changed since `~icap.models.HTTPMessage.mark_unmodified`
+        was called.
+
+        Messages that were never marked as unmodified, e.g. those constructed
+        by handlers, are always considered modified.
+
+        """
+        original = self._original
+        if original is None:
+            return True
+
+        state = self._modification_state()
+        return state[0] is not original[0] or state[1:] != original[1:]
+
+    def _modification_state(self):
+        if self.is_request:
+            field = bytes(self.request_line)
+        else:
+            field = self.status_line
+
+        # bytes comparison is by identity first, so unchanged bodies are
+        # cheap to compare, and replacing one with an equal value isn't a
+        # modification. Bodies that were never used compare as the
+        # ReceivedBody they would be taken from.
+        body = self._file
+        if body is None:
+            body = self._body
+        if body is None:
+            body = self._received
+
+        return (self.headers, self.headers.version, field, body,
+                self.cookies_changed(), self.set_cookies_changed())
+
 
 class HTTPRequest(HTTPMessage):
     """Representation of a HTTP request."""
 
-    parsed_post_data = False
+    __slots__ = ('request_line', 'parsed_post_data', '_post')
+
+    is_request = True
 
     def __init__(self, request_line=None, *args, **kwargs):
         """If no ``request_line`` is given, a default of "GET / HTTP/1.1" will
@@ -505,6 +957,7 @@ class HTTPRequest(HTTPMessage):
 
         """
         self.request_line = request_line or RequestLine('GET', '/', 'HTTP/1.1')
+        self.parsed_post_data = False
         super().__init__(*args, **kwargs)
 
     @classmethod
@@ -516,8 +969,10 @@ class HTTPRequest(HTTPMessage):
         """
         assert not isinstance(parser, ICAPRequestParser)
         assert parser.is_request
-        f = cls(parser.sline, parser.headers, parser.cookies,
-                parser.set_cookies, parser.payload)
+        f = cls(parser.sline, parser.headers)
+        if parser.received is not None:
+            f._body, f._received = None, parser.received
+        f.mark_unmodified()
 
         return f
 
@@ -525,28 +980,76 @@ class HTTPRequest(HTTPMessage):
         """Prior to serialization, write POST data back to bytes if they've
         been parsed out.
 
+        Multipart forms are only written back if they were modified.
         """
         if not self.parsed_post_data:
             return
 
+        if isinstance(self.post, MultipartForm):
+            if self.post.modified:
+                self.body = self.post.body()
+                self.post.mark_unmodified()
+            return
+
         content_type, charset = self.content_type
         s = urlencode(self.post, doseq=True, encoding=charset or 'utf-8')
-        self._body = s.encode(charset or 'utf-8')
+        # through the setter, so a file body set earlier is dropped.
+        self.body = s.encode(charset or 'utf-8')
 
-    @cached_property
+    def _modification_state(self):
+        # parsed POST data is only written back to the body when serializing.
+        self.pre_serialization()
+        return super()._modification_state()
+
+    @property
     def post(self):
-        content_type, charset = self.content_type
+        """The form data in the body, parsed the first time this is used.
+
+        For ``application/x-www-form-urlencoded`` bodies, it's a dict of
+        names to lists of values, as returned by `urllib.parse.parse_qs`.
+        For ``multipart/form-data`` bodies, it's a
+        `~icap.forms.MultipartForm`. Otherwise it's None.
+
+        The body is parsed incrementally from the chunks it was received in,
+        see `~icap.forms`. Changes to the form data are written back to the
+        body by `~icap.models.HTTPRequest.pre_serialization`.
+        """
+        try:
+            return self._post
+        except AttributeError:
+            pass
+
+        content_type, options = parse_options_header(
+            self.headers.get('content-type', ''))
 
         if content_type == 'application/x-www-form-urlencoded':
-            self.parsed_post_data = True
-            return parse_qs(self.body, encoding=charset or 'utf-8')
+            parser = URLEncodedParser(options.get('charset') or None)
+        elif content_type == 'multipart/form-data' and \
+                options.get('boundary'):
+            parser = MultipartParser(options['boundary'])
         else:
+            self._post = None
             return None
 
+        chunks = self.received_chunks()
+        if chunks is None or self._received.gzipped:
+            parser.feed(self.body_bytes)
+        else:
+            for chunk in chunks:
+                parser.feed(chunk.content)
+
+        self.parsed_post_data = True
+        post = self._post = parser.close()
+        return post
+
 
 class HTTPResponse(HTTPMessage):
     """Representation of a HTTP response."""
 
+    __slots__ = ('status_line', '_request_line', '_request_headers')
+
+    is_response = True
+
     def __init__(self, status_line=None, *args, **kwargs):
         """Initialise a new `HTTPResponse` instance.
 
@@ -557,13 +1060,43 @@ class HTTPResponse(HTTPMessage):
 
         """
         super().__init__(*args, **kwargs)
-        self.status_line = status_line or StatusLine('HTTP/1.1', 200, 'OK')
+        self.status_line = status_line or _default_http_status_line
+
+    # if a RESPMOD comes in such that the request headers are available,
+    # these will be replaced with those. Otherwise defaults are created when
+    # first used, to protect against AttributeErrors.
+
+    @property
+    def request_line(self):
+        """The request line of the request this is the response to, or a
+        default of "GET / HTTP/1.1".
+
+        """
+        try:
+            return self._request_line
+        except AttributeError:
+            self._request_line = RequestLine('GET', '/', 'HTTP/1.1')
+            return self._request_line
 
-        # if a RESPMOD comes in such that the request headers are available,
-        # these will be replaced with those. These are merely provided as
-        # defaults to protect against AttributeErrors.
-        self.request_line = RequestLine('GET', '/', 'HTTP/1.1')
-        self.request_headers = HeadersDict()
+    @request_line.setter
+    def request_line(self, request_line):
+        self._request_line = request_line
+
+    @property
+    def request_headers(self):
+        """The headers of the request this is the response to, or an empty
+        `~icap.models.HeadersDict`.
+
+        """
+        try:
+            return self._request_headers
+        except AttributeError:
+            self._request_headers = HeadersDict()
+            return self._request_headers
+
+    @request_headers.setter
+    def request_headers(self, request_headers):
+        self._request_headers = request_headers
 
     @classmethod
     def from_parser(cls, parser):
@@ -574,5 +1107,9 @@ class HTTPResponse(HTTPMessage):
         """
         assert not isinstance(parser, ICAPRequestParser)
         assert parser.is_response
-        return cls(parser.sline, parser.headers, parser.cookies,
-                   parser.set_cookies, parser.payload)
+        f = cls(parser.sline, parser.headers)
+        if parser.received is not None:
+            f._body, f._received = None, parser.received
+        f.mark_unmodified()
+
+        return f
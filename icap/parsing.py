@@ -1,8 +1,7 @@
 import gzip
 
 from collections import namedtuple
-from io import BytesIO, SEEK_END
-from http.cookies import SimpleCookie
+from io import BytesIO
 
 from werkzeug import cached_property
 
@@ -15,6 +14,8 @@ __all__ = [
     'ChunkedMessageParser',
     'ICAPRequestParser',
     'HTTPMessageParser',
+    'ReceivedBody',
+    'PendingBody',
 ]
 
 
@@ -39,7 +40,6 @@ class ChunkedMessageParser(object):
         self.sline = None
         self.headers = HeadersDict()
         self.state = ParseState.empty
-        self.body = BytesIO()
         self.chunks = []
 
     def started(self, set=False):
@@ -66,7 +66,7 @@ class ChunkedMessageParser(object):
         return self.state == ParseState.body_complete
 
     def feed_line(self, line):
-        if isinstance(line, bytes):
+        if isinstance(line, (bytes, bytearray)):
             line = line.decode('utf8')
 
         # FIXME: non-crlf-endings
@@ -81,15 +81,19 @@ class ChunkedMessageParser(object):
         return True
 
     def feed_body(self, data):
-        self.body.write(data)
-        self.body.seek(0)
+        """Parse as much of the body as possible from ``data``, any
+        bytes-like object.
+
+        Parts of the body are kept as memoryviews of ``data`` where possible,
+        rather than copies, so it must not be modified afterwards.
+
+        """
+        view = memoryview(data)
         try:
             while not self.complete():
-                self.attempt_body_parse()
+                view = self.attempt_body_parse(view)
         except ChunkParsingError:
             pass
-        finally:
-            self.body.seek(0, SEEK_END)
 
     @classmethod
     def from_bytes(cls, bytes):
@@ -101,18 +105,20 @@ class ChunkedMessageParser(object):
             if not self.feed_line(line):
                 raise MalformedRequestError('Line not valid: %r' % line)
 
-        while True:
-            s = stream.read()
-            if s:
-                self.feed_body(s)
-            else:
-                self.complete(True)
-                break
+        body = memoryview(bytes)[stream.tell():]
+        if body:
+            self.feed_body(body)
+        self.complete(True)
 
         assert self.complete()
         return self
 
-    def attempt_body_parse(self):
+    def attempt_body_parse(self, view):
+        """Parse the next part of the body from the memoryview ``view``,
+        returning the rest of it. Raises ChunkParsingError if more data is
+        needed.
+
+        """
         raise NotImplementedError()
 
     def handle_status_line(self, sline):
@@ -130,16 +136,9 @@ class ChunkedMessageParser(object):
 
         # multiline headers
         if header.startswith(('\t', ' ')):
-            k = list(self.headers.keys())[-1]
-            from collections import OrderedDict
-            raw_v = OrderedDict.__getitem__(self.headers, k)
-            k, v = raw_v[-1]
-
             # section 4.2 says that we MAY reduce whitespace down to a single
             # character, so let's do it.
-            v = ''.join((v, header.lstrip()))
-
-            raw_v[-1] = k, v
+            self.headers.extend_last(header.lstrip())
         else:
             k, v = header.split(':', 1)
             k = k.rstrip()
@@ -172,19 +171,41 @@ class ICAPRequestParser(ChunkedMessageParser):
         self.request_parser = HTTPMessageParser()
         self.response_parser = HTTPMessageParser()
 
-    def attempt_body_parse(self):
-        name, size = self.encapsulated_parts[0]
-        data = self.body.read(size)
+        # encapsulated headers received so far
+        self.http_headers = b''
 
-        if size > 0 and len(data) != size:
-            raise ChunkParsingError
+    def http_headers_complete(self):
+        """Return True once the encapsulated HTTP headers have been parsed,
+        whether or not any of the body has been received yet.
 
-        if size == -1 and not data:
-            raise ChunkParsingError
+        """
+        return self.headers_complete() and not any(
+            name.endswith('-hdr') for name, size in self.encapsulated_parts)
 
-        if size == 0:
-            assert name == 'null-body'
-            assert not data
+    def discard_body(self):
+        """Stop keeping the encapsulated body. It is still parsed, so the end
+        of the request can be found, but the chunks are thrown away.
+
+        """
+        for parser in (self.request_parser, self.response_parser):
+            parser.discard = True
+            parser.chunks = []
+
+    def relay_body(self, callback):
+        """Pass the content of each chunk of the encapsulated body to
+        ``callback`` as soon as it's parsed, instead of keeping it. Chunks
+        that were already parsed are passed straight away.
+
+        """
+        for parser in (self.request_parser, self.response_parser):
+            for chunk in parser.chunks:
+                callback(chunk.content)
+            parser.discard = True
+            parser.chunks = []
+            parser.on_chunk = callback
+
+    def attempt_body_parse(self, view):
+        name, size = self.encapsulated_parts[0]
 
         if name in ('req-hdr', 'req-body'):
             parser = self.request_parser
@@ -192,16 +213,27 @@ class ICAPRequestParser(ChunkedMessageParser):
             parser = self.response_parser
 
         if name in ('req-hdr', 'res-hdr'):
+            missing = size - len(self.http_headers)
+            self.http_headers += bytes(view[:missing])
+            view = view[missing:]
+
+            if len(self.http_headers) != size:
+                raise ChunkParsingError
+
             self.encapsulated_parts.pop(0)
-            buffer = BytesIO(data)
-            for line in buffer:
+            for line in BytesIO(self.http_headers):
                 parser.feed_line(line)
+            self.http_headers = b''
             assert parser.headers_complete()
         elif name in ('req-body', 'res-body'):
-            self.body.seek(0)
-            self.body.truncate()
+            if not view:
+                raise ChunkParsingError
+
             assert parser.headers_complete()
-            parser.feed_body(data)
+            # the body runs to the end of the request, so the HTTP parser
+            # takes all of the data.
+            parser.feed_body(view)
+            view = view[len(view):]
 
             if parser.complete():
                 self.encapsulated_parts.pop(0)
@@ -217,7 +249,7 @@ class ICAPRequestParser(ChunkedMessageParser):
             self.request_parser.complete(True)
             self.response_parser.complete(True)
 
-        self.body = BytesIO(self.body.read())
+        return view
 
     def complete(self, set=False):
         if set:
@@ -270,78 +302,173 @@ class ICAPRequestParser(ChunkedMessageParser):
         return self.sline.method == 'OPTIONS'
 
 
+class ReceivedBody(object):
+    """The chunks a body was received in, joined and decoded the first time
+    the payload is needed.
+
+    Until then, the body can be written back out as it was received,
+    without being copied (see `~icap.models.HTTPMessage.received_chunks`).
+    Compares equal to bytes equal to the payload.
+
+    """
+    pending = False
+
+    def __init__(self, chunks, gzipped=False):
+        self.chunks = chunks
+        self.gzipped = gzipped
+        self.joined = None
+
+    @property
+    def payload(self):
+        payload = self.joined
+        if payload is None:
+            payload = b''.join(chunk.content for chunk in self.chunks)
+            if self.gzipped:
+                # FIXME: this should be done in a thread
+                payload = gzip.decompress(payload)
+            self.joined = payload
+        return payload
+
+    def __eq__(self, other):
+        if isinstance(other, ReceivedBody):
+            return self is other
+        return self.payload == other
+
+    __hash__ = object.__hash__
+
+    def __reduce__(self):
+        # the chunks are views of receive buffers, which can't be pickled.
+        raw = b''.join(chunk.content for chunk in self.chunks)
+        return (self.__class__, ([BodyPart(raw, b'')], self.gzipped))
+
+
+class PendingBody(ReceivedBody):
+    """Placeholder for a body that hasn't been received yet, e.g. while
+    it's relayed.
+
+    Its payload is empty, but it only compares equal to itself, so setting
+    the body of a message, even to b'', counts as modifying it.
+
+    """
+    pending = True
+
+    def __init__(self, gzipped=False):
+        super().__init__([], gzipped)
+        self.joined = b''
+
+    def __eq__(self, other):
+        return self is other
+
+    __hash__ = object.__hash__
+
+    def __reduce__(self):
+        return (self.__class__, (self.gzipped,))
+
+
 class HTTPMessageParser(ChunkedMessageParser):
-    payload = b''
+    received = None
+    discard = False
+    on_chunk = None
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.cookies = SimpleCookie()
-        self.set_cookies = SimpleCookie()
 
-    def attempt_body_parse(self):
-        while True:
-            chunk = self.attempt_parse_chunk()
-            if chunk is None:
-                assert self.complete()
-                break
-            self.chunks.append(chunk)
+        # state of the chunk being parsed, see attempt_body_parse.
+        self.line = b''
+        self.remaining = 0
+        self.pieces = []
+        self.chunk_header = b''
+        self.last_chunk = False
+
+    @property
+    def payload(self):
+        """The body of the message, once it's complete."""
+        if self.received is None:
+            return b''
+        return self.received.payload
+
+    def attempt_body_parse(self, view):
+        if not view:
+            raise ChunkParsingError
 
-    @cached_property
-    def is_gzipped(self):
-        return 'gzip' in self.headers.get('Content-Encoding', '')
+        if self.remaining:
+            piece = view[:self.remaining]
+            self.pieces.append(piece)
+            self.remaining -= len(piece)
+            return view[len(piece):]
 
-    def on_headers_complete(self):
-        super().on_headers_complete()
-        # Parse cookies if any.
-        self.cookies = SimpleCookie(self.headers.pop('Cookie', ''))
-        for set_cookie in self.headers.getlist('Set-Cookie'):
-            name, value = list(SimpleCookie(set_cookie).items())[0]
-            self.set_cookies[name] = value
+        line, view = self.read_line(view)
 
-    def on_complete(self):
-        payload = b''.join(b.content for b in self.chunks)
-        if self.is_gzipped:
-            # FIXME: this should be done in a thread
-            payload = gzip.decompress(payload)
-        self.payload = payload
+        # FIXME: non-crlf-endings
+        if self.pieces:
+            # the end of the chunk's data
+            if line != b'\r\n':
+                raise ChunkParsingError
 
-    def attempt_parse_chunk(self):
-        line = self.body.readline()
+            pieces, self.pieces = self.pieces, []
 
-        # FIXME: non-crlf-endings
-        if not line.endswith(b'\r\n'):
-            raise ChunkParsingError
-        else:
-            try:
-                size, header = line.split(b';', 1)
-            except ValueError:
-                size = line
-                header = b''
+            # chunks are only copied if they were split between reads.
+            if len(pieces) == 1:
+                content = pieces[0]
+            else:
+                content = b''.join(pieces)
 
+            self.chunk_parsed(BodyPart(content, self.chunk_header))
+        elif self.last_chunk:
+            # end of stream, make sure we have trailing newline
+            if line != b'\r\n':
+                raise ChunkParsingError
+
+            self.complete(True)
+        else:
+            size, _, header = line.partition(b';')
             size = int(size, 16)
+
             if size:
-                # FIXME: non-crlf-endings
-                data = self.body.read(size+2)  # +2 for CRLF
+                self.remaining = size
+                self.chunk_header = header.strip()
+            else:
+                self.last_chunk = True
 
-                if len(data) != size+2:
-                    raise ChunkParsingError
+        return view
 
-                # reset the stream so we don't create the same chunk over and
-                # over
-                self.body = BytesIO(self.body.read())
+    def read_line(self, view):
+        """Return the next CRLF terminated line from ``view`` and the rest of
+        ``view``. Raises ChunkParsingError if the line isn't complete, keeping
+        what there is of it.
 
-                # FIXME: non-crlf-endings
-                chunk = BodyPart(data[:-2], header.strip())
-                return chunk
-            else:
-                # end of stream, make sure we have trailing newline
-                s = self.body.readline()
+        """
+        # lines in the body are short, so only the start of view is copied
+        # to search it.
+        window = 64
+        while True:
+            line = self.line + bytes(view[:window])
+            end = line.find(b'\r\n')
 
-                # FIXME: non-crlf-endings
-                if s != b'\r\n':
-                    raise ChunkParsingError
+            if end != -1:
+                used = end + 2 - len(self.line)
+                self.line = b''
+                return line[:end + 2], view[used:]
+
+            if window >= len(view):
+                self.line = line
+                raise ChunkParsingError
 
-                self.complete(True)
+            window *= 4
+
+    def chunk_parsed(self, chunk):
+        if self.on_chunk is not None:
+            self.on_chunk(chunk.content)
+        if not self.discard:
+            self.chunks.append(chunk)
+
+    @cached_property
+    def is_gzipped(self):
+        return 'gzip' in self.headers.get('Content-Encoding', '')
+
+    def on_complete(self):
+        if self.chunks and self.received is None:
+            self.received = ReceivedBody(self.chunks, self.is_gzipped)
 
     @classmethod
     def from_bytes(cls, bytes):
@@ -5,14 +5,17 @@ These are all to be considered private. You should not need to use them
 directly except for special circumstances.
 """
 
+import asyncio
 import gzip
 import logging
 import re
+import time
 
 from collections import OrderedDict
 
 from werkzeug import http_date, cached_property
 
+from .errors import icap_response_codes
 from .utils import dump_encapsulated_field
 
 
@@ -73,12 +76,25 @@ class Serializer(object):
     This class should never be used directly. It is for internal usage only.
 
     """
-    def __init__(self, response, is_tag, is_options=False):
+    def __init__(self, response, is_tag, is_options=False, relay=False,
+                 sendfile=False):
+        """If ``relay`` is True, the body of the encapsulated message is
+        written separately, with `write_chunk` and `write_last_chunk`, and
+        only the headers are serialized.
+
+        If ``sendfile`` is True, the content of a `~icap.models.FileBody`
+        is left out when serializing, and kept as ``file`` to be sent by
+        `~icap.serialization.Serializer.send_file`.
+
+        """
         from .models import ICAPResponse
         assert isinstance(response, ICAPResponse)
         self.response = response
         self.is_tag = is_tag
         self.is_options = is_options
+        self.relay = relay
+        self.sendfile = sendfile
+        self.file = None
 
     def serialize_to_stream(self, stream):
         """Serialize the ICAP response and contained HTTP message to
@@ -93,7 +109,7 @@ class Serializer(object):
             stream.write(bytes(self.response))
             stream.write(b'\r\n')
             http = self.response.http
-            if http and http.body_bytes:
+            if http and http.has_body:
                 log.warning("opt-body is not supported")
             return
 
@@ -103,29 +119,87 @@ class Serializer(object):
         stream.write(b'\r\n')
         stream.write(http_preamble)
 
-        self.write_body(stream)
+        if not self.relay:
+            self.write_body(stream)
 
     @cached_property
     def is_gzipped(self):
         return 'gzip' in self.response.http.headers.get('Content-Encoding', '')
 
     def write_body(self, stream):
-        """Write out each chunk to the given stream."""
-        self.response.http.pre_serialization()
+        """Write out each chunk to the given stream.
+
+        Bodies that are unchanged since they were received are written back
+        in the chunks they were received in, without being joined, encoded
+        or copied. Bodies sent from a file are written as a single chunk,
+        read in blocks, or only framed if the serializer is for ``sendfile``.
+
+        """
+        http = self.response.http
+        http.pre_serialization()
+
+        chunks = http.received_chunks()
+        if chunks is not None:
+            for chunk in chunks:
+                write_chunk(stream, chunk.content)
+            write_last_chunk(stream)
+            return
+
+        body = http.body_file
+        if body is not None and not self.is_gzipped:
+            if not body.length:
+                return
 
-        if not self.response.http.body_bytes:
+            stream.write(b'%x\r\n' % body.length)
+            if self.sendfile:
+                self.file = body
+                return
+
+            with body.open() as f:
+                write_file(stream, f, body.length)
+            stream.write(b'\r\n')
+            write_last_chunk(stream)
+            return
+
+        if not http.body_bytes:
             return
 
-        body = self.response.http.body_bytes
+        body = http.body_bytes
         if self.is_gzipped:
             # FIXME: this should be done in a thread
             body = gzip.compress(body)
 
-        size = len(body)
-        header = ('%x' % size).encode('utf8')
-        stream.write(header+b'\r\n')
-        stream.write(body+b'\r\n')
-        stream.write(b'0\r\n\r\n')
+        write_chunk(stream, body)
+        write_last_chunk(stream)
+
+    async def send_file(self, transport):
+        """Send the content of ``file`` to ``transport`` with
+        `asyncio.AbstractEventLoop.sendfile`, and end the body.
+
+        Transports that don't support sendfile at all have the file written
+        to them in blocks instead.
+
+        """
+        body = self.file
+        loop = asyncio.get_event_loop()
+
+        with body.open() as f:
+            if transport.is_closing():
+                return
+
+            try:
+                sent = await loop.sendfile(transport, f, body.offset,
+                                           body.length)
+            except RuntimeError:
+                if transport.is_closing():
+                    raise
+                sent = write_file(transport, f, body.length)
+
+        if sent != body.length:
+            raise EOFError('%r ended after %d bytes' % (body, sent))
+
+        transport.write(b'\r\n')
+        write_last_chunk(transport)
 
     def set_encapsulated_header(self):
         """Serialize the http message preamble, set the encapsulated header,
@@ -146,7 +220,7 @@ class Serializer(object):
                 encapsulated = OrderedDict([('res-hdr', 0)])
                 body_key = 'res-body'
 
-            if not http or not http.body_bytes:
+            if not self.relay and (not http or not http.has_body):
                 body_key = 'null-body'
 
             encapsulated[body_key] = len(http_preamble)
@@ -162,8 +236,140 @@ class Serializer(object):
         Currently these set ISTag and Date headers.
 
         """
-        self.response.headers['Date'] = http_date()
+        self.response.headers['Date'] = date_cache.get()
         self.response.headers['ISTag'] = self.is_tag
 
         # TODO: remove all hop-by-hop headers
         # TODO: ensure required authorization headers are preserved
+
+
+def write_chunk(stream, data):
+    """Write ``data`` to ``stream`` as a single chunk."""
+    stream.write(b'%x\r\n' % len(data))
+    stream.write(data)
+    stream.write(b'\r\n')
+
+
+def write_last_chunk(stream):
+    """Write the chunk ending a chunked body to ``stream``."""
+    stream.write(b'0\r\n\r\n')
+
+
+def write_file(stream, f, count, block_size=65536):
+    """Write ``count`` bytes from the file object ``f`` to ``stream``, in
+    blocks of at most ``block_size`` bytes, returning the number written.
+
+    Raises EOFError if the file ends first.
+
+    """
+    written = 0
+    while written < count:
+        data = f.read(min(block_size, count - written))
+        if not data:
+            raise EOFError('%r ended after %d bytes' % (f, written))
+        stream.write(data)
+        written += len(data)
+    return written
+
+
+class DateCache(object):
+    """The value of the Date header, formatted at most once a second.
+
+    While running, the server refreshes it from a timer on the event loop
+    (see `start`), so getting the value is only an attribute lookup. Without
+    a timer, the value is refreshed when it is read in a new second.
+
+    """
+    def __init__(self):
+        self.value = None
+        self.value_bytes = None
+        self.expires = 0
+        self.handle = None
+
+    def get(self):
+        """Return the current Date header value."""
+        if self.handle is None and time.time() >= self.expires:
+            self.refresh()
+        return self.value
+
+    def get_bytes(self):
+        """Return the current Date header value, encoded as ASCII."""
+        if self.handle is None and time.time() >= self.expires:
+            self.refresh()
+        return self.value_bytes
+
+    def refresh(self):
+        now = time.time()
+        self.expires = int(now) + 1
+        self.value = http_date(now)
+        self.value_bytes = self.value.encode('ascii')
+
+    def start(self, loop):
+        """Refresh the value at the start of every second on ``loop``."""
+        self.stop()
+        self._tick(loop)
+
+    def stop(self):
+        """Stop refreshing from the event loop timer, if it was started."""
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+
+    def _tick(self, loop):
+        self.refresh()
+        self.handle = loop.call_later(self.expires - time.time(),
+                                      self._tick, loop)
+
+
+date_cache = DateCache()
+
+
+class ResponseTemplate(object):
+    """An ICAP response without an encapsulated message, serialized ahead of
+    time.
+
+    Only the Date and ISTag headers, which differ between responses, are
+    written when rendering it.
+
+    This class should never be used directly. It is for internal usage only.
+
+    """
+    def __init__(self, response, is_options=False):
+        s = Serializer(response, '', is_options=is_options)
+        remove_invalid_headers(response.headers, is_options=is_options)
+        http_preamble = s.set_encapsulated_header()
+        assert not http_preamble, 'responses with bodies cannot be templated'
+
+        response.headers.pop('Date', None)
+        response.headers.pop('ISTag', None)
+        self.prefix = bytes(response)
+
+    def render(self, is_tag, headers=b''):
+        """Return the serialized response for the quoted ISTag ``is_tag``.
+
+        ``headers`` are any extra, already serialized, headers to include.
+
+        """
+        return b''.join([
+            self.prefix,
+            b'Date: ', date_cache.get_bytes(),
+            b'\r\nISTag: ', is_tag.encode('utf8'),
+            b'\r\n', headers,
+            b'\r\n',
+        ])
+
+
+def prerender_errors():
+    """Return a dict of `ResponseTemplate` objects for every ICAP status
+    code, keyed by code, used for error responses.
+
+    200 is excluded, as those responses always encapsulate a message.
+
+    """
+    from .models import ICAPResponse
+
+    return {code: ResponseTemplate(ICAPResponse.from_error(code))
+            for code in icap_response_codes if code != 200}
+
+
+error_templates = prerender_errors()
@@ -6,10 +6,15 @@ import logging
 import signal
 import uuid
 
-from .criteria import sort_handlers
+from inspect import isawaitable
+
+from .criteria import _HANDLERS, sort_handlers
+from .executors import shutdown
+from .serialization import date_cache
 
 __all__ = [
     'hooks',
+    'invalidate_is_tag',
     'run',
     'stop',
 ]
@@ -29,51 +34,170 @@ class Hooks(dict):
     >>> def extra_headers():
     ...     return {'new': 'headers'}
 
+    Each hook name is compiled into a dispatcher when a function is registered
+    for it, so looking up and calling a hook doesn't allocate anything, and
+    hooks with nothing registered are a no-op.
+
+    Registering a function replaces any registered for the same name, unless
+    *append* is given, in which case the functions are called in the order
+    they were registered, and the return value of the last one is used.
+
+    Hook functions may be coroutine functions, in which case the dispatcher
+    returns an awaitable. Only 'before_handling' and 'before_serialization'
+    (for REQMOD and RESPMOD requests) are awaited; the results of the other
+    hooks are cached, so they must be synchronous.
+
+    The registered functions and default of each name are stored as a
+    ``(listeners, default)`` pair, which may also be set, deleted or
+    updated with the usual dict methods, and the dispatchers are kept in
+    step. ``version`` is incremented whenever they change.
+
     """
+    version = 0
+
+    def __init__(self):
+        super().__init__()
+        self._dispatchers = {}
+
     def __getitem__(self, name):
         """Return the callable hook matching *name*.
 
         Always returns a callable that won't raise an exception.
 
         """
+        return self._dispatchers.get(name, _noop)
 
-        func, default = None, None
-        if name in self:
-            func, default = dict.__getitem__(self, name)
-
-        def safe_callable(*args, **kwargs):
-            try:
-                if func:
-                    return func(*args, **kwargs)
-            except Exception as e:
-                log.error("Error calling hook '%s'", name, exc_info=True)
-                return default
-        return safe_callable
-
-    def __call__(self, name, default=None, override=False):
+    def __call__(self, name, default=None, override=False, append=False):
         """Register a hook function with *name*, and *default* return value.
 
         Unless *override* is True, then *default* will only be saved the for
         the first time. This is to ensure sane defaults are used in the event
         that an error occurs in the registered hook.
 
+        If *append* is True, the function is called after those already
+        registered with *name*, rather than replacing them.
+
         """
         # we want to keep the original default, as it will be used if the new
         # one fails, e.g. for the ISTag header.
-        if name in self and not override:
-            _oldfunc, default = dict.__getitem__(self, name)
+        listeners = ()
+        if name in self:
+            old_listeners, old_default = dict.__getitem__(self, name)
+            if not override:
+                default = old_default
+            if append:
+                listeners = old_listeners
 
         def wrapped(func):
-            self[name] = func, default
+            self[name] = listeners + (func,), default
             return func
         return wrapped
 
+    def __setitem__(self, name, value):
+        listeners, default = value
+        listeners = tuple(listeners)
+        dict.__setitem__(self, name, (listeners, default))
+        self._dispatchers[name] = compile_hook(name, listeners, default)
+        self.version += 1
+
+    def __delitem__(self, name):
+        dict.__delitem__(self, name)
+        self._dispatchers.pop(name, None)
+        self.version += 1
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def pop(self, name, *default):
+        if name not in self:
+            return dict.pop(self, name, *default)
+        value = dict.__getitem__(self, name)
+        del self[name]
+        return value
+
+    def popitem(self):
+        name, value = dict.popitem(self)
+        self._dispatchers.pop(name, None)
+        self.version += 1
+        return name, value
+
+    def clear(self):
+        dict.clear(self)
+        self._dispatchers.clear()
+        self.version += 1
+
+    def update(self, *args, **kwargs):
+        for name, value in dict(*args, **kwargs).items():
+            self[name] = value
+
+    def setdefault(self, name, value):
+        if name not in self:
+            self[name] = value
+        return dict.__getitem__(self, name)
+
+
+def _noop(*args, **kwargs):
+    return None
+
+
+def compile_hook(name, listeners, default):
+    """Return a function calling each of ``listeners`` in order, returning
+    the result of the last one, or ``default`` if it raises an exception.
+
+    If any listener is a coroutine function, the returned function is too.
+
+    """
+    if not listeners:
+        def dispatch(*args, **kwargs):
+            return default
+        return dispatch
+
+    if any(asyncio.iscoroutinefunction(f) for f in listeners):
+        async def dispatch(*args, **kwargs):
+            result = default
+            for func in listeners:
+                try:
+                    result = func(*args, **kwargs)
+                    if isawaitable(result):
+                        result = await result
+                except Exception:
+                    log.error("Error calling hook '%s'", name, exc_info=True)
+                    result = default
+            return result
+        return dispatch
+
+    if len(listeners) == 1:
+        func, = listeners
+
+        def dispatch(*args, **kwargs):
+            try:
+                return func(*args, **kwargs)
+            except Exception:
+                log.error("Error calling hook '%s'", name, exc_info=True)
+                return default
+        return dispatch
+
+    def dispatch(*args, **kwargs):
+        result = default
+        for func in listeners:
+            try:
+                result = func(*args, **kwargs)
+            except Exception:
+                log.error("Error calling hook '%s'", name, exc_info=True)
+                result = default
+        return result
+    return dispatch
+
 
 hooks = Hooks()
 
 _server = None
 _fallback_is_tag = uuid.uuid4().hex
 
+# (config_version(), quoted ISTag value) for the ISTag currently in use.
+_is_tag_cache = None
+
 
 @hooks('is_tag', default=_fallback_is_tag)
 def is_tag_hook(request):
@@ -84,13 +208,44 @@ def is_tag_hook(request):
     return _fallback_is_tag
 
 
+def config_version():
+    """Return a value that changes whenever handlers or hooks are registered.
+
+    Used for invalidating anything computed from the server's configuration,
+    e.g. OPTIONS responses.
+
+    """
+    return _HANDLERS.version, hooks.version
+
+
 def is_tag(request):
     """Return the quoted ISTag header value to be used for the response of
     a given request, truncated to 32 bytes.
 
+    The ``is_tag`` hook is only called again when handlers or hooks are
+    registered, or after `invalidate_is_tag` is called, so it should describe
+    the state of the service rather than anything specific to ``request``.
+
     You don't need to use this directly.
     """
-    return '"%s"' % hooks['is_tag'](request)[:32]
+    global _is_tag_cache
+
+    version = config_version()
+    if _is_tag_cache is None or _is_tag_cache[0] != version:
+        _is_tag_cache = version, '"%s"' % hooks['is_tag'](request)[:32]
+    return _is_tag_cache[1]
+
+
+def invalidate_is_tag():
+    """Discard the cached ISTag, so the ``is_tag`` hook is called again for the
+    next response.
+
+    Use this when the state the ``is_tag`` hook depends on changes, e.g. when
+    virus definitions are updated, so that clients drop cached responses.
+
+    """
+    global _is_tag_cache
+    _is_tag_cache = None
 
 
 def signal_handlers():
@@ -145,6 +300,8 @@ def run(host='127.0.0.1', port=1334, *, install_signal_handlers=True,
     f = loop.create_server(factory, host, port)
     _server = loop.run_until_complete(f)
 
+    date_cache.start(loop)
+
     loop.run_until_complete(_server.wait_closed())
 
 
@@ -155,3 +312,5 @@ def stop():
         return
     _server.close()
     _server = None
+    date_cache.stop()
+    shutdown(wait=False)
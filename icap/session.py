@@ -15,11 +15,12 @@ TODO: Make the X-Session-ID configurable.
 
 """
 
-import asyncio
 import re
 import uuid
 import logging
 
+from inspect import isawaitable
+
 from .server import hooks
 
 
@@ -77,15 +78,29 @@ def make_session_id(request):
     return session_id
 
 
-@asyncio.coroutine
-def get_session(request):
-    from .asyncio import maybe_coroutine
+def load_session(request):
+    """Return the session for ``request``, or an awaitable resolving to it if
+    the session manager is asynchronous.
+
+    Used when handling requests, so synchronous session managers don't pay
+    for coroutines. See `get_session` for a coroutine version.
 
+    """
     session_id = make_session_id(request)
     get = hooks['session_manager']().get
 
-    session = yield from maybe_coroutine(get, session_id, request)
+    session = get(session_id, request)
+
+    if isawaitable(session):
+        return _await_session(session, request)
+    return prepare_session(session, request)
 
+
+async def _await_session(session, request):
+    return prepare_session(await session, request)
+
+
+def prepare_session(session, request):
     if 'url' not in session:
         url = request.http.request_line.uri
         session['url'] = url
@@ -93,12 +108,28 @@ def get_session(request):
     return session
 
 
-@asyncio.coroutine
-def finalize_session(session_id):
-    from .asyncio import maybe_coroutine
+async def get_session(request):
+    session = load_session(request)
 
+    if isawaitable(session):
+        session = await session
+    return session
+
+
+def unload_session(session_id):
+    """Finalize the session keyed by ``session_id``. Returns an awaitable if
+    the session manager is asynchronous.
+
+    """
     finalize = hooks['session_manager']().finalize
-    yield from maybe_coroutine(finalize, session_id)
+    return finalize(session_id)
+
+
+async def finalize_session(session_id):
+    result = unload_session(session_id)
+
+    if isawaitable(result):
+        await result
 
 
 def should_finalize_session(request):
@@ -1,6 +1,17 @@
+import asyncio
+import os
+import tempfile
 import time
+import tracemalloc
 
-from icap import ICAPRequestParser, HTTPMessageParser
+from icap import (DomainCriteria, HTTPMessageParser, HeadersDict,
+                  ICAPProtocolFactory, ICAPRequestParser, handler,
+                  DomainListCriteria, BloomFilterCriteria, RegexCriteria,
+                  RegexSetCriteria)
+from icap.criteria import get_handler
+from icap.forms import MultipartParser
+from icap.listindex import build_index
+from icap.server import Hooks
 
 
 def benchmark(count, maximum_time, *args, **kwargs):
@@ -39,3 +50,243 @@ def benchmark_HTTP_parsing(request):
 @benchmark(1800, 0.0007, request=open('tests/data/ninemsn.com.au', 'rb').read())
 def benchmark_HTTP_parsing(request):
     HTTPMessageParser.from_bytes(request)
+
+
+cookie_request = b''.join([
+    b'GET / HTTP/1.1\r\nHost: example.com\r\nCookie: ',
+    b'; '.join(b'cookie%d=%s' % (i, b'v' * 20) for i in range(20)),
+    b'\r\n\r\n',
+])
+
+
+@benchmark(6000, 0.0002, request=cookie_request)
+def benchmark_HTTP_cookies_passthrough(request):
+    bytes(HTTPMessageParser.from_bytes(request))
+
+
+text_response = HTTPMessageParser.from_bytes(
+    open('tests/data/ninemsn.com.au', 'rb').read())
+
+
+@benchmark(100000, 0.000005, request=b'')
+def benchmark_HTTP_body_text(request):
+    text_response.body
+
+
+upload = b''.join([
+    b'--xyz\r\nContent-Disposition: form-data; name="f"; filename="f"\r\n\r\n',
+    os.urandom(1024 * 1024),
+    b'\r\n--xyz--\r\n',
+])
+upload_pieces = [upload[i:i + 65536] for i in range(0, len(upload), 65536)]
+
+
+@benchmark(100, 0.005, request=upload)
+def benchmark_multipart_parsing(request):
+    parser = MultipartParser('xyz')
+    for piece in upload_pieces:
+        parser.feed(piece)
+    parser.close()
+
+
+class NullTransport:
+    def write(self, data):
+        pass
+
+    def close(self):
+        pass
+
+
+@handler(DomainCriteria('www.origin-server.com'))
+def reqmod(request):
+    pass
+
+
+async def handle_icap_requests(request, count, factory=None):
+    # data_received is called from within the running loop, like it would be
+    # in a real server. Building a factory prerenders the OPTIONS templates,
+    # so it's kept out of the loop.
+    if factory is None:
+        factory = ICAPProtocolFactory()
+
+    for _ in range(count):
+        protocol = factory()
+        protocol.connection_made(NullTransport())
+
+        f = protocol.data_received(request)
+
+        if f is not None:
+            await f
+
+
+trivial_server = ICAPProtocolFactory()
+
+
+@benchmark(30, 0.05, request=open('tests/data/request_with_http_request_no_payload.request', 'rb').read())
+def benchmark_ICAP_trivial_handler(request):
+    # 100 requests per call, so each call doesn't just measure loop startup.
+    asyncio.get_event_loop().run_until_complete(
+        handle_icap_requests(request, 100, trivial_server))
+
+
+def copy_benchmark(maximum_copies, payload_size, request):
+    """Check the payload of ``request``, ``payload_size`` bytes, is copied
+    fewer than ``maximum_copies`` times when handled, going by the peak
+    memory allocated.
+
+    """
+    def inner(func):
+        tracemalloc.start()
+        func(request)
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        copies = peak / payload_size
+        print('copied {:,d} bytes of payload {:.2f} times'.format(payload_size, copies))
+        assert copies < maximum_copies
+        return func
+    return inner
+
+
+def memory_benchmark(count, maximum_bytes, *args, **kwargs):
+    """Check the objects returned by ``count`` calls take up fewer than
+    ``maximum_bytes`` each, going by the memory still allocated while they're
+    all alive.
+
+    """
+    def inner(func):
+        tracemalloc.start()
+        results = [func(*args, **kwargs) for _ in range(count)]
+        current, peak = tracemalloc.get_traced_memory()
+        blocks = sum(s.count for s in tracemalloc.take_snapshot().statistics('filename'))
+        tracemalloc.stop()
+
+        per_object = current / count
+        print('{:,.0f} bytes in {:.1f} blocks each for {} objects'.format(per_object, blocks / count, len(results)))
+        assert per_object < maximum_bytes
+        return func
+    return inner
+
+
+http_headers = HTTPMessageParser.from_bytes(
+    open('tests/data/ninemsn.com.au', 'rb').read()).headers.items_multi()
+
+
+@memory_benchmark(10000, 2500, http_headers)
+def benchmark_HeadersDict_memory(items):
+    return HeadersDict(items)
+
+
+@memory_benchmark(10000, 100, HeadersDict(http_headers))
+def benchmark_HeadersDict_copy_memory(headers):
+    return headers.copy()
+
+
+@memory_benchmark(1000, 4500, open('tests/data/request_with_http_response_and_payload.request', 'rb').read())
+def benchmark_ICAPRequest_memory(request):
+    return ICAPRequestParser.from_bytes(request)
+
+
+@handler(name='passthrough')
+def respmod(response):
+    pass
+
+
+passthrough_chunk = os.urandom(65536)
+passthrough_response = b'HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n' % (16 * len(passthrough_chunk))
+passthrough_request = b''.join([
+    b'RESPMOD /passthrough/respmod ICAP/1.0\r\n'
+    b'Host: icap.example.org\r\n'
+    b'Encapsulated: res-hdr=0, res-body=%d\r\n\r\n' % len(passthrough_response),
+    passthrough_response,
+    b'%x\r\n%s\r\n' % (len(passthrough_chunk), passthrough_chunk) * 16,
+    b'0\r\n\r\n',
+])
+
+
+@copy_benchmark(0.5, 16 * len(passthrough_chunk), passthrough_request)
+def benchmark_unmodified_body_copies(request):
+    asyncio.get_event_loop().run_until_complete(
+        handle_icap_requests(request, 1))
+
+
+benchmark_hooks = Hooks()
+benchmark_hooks('registered')(lambda request: None)
+
+
+@benchmark(200000, 0.000002, request=b'')
+def benchmark_hook_dispatch_empty(request):
+    benchmark_hooks['empty'](request)
+
+
+@benchmark(200000, 0.000002, request=b'')
+def benchmark_hook_dispatch_registered(request):
+    benchmark_hooks['registered'](request)
+
+
+for i in range(10000):
+    handler(DomainCriteria('www.%d.example.com' % i), name='many')(reqmod)
+
+handler(DomainCriteria('www.origin-server.com'), name='many')(reqmod)
+
+many_rules_request = ICAPRequestParser.from_bytes(open('tests/data/request_with_http_request_no_payload.request', 'rb').read().replace(b'REQMOD /reqmod', b'REQMOD /many/reqmod'))
+
+
+@benchmark(10000, 0.00005, request=b'')
+def benchmark_routing_10000_rules(request):
+    get_handler(many_rules_request)
+
+
+blocklist = DomainCriteria(*(
+    ['www.%d.example.com' % i for i in range(100000)] +
+    ['*.%d.example.org' % i for i in range(100000)]))
+
+
+@benchmark(10000, 0.00002, request=b'')
+def benchmark_DomainCriteria_200000_domains(request):
+    blocklist(many_rules_request)
+
+
+domain_list_path = os.path.join(tempfile.mkdtemp(), 'domains.idx')
+build_index(('www.%d.example.com' % i for i in range(1000000)), domain_list_path)
+
+
+@benchmark(1000, 0.0002, request=b'')
+def benchmark_DomainListCriteria_open_1000000_domains(request):
+    DomainListCriteria(domain_list_path).index.close()
+
+
+domain_list = DomainListCriteria(domain_list_path)
+
+
+@benchmark(10000, 0.0001, request=b'')
+def benchmark_DomainListCriteria_1000000_domains(request):
+    domain_list(many_rules_request)
+
+
+many_rules_request.session = {'url': many_rules_request.http.request_line.uri}
+
+url_keys = ['www.%d.example.com/ads' % i for i in range(100000)]
+prefiltered = BloomFilterCriteria(
+    RegexCriteria('|'.join(['http://www\\.%d\\.example\\.com/ads' % i for i in range(1000)])),
+    url_keys)
+
+
+@benchmark(10000, 0.00005, request=b'')
+def benchmark_BloomFilterCriteria_clean_url(request):
+    prefiltered(many_rules_request)
+
+
+url_patterns = ['http://www\\.%d\\.example\\.com/ads/.*' % i for i in range(500)]
+regex_set = RegexSetCriteria(*url_patterns)
+regex_list = [RegexCriteria(pattern) for pattern in url_patterns]
+
+
+@benchmark(10000, 0.00005, request=b'')
+def benchmark_RegexSetCriteria_500_patterns(request):
+    regex_set(many_rules_request)
+
+
+@benchmark(1000, 0.001, request=b'')
+def benchmark_RegexCriteria_500_patterns(request):
+    any(r(many_rules_request) for r in regex_list)
@@ -1,5 +1,10 @@
 import asyncio
+import concurrent.futures
 import os
+import socket
+import threading
+import time
+import tracemalloc
 
 from io import BytesIO
 
@@ -8,9 +13,11 @@ import pytest
 from unittest.mock import MagicMock, patch
 
 from icap import (DomainCriteria, HTTPResponse, HeadersDict, HTTPRequest,
-                  handler, ICAPProtocolFactory, ICAPProtocol, RequestLine, hooks)
+                  handler, ICAPProtocolFactory, ICAPProtocol, RequestLine,
+                  StatusLine, hooks, RegexCriteria, RegexSetCriteria,
+                  BufferedICAPProtocol, FileBody)
 from icap.criteria import _HANDLERS, get_handler
-from icap.errors import ICAPAbort
+from icap.errors import ICAPAbort, abort
 from icap.models import ICAPRequest
 
 
@@ -18,6 +25,16 @@ def data_string(path):
     return open('tests/data/' + path, 'rb').read()
 
 
+class ProcessHandler:
+    # defined at module level so it can be pickled for the process pool.
+    def reqmod(self, request):
+        request.headers['X-Modified'] = 'yes'
+
+    def respmod(self, request):
+        request.headers['X-Pid'] = str(os.getpid())
+        return request.body_bytes.upper()
+
+
 class BytesIOTransport:
     def __init__(self):
         self._buffer = BytesIO()
@@ -37,6 +54,9 @@ class BytesIOTransport:
     def getvalue(self):
         return self._buffer.getvalue()
 
+    def is_closing(self):
+        return False
+
     def close(self):
         pass
 
@@ -48,11 +68,32 @@ class TestICAPProtocolFactory:
         assert isinstance(t, ICAPProtocol)
         assert t.factory == f
 
+    def test_buffered(self):
+        f = ICAPProtocolFactory(buffered=True)
+        t = f()
+        assert isinstance(t, BufferedICAPProtocol)
+        assert isinstance(t, asyncio.BufferedProtocol)
+        assert t.factory == f
+
 
 class TestICAPProtocol:
-    def setup_method(self, method):
+    @pytest.fixture(autouse=True)
+    def restore_registries(self):
+        # handlers and hooks are global, so each test starts without
+        # handlers and leaves both as it found them.
+        saved_handlers = {path: list(services)
+                          for path, services in _HANDLERS.items()}
+        saved_hooks = dict(hooks)
         _HANDLERS.clear()
 
+        yield
+
+        _HANDLERS.clear()
+        for path, services in saved_handlers.items():
+            _HANDLERS[path] = services
+        hooks.clear()
+        hooks.update(saved_hooks)
+
     def test_connection_made_and_lost(self):
         i = ICAPProtocol(None)
         transport = MagicMock()
@@ -131,6 +172,63 @@ class TestICAPProtocol:
 
         assert b'500 Internal Server Error' in transaction
 
+    def test_handle_request__async_hooks(self):
+        input_bytes = data_string('icap_request_with_two_header_sets.request')
+
+        server = ICAPProtocolFactory()
+        calls = []
+
+        @handler(DomainCriteria('www.origin-server.com'))
+        def respmod(request):
+            calls.append('respmod')
+
+        @hooks('before_handling')
+        async def before_handling(request):
+            await asyncio.sleep(0)
+            calls.append('before_handling')
+
+        @hooks('before_serialization')
+        async def before_serialization(request, response):
+            await asyncio.sleep(0)
+            calls.append('before_serialization')
+            response.headers['X-Hooked'] = 'yes'
+
+        transaction = self.run_test(server, input_bytes)
+
+        assert calls == ['before_handling', 'respmod', 'before_serialization']
+        assert b'X-Hooked: yes\r\n' in transaction
+
+    def test_handle_request__url_criteria(self):
+        input_bytes = data_string('request_with_http_request_no_payload.request')
+
+        server = ICAPProtocolFactory()
+
+        @handler(RegexSetCriteria('.*/nomatch', '/$'))
+        def reqmod(request):
+            request.headers['X-Routed'] = 'yes'
+            return request
+
+        transaction = self.run_test(server, input_bytes)
+
+        assert b'X-Routed: yes' in transaction
+
+    def test_handle_request__error_includes_session_id(self):
+        input_bytes = data_string('icap_request_with_two_header_sets.request')
+
+        server = ICAPProtocolFactory()
+
+        @handler(DomainCriteria('www.origin-server.com'))
+        def respmod(request):
+            abort(403)
+
+        with patch('icap.session.uuid.uuid4') as mock_uuid:
+            mock_uuid.return_value.hex = 'cool hash'
+            transaction = self.run_test(server, input_bytes)
+
+        assert transaction.startswith(b'ICAP/1.0 403 ')
+        assert b'X-Session-ID: cool hash\r\n' in transaction
+        assert transaction.endswith(b'\r\n\r\n')
+
     @pytest.mark.parametrize('is_reqmod', [False, True])
     def test_poor_matching_uris_returns_405(self, is_reqmod):
         if is_reqmod:
@@ -301,6 +399,69 @@ class TestICAPProtocol:
         assert b'Transfer-Complete: *' in s
         assert b'Options-TTL: 3600' in s
 
+    def test_handle_request__options_request_is_cached(self):
+        input_bytes = data_string('options_request.request')
+        server = self.dummy_server()
+
+        with patch.object(ICAPProtocol, 'handle_options',
+                          autospec=True,
+                          side_effect=ICAPProtocol.handle_options) as m:
+            first = self.run_test(server, input_bytes)
+            second = self.run_test(server, input_bytes)
+
+            assert len(m.mock_calls) == 1
+            assert first.replace(b'\r\n', b'\n').split(b'\n')[0] == \
+                second.replace(b'\r\n', b'\n').split(b'\n')[0]
+
+            @hooks('options_headers')
+            def options_headers():
+                return {'Service': 'lamps'}
+
+            third = self.run_test(server, input_bytes)
+
+            assert len(m.mock_calls) == 2
+            assert b'Service: lamps' in third
+
+            @handler(name='foo')
+            def reqmod(request):
+                pass
+
+            self.run_test(server, input_bytes)
+            assert len(m.mock_calls) == 3
+
+    def test_handle_request__options_request_prerendered(self):
+        self.dummy_server()
+        server = ICAPProtocolFactory()
+
+        assert set(server.options_cache) == {'/reqmod', '/respmod'}
+
+    def test_handle_request__options_ttl(self):
+        input_bytes = data_string('options_request.request')
+        self.dummy_server()
+
+        @hooks('options_headers')
+        def options_headers():
+            return {}
+
+        server = ICAPProtocolFactory(options_ttl=60)
+
+        s = self.run_test(server, input_bytes)
+        assert b'Options-TTL: 60\r\n' in s
+
+        now = time.monotonic()
+
+        with patch.object(ICAPProtocol, 'handle_options',
+                          autospec=True,
+                          side_effect=ICAPProtocol.handle_options) as m, \
+                patch('time.monotonic') as monotonic:
+            monotonic.return_value = now + 30
+            self.run_test(server, input_bytes)
+            assert not m.mock_calls
+
+            monotonic.return_value += 60
+            self.run_test(server, input_bytes)
+            assert len(m.mock_calls) == 1
+
     def test_handle_request__response_for_reqmod(self):
         input_bytes = data_string('request_with_http_request_no_payload.request')
 
@@ -314,6 +475,23 @@ class TestICAPProtocol:
         assert b"HTTP/1.1 200 OK" in transaction
         assert b"cool body" in transaction
 
+    def test_handle_request__url_with_query(self):
+        input_bytes = data_string('request_with_http_request_no_payload.request')
+        input_bytes = input_bytes.replace(
+            b'GET / HTTP', b'GET /?a=1&b=2 HTTP').replace(
+            b'null-body=170', b'null-body=178')
+
+        server = ICAPProtocolFactory()
+
+        @handler(RegexCriteria(r'/\?a=1&b=2$'))
+        def reqmod(request):
+            return HTTPResponse(body=b'cool body')
+
+        transaction = self.run_test(server, input_bytes)
+
+        assert b"HTTP/1.1 200 OK" in transaction
+        assert b"cool body" in transaction
+
     def test_handle_request__request_for_reqmod(self):
         input_bytes = data_string('request_with_http_request_no_payload.request')
 
@@ -384,6 +562,342 @@ class TestICAPProtocol:
         else:
             assert b"ICAP/1.0 200 OK" in transaction
 
+    @pytest.mark.parametrize(('allow_204'), [False, True])
+    def test_handle_request__no_match_204_before_body(self, allow_204):
+        input_bytes = data_string('icap_request_with_two_header_sets.request')
+        if allow_204:
+            input_bytes = input_bytes.replace(
+                b'Encapsulated', b'Allow: 204\r\nEncapsulated')
+        headers, body = input_bytes.split(b'33; lamps')
+
+        server = ICAPProtocolFactory()
+
+        @handler(DomainCriteria('www.example.com'))
+        def respmod(request):
+            pass
+
+        protocol = server()
+        protocol.connection_made(BytesIOTransport())
+
+        assert protocol.data_received(headers) is None
+
+        transaction = protocol.transport.getvalue()
+        if allow_204:
+            assert transaction.startswith(b'ICAP/1.0 204 ')
+        else:
+            assert not transaction
+
+        f = protocol.data_received(b'33; lamps' + body)
+        if f is not None:
+            asyncio.get_event_loop().run_until_complete(f)
+
+        transaction = protocol.transport.getvalue()
+        assert transaction.count(b'ICAP/1.0') == 1
+        if not allow_204:
+            assert transaction.startswith(b'ICAP/1.0 200 ')
+            assert b'returned by an origin server' in transaction
+
+        assert not protocol.parser.started()
+        assert not protocol.discarding
+
+    def test_handle_request__routed_before_body(self):
+        input_bytes = data_string('icap_request_with_two_header_sets.request')
+        headers, body = input_bytes.split(b'33; lamps')
+
+        server = ICAPProtocolFactory()
+
+        @handler(DomainCriteria('www.origin-server.com'))
+        def respmod(request):
+            return request.body_bytes.upper()
+
+        protocol = server()
+        protocol.connection_made(BytesIOTransport())
+        protocol.data_received(headers)
+
+        assert protocol.route == (respmod, False)
+
+        with patch('icap.asyncio.get_handler') as mock_get_handler:
+            f = protocol.data_received(b'33; lamps' + body)
+            asyncio.get_event_loop().run_until_complete(f)
+            assert not mock_get_handler.called
+
+        transaction = protocol.transport.getvalue()
+        assert b'RETURNED BY AN ORIGIN SERVER' in transaction
+        assert protocol.route is None
+
+    def test_handle_request__body_criteria_wait_for_body(self):
+        input_bytes = data_string('icap_request_with_two_header_sets.request')
+        input_bytes = input_bytes.replace(
+            b'Encapsulated', b'Allow: 204\r\nEncapsulated')
+        headers, body = input_bytes.split(b'33; lamps')
+
+        server = ICAPProtocolFactory()
+
+        @handler(lambda request: b'origin' in request.http.body_bytes)
+        def respmod(request):
+            return b'matched'
+
+        protocol = server()
+        protocol.connection_made(BytesIOTransport())
+        protocol.data_received(headers)
+
+        assert protocol.route is None
+        assert not protocol.transport.getvalue()
+
+        f = protocol.data_received(b'33; lamps' + body)
+        asyncio.get_event_loop().run_until_complete(f)
+
+        assert b'matched' in protocol.transport.getvalue()
+
+    def feed(self, protocol, data):
+        f = protocol.data_received(data)
+        if f is not None:
+            asyncio.get_event_loop().run_until_complete(f)
+        return protocol.transport.getvalue()
+
+    def test_handle_request__body_false_relays_body(self):
+        input_bytes = data_string('icap_request_with_two_header_sets.request')
+        headers, body = input_bytes.split(b'33; lamps')
+        chunk = b'33\r\nThis is data that was returned by an origin server.\r\n'
+
+        server = ICAPProtocolFactory()
+
+        @handler(DomainCriteria('www.origin-server.com'), body=False)
+        def respmod(request):
+            request.headers['X-Relayed'] = 'yes'
+
+        protocol = server()
+        protocol.connection_made(BytesIOTransport())
+
+        transaction = self.feed(protocol, headers)
+
+        assert transaction.startswith(b'ICAP/1.0 200 ')
+        assert b'X-Relayed: yes\r\n' in transaction
+        assert b'Content-Length: 51\r\n' in transaction
+        assert b'res-body=' in transaction
+        assert transaction.endswith(b'\r\n\r\n')
+
+        transaction = self.feed(protocol, b'33; lamps' + body[:-5])
+
+        assert transaction.endswith(chunk)
+        assert not protocol.parser.response_parser.chunks
+
+        transaction = self.feed(protocol, b'0\r\n\r\n')
+
+        assert transaction.endswith(chunk + b'0\r\n\r\n')
+        assert transaction.count(b'ICAP/1.0') == 1
+        assert not protocol.parser.started()
+        assert protocol.relay is None
+
+    @pytest.mark.parametrize('allow_204', [False, True])
+    def test_handle_request__body_false_empty_body(self, allow_204):
+        input_bytes = data_string('icap_request_with_two_header_sets.request')
+        if allow_204:
+            input_bytes = input_bytes.replace(
+                b'Encapsulated', b'Allow: 204\r\nEncapsulated')
+        headers, body = input_bytes.split(b'33; lamps')
+
+        server = ICAPProtocolFactory()
+
+        @handler(DomainCriteria('www.origin-server.com'), body=False)
+        def respmod(request):
+            assert request.body_bytes == b''
+            request.body = b''
+
+        protocol = server()
+        protocol.connection_made(BytesIOTransport())
+
+        self.feed(protocol, headers)
+        transaction = self.feed(protocol, b'33; lamps' + body)
+
+        assert transaction.startswith(b'ICAP/1.0 200 ')
+        assert b'origin server' not in transaction
+        assert transaction.count(b'ICAP/1.0') == 1
+        assert not protocol.parser.started()
+
+    def test_handle_request__body_false_holds_body_until_handled(self):
+        input_bytes = data_string('icap_request_with_two_header_sets.request')
+        headers, body = input_bytes.split(b'33; lamps')
+
+        server = ICAPProtocolFactory()
+
+        @handler(DomainCriteria('www.origin-server.com'), body=False)
+        async def respmod(request):
+            await asyncio.sleep(0)
+            request.headers['X-Relayed'] = 'yes'
+
+        protocol = server()
+        protocol.connection_made(BytesIOTransport())
+
+        f = protocol.data_received(headers)
+        relay = protocol.relay
+
+        with patch.object(relay, 'limit', 10):
+            assert protocol.data_received(b'33; lamps' + body[:-5]) is None
+            assert protocol.transport._paused
+
+            assert protocol.data_received(b'0\r\n\r\n') is None
+            assert not protocol.transport._paused
+
+        assert not protocol.transport.getvalue()
+        assert not protocol.parser.started()
+
+        asyncio.get_event_loop().run_until_complete(f)
+
+        transaction = protocol.transport.getvalue()
+        assert not protocol.transport._paused
+        assert b'X-Relayed: yes\r\n' in transaction
+        assert transaction.endswith(
+            b'returned by an origin server.\r\n0\r\n\r\n')
+
+    @pytest.mark.parametrize('replace', [False, True])
+    def test_handle_request__body_false_without_relay(self, replace):
+        input_bytes = data_string('icap_request_with_two_header_sets.request')
+        input_bytes = input_bytes.replace(
+            b'Encapsulated', b'Allow: 204\r\nEncapsulated')
+        headers, body = input_bytes.split(b'33; lamps')
+
+        server = ICAPProtocolFactory()
+
+        @handler(DomainCriteria('www.origin-server.com'), body=False)
+        def respmod(request):
+            if replace:
+                return b'replaced'
+
+        protocol = server()
+        protocol.connection_made(BytesIOTransport())
+
+        transaction = self.feed(protocol, headers)
+
+        if replace:
+            assert transaction.startswith(b'ICAP/1.0 200 ')
+            assert transaction.endswith(b'8\r\nreplaced\r\n0\r\n\r\n')
+        else:
+            assert transaction.startswith(b'ICAP/1.0 204 ')
+
+        assert transaction == self.feed(protocol, b'33; lamps' + body)
+        assert not protocol.parser.started()
+
+    def feed_buffered(self, protocol, data, read_size):
+        while data:
+            buffer = protocol.get_buffer(-1)
+            n = min(len(buffer), len(data), read_size)
+            buffer[:n] = data[:n]
+            data = data[n:]
+
+            f = protocol.buffer_updated(n)
+            if f is not None:
+                asyncio.get_event_loop().run_until_complete(f)
+
+        return protocol.transport.getvalue()
+
+    @pytest.mark.parametrize('read_size', [1, 7, 100, 65536])
+    def test_buffered_protocol(self, read_size):
+        input_bytes = data_string('icap_request_with_two_header_sets.request')
+
+        server = ICAPProtocolFactory(buffered=True)
+
+        @handler(DomainCriteria('www.origin-server.com'))
+        def respmod(request):
+            return request.body_bytes.upper()
+
+        protocol = server()
+        protocol.connection_made(BytesIOTransport())
+
+        self.feed_buffered(protocol, input_bytes, read_size)
+        transaction = self.feed_buffered(protocol, input_bytes, read_size)
+
+        assert transaction.count(b'ICAP/1.0 200 OK') == 2
+        assert transaction.count(b'RETURNED BY AN ORIGIN SERVER.\r\n') == 2
+        assert not protocol.parser.started()
+
+    def test_buffered_protocol__reuses_buffer(self):
+        input_bytes = data_string('icap_request_with_two_header_sets.request')
+        headers, body = input_bytes.split(b'33; lamps')
+
+        server = ICAPProtocolFactory(buffered=True)
+
+        @handler(lambda request: True)
+        def respmod(request):
+            pass
+
+        protocol = server()
+        protocol.connection_made(BytesIOTransport())
+        buffer = protocol.get_buffer(-1)
+
+        self.feed_buffered(protocol, input_bytes, 65536)
+        assert protocol.get_buffer(-1) is buffer
+
+        # small bodies are copied out of the buffer.
+        self.feed_buffered(protocol, headers + b'33; lamps', 65536)
+        self.feed_buffered(protocol, body[:-5], 65536)
+        assert protocol.get_buffer(-1) is buffer
+
+        transaction = self.feed_buffered(protocol, b'0\r\n\r\n', 65536)
+        assert protocol.get_buffer(-1) is buffer
+        assert transaction.count(b'ICAP/1.0 200 OK') == 2
+        assert transaction.count(b'returned by an origin server.') == 2
+
+        # the parser keeps views of larger ones until the request is complete
+        chunk = b'x' * 40000
+        self.feed_buffered(protocol, headers + b'9c40\r\n' + chunk, 65536)
+        assert protocol.get_buffer(-1) is not buffer
+        buffer = protocol.get_buffer(-1)
+
+        transaction = self.feed_buffered(protocol, b'\r\n0\r\n\r\n', 65536)
+        assert protocol.get_buffer(-1) is buffer
+        assert transaction.count(b'ICAP/1.0 200 OK') == 3
+
+    def test_buffered_protocol__small_reads(self):
+        input_bytes = data_string('icap_request_with_two_header_sets.request')
+        headers = input_bytes.split(b'33; lamps')[0]
+        chunk = b'64\r\n' + b'x' * 100 + b'\r\n'
+        body = chunk * 1000 + b'0\r\n\r\n'
+
+        server = ICAPProtocolFactory(buffered=True)
+
+        @handler(lambda request: True)
+        def respmod(request):
+            pass
+
+        protocol = server()
+        protocol.connection_made(BytesIOTransport())
+        self.feed_buffered(protocol, headers, 65536)
+
+        tracemalloc.start()
+        try:
+            self.feed_buffered(protocol, body[:-5], len(chunk))
+            retained, _ = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        assert retained < 1048576
+        transaction = self.feed_buffered(protocol, body[-5:], 5)
+        assert transaction.startswith(b'ICAP/1.0 200 OK')
+
+    def test_buffered_protocol__sizehint(self):
+        protocol = ICAPProtocolFactory(buffered=True)()
+        protocol.connection_made(BytesIOTransport())
+        buffer = protocol.get_buffer(-1)
+
+        assert protocol.get_buffer(1024) is buffer
+        assert len(protocol.get_buffer(100000)) == 100000
+        assert len(protocol.get_buffer(10 ** 9)) == \
+            BufferedICAPProtocol.max_buffer_size
+
+    def test_buffered_protocol__grows_buffer(self):
+        protocol = ICAPProtocolFactory(buffered=True)()
+        protocol.connection_made(BytesIOTransport())
+
+        with patch.object(BufferedICAPProtocol, 'max_buffer_size', 262144):
+            buffer = protocol.get_buffer(-1)
+            assert len(buffer) == BufferedICAPProtocol.buffer_size
+
+            for size in (131072, 262144, 262144):
+                protocol.buffer_updated(len(buffer))
+                buffer = protocol.get_buffer(-1)
+                assert len(buffer) == size
+
     def test_handle_request__request_for_respmod(self):
         input_bytes = data_string('icap_request_with_two_header_sets.request')
 
@@ -398,6 +912,134 @@ class TestICAPProtocol:
         assert b"500 Internal Server Error" in transaction
         assert transaction.count(b"This is data that was returned by an origin server") == 0
 
+    @pytest.mark.parametrize('file_object', [False, True])
+    def test_handle_request__file_body(self, tmpdir, file_object):
+        input_bytes = data_string('icap_request_with_two_header_sets.request')
+        path = tmpdir.join('blocked.html')
+        path.write_binary(b'<p>blocked</p>')
+
+        server = ICAPProtocolFactory()
+        files = []
+
+        @handler(DomainCriteria('www.origin-server.com'))
+        def respmod(request):
+            if file_object:
+                files.append(open(str(path), 'rb'))
+                request.body = FileBody(files[0])
+            else:
+                request.body = FileBody(str(path))
+
+        transaction = self.run_test(server, input_bytes)
+
+        assert b'Content-Length: 14\r\n' in transaction
+        assert transaction.endswith(b'\r\n\r\ne\r\n<p>blocked</p>\r\n0\r\n\r\n')
+
+        # file objects are closed once they've been sent.
+        assert all(f.closed for f in files)
+
+    @pytest.mark.parametrize(('outcome', 'expected'), [
+        ('error', b'ICAP/1.0 500 '),
+        ('request for respmod', b'ICAP/1.0 500 '),
+        ('empty file', b'ICAP/1.0 200 '),
+    ])
+    def test_handle_request__file_body_closed(self, tmpdir, outcome,
+                                              expected):
+        input_bytes = data_string('icap_request_with_two_header_sets.request')
+        path = tmpdir.join('blocked.html')
+        path.write_binary(b'' if outcome == 'empty file' else b'blocked')
+
+        server = ICAPProtocolFactory()
+        files = []
+
+        @handler(DomainCriteria('www.origin-server.com'))
+        def respmod(request):
+            files.append(open(str(path), 'rb'))
+            if outcome == 'request for respmod':
+                return HTTPRequest(body=FileBody(files[0]))
+
+            request.body = FileBody(files[0])
+            if outcome == 'error':
+                raise Exception('boom')
+
+        transaction = self.run_test(server, input_bytes)
+
+        assert transaction.startswith(expected)
+        assert files and all(f.closed for f in files)
+
+    @pytest.mark.parametrize('outcome', ['unmodified', 'modified', 'error'])
+    def test_handle_request__form_files_closed(self, outcome):
+        content = b'x' * 5000
+        body = (b'--xyz\r\nContent-Disposition: form-data; name="f"; '
+                b'filename="big"\r\n\r\n' + content + b'\r\n--xyz--\r\n')
+        http = (b'POST / HTTP/1.1\r\n'
+                b'Host: www.origin-server.com\r\n'
+                b'Content-Type: multipart/form-data; boundary=xyz\r\n'
+                b'\r\n')
+        input_bytes = (b'REQMOD icap://icap-server.net/reqmod ICAP/1.0\r\n'
+                       b'Host: icap-server.net\r\n'
+                       b'Allow: 204\r\n'
+                       b'Encapsulated: req-hdr=0, req-body=%d\r\n'
+                       b'\r\n' % len(http) +
+                       http + b'%x\r\n%s\r\n0\r\n\r\n' % (len(body), body))
+
+        server = ICAPProtocolFactory()
+        requests = []
+
+        @handler(DomainCriteria('www.origin-server.com'))
+        def reqmod(request):
+            requests.append(request)
+            form = request.post
+            if outcome != 'unmodified':
+                # large enough to be written to a temporary file.
+                form['f'].content = content.upper()
+                form.max_memory = 1024
+            if outcome == 'error':
+                raise Exception('boom')
+
+        transaction = self.run_test(server, input_bytes)
+
+        assert transaction.startswith({
+            'unmodified': b'ICAP/1.0 204 ',
+            'modified': b'ICAP/1.0 200 ',
+            'error': b'ICAP/1.0 500 ',
+        }[outcome])
+        request, = requests
+        assert request.post['f'].file.closed
+        if outcome == 'modified':
+            assert request.body_file.file.closed
+
+    def test_handle_request__file_body_with_sendfile(self, tmpdir):
+        input_bytes = data_string('icap_request_with_two_header_sets.request')
+        path = tmpdir.join('blocked.html')
+        path.write_binary(b'0123456789' * 10000)
+
+        server = ICAPProtocolFactory()
+
+        @handler(DomainCriteria('www.origin-server.com'))
+        def respmod(request):
+            request.body = FileBody(str(path), offset=10, length=50000)
+
+        loop = asyncio.get_event_loop()
+        client, sock = socket.socketpair()
+
+        async def exchange():
+            transport, _ = await loop.connect_accepted_socket(server, sock)
+            reader, writer = await asyncio.open_connection(sock=client)
+            writer.write(input_bytes)
+            try:
+                return await reader.readuntil(b'\r\n0\r\n\r\n')
+            finally:
+                writer.close()
+                transport.close()
+
+        with patch.object(loop, 'sendfile', wraps=loop.sendfile) as sendfile:
+            transaction = loop.run_until_complete(exchange())
+
+        assert sendfile.call_count == 1
+        assert b'Content-Length: 50000\r\n' in transaction
+        assert transaction.endswith(
+            b'\r\n\r\nc350\r\n' + b'0123456789' * 5000 + b'\r\n0\r\n\r\n')
+
     def test_handle_request__response_for_respmod(self):
         input_bytes = data_string('icap_request_with_two_header_sets.request')
 
@@ -430,9 +1072,48 @@ class TestICAPProtocol:
 
         transaction = self.run_test(server, input_bytes, force_204=force_204)
 
-        assert b'200 OK' in transaction
-        assert transaction.count(b'33; lamps') == 0
-        assert transaction.count(b'33\r\n') == 1
+        if force_204:
+            assert b'ICAP/1.0 204 No Modifications Needed' in transaction
+            assert b'\r\n\r\n33\r\n' not in transaction
+        else:
+            # the chunk size follows the headers, matched with them so a
+            # random session ID ending in "33" doesn't count.
+            assert b'200 OK' in transaction
+            assert transaction.count(b'33; lamps') == 0
+            assert transaction.count(b'\r\n\r\n33\r\n') == 1
+
+    @pytest.mark.parametrize(('modify', 'expected'), [
+        (None, b'ICAP/1.0 204 No Modifications Needed'),
+        ('same body', b'ICAP/1.0 204 No Modifications Needed'),
+        ('same message', b'ICAP/1.0 204 No Modifications Needed'),
+        ('header', b'ICAP/1.0 200 OK'),
+        ('body', b'ICAP/1.0 200 OK'),
+        ('status line', b'ICAP/1.0 200 OK'),
+        ('set cookie', b'ICAP/1.0 200 OK'),
+    ])
+    def test_handle_request__unmodified_returns_204(self, modify, expected):
+        input_bytes = data_string('icap_request_with_two_header_sets.request')
+
+        server = ICAPProtocolFactory()
+
+        @handler(DomainCriteria('www.origin-server.com'))
+        def respmod(request):
+            if modify == 'same body':
+                return request.body_bytes
+            elif modify == 'same message':
+                return request
+            elif modify == 'header':
+                request.headers['X-Foo'] = 'bar'
+            elif modify == 'body':
+                return b'new body'
+            elif modify == 'status line':
+                request.status_line = StatusLine('HTTP/1.1', 404)
+            elif modify == 'set cookie':
+                request.set_cookie('foo', 'bar')
+
+        transaction = self.run_test(server, input_bytes, force_204=True)
+
+        assert expected in transaction
 
     def test_handle_request__string_return(self):
         input_bytes = data_string('icap_request_with_two_header_sets.request')
@@ -475,16 +1156,129 @@ class TestICAPProtocol:
 
         assert b"fooooooooooooooo" in transaction
 
+    def test_handle_request__thread_executor(self):
+        input_bytes = data_string('icap_request_with_two_header_sets.request')
+
+        server = ICAPProtocolFactory()
+        threads = []
+
+        @handler(DomainCriteria('www.origin-server.com'), executor='thread')
+        def respmod(request):
+            threads.append(threading.current_thread())
+            return b"fooooooooooooooo"
+
+        transaction = self.run_test(server, input_bytes, assert_mutated=True)
+
+        assert b"fooooooooooooooo" in transaction
+        assert threads and threads[0] is not threading.main_thread()
+
+    def test_handle_request__custom_executor(self):
+        input_bytes = data_string('icap_request_with_two_header_sets.request')
+
+        server = ICAPProtocolFactory()
+        executor = concurrent.futures.ThreadPoolExecutor(1)
+
+        with patch.object(executor, 'submit', wraps=executor.submit) as submit:
+            @handler(DomainCriteria('www.origin-server.com'),
+                     executor=executor)
+            def respmod(request):
+                return b"fooooooooooooooo"
+
+            transaction = self.run_test(server, input_bytes,
+                                        assert_mutated=True)
+
+            assert submit.called
+
+        executor.shutdown()
+        assert b"fooooooooooooooo" in transaction
+
+    def test_handle_request__process_executor(self):
+        input_bytes = data_string('icap_request_with_two_header_sets.request')
+
+        server = ICAPProtocolFactory()
+
+        handler(DomainCriteria('www.origin-server.com'),
+                executor='process')(ProcessHandler)
+
+        transaction = self.run_test(server, input_bytes, assert_mutated=True)
+
+        assert b"THIS IS DATA THAT WAS RETURNED BY AN ORIGIN SERVER." in transaction
+        assert b'X-Pid: ' in transaction
+        assert ('X-Pid: %d\r\n' % os.getpid()).encode('utf8') not in transaction
+
+    def test_handle_request__process_executor_in_place_changes(self):
+        input_bytes = data_string('request_with_http_request_no_payload.request')
+
+        server = ICAPProtocolFactory()
+
+        handler(DomainCriteria('www.origin-server.com'),
+                executor='process')(ProcessHandler)
+
+        transaction = self.run_test(server, input_bytes)
+
+        assert b"X-Modified: yes" in transaction
+
+    def run_in_loop(self, server, input_bytes):
+        protocol = server()
+        protocol.connection_made(BytesIOTransport())
+
+        async def receive():
+            return protocol.data_received(input_bytes)
+
+        f = asyncio.get_event_loop().run_until_complete(receive())
+
+        if f is not None:
+            asyncio.get_event_loop().run_until_complete(f)
+
+        return f, protocol.transport.getvalue()
+
+    def test_data_received__synchronous_requests_complete_eagerly(self):
+        input_bytes = data_string('request_with_http_request_no_payload.request')
+
+        @handler(DomainCriteria('www.origin-server.com'))
+        def reqmod(request):
+            return b'cool body'
+
+        f, transaction = self.run_in_loop(ICAPProtocolFactory(), input_bytes)
+
+        assert f is None
+        assert b'ICAP/1.0 200 OK' in transaction
+        assert b'cool body' in transaction
+
+    @pytest.mark.parametrize('generator', [False, True])
+    def test_data_received__coroutines_continue_in_task(self, generator):
+        input_bytes = data_string('request_with_http_request_no_payload.request')
+
+        if generator:
+            @handler(DomainCriteria('www.origin-server.com'))
+            def reqmod(request):
+                yield from asyncio.sleep(0)
+                return b'cool body'
+        else:
+            @handler(DomainCriteria('www.origin-server.com'))
+            async def reqmod(request):
+                await asyncio.sleep(0)
+                return b'cool body'
+
+        f, transaction = self.run_in_loop(ICAPProtocolFactory(), input_bytes)
+
+        assert isinstance(f, asyncio.Task)
+        assert b'ICAP/1.0 200 OK' in transaction
+        assert b'cool body' in transaction
+
     def test_write_response__when_disconnected(self):
+        run = asyncio.get_event_loop().run_until_complete
+
         i = ICAPProtocol(False)
         with patch('icap.asyncio.Serializer') as mock_serializer:
-            i.write_response(MagicMock(), MagicMock())
+            run(i.write_response(MagicMock(), MagicMock()))
             assert not mock_serializer.mock_calls
 
         i.connection_made(MagicMock())
 
         with patch('icap.asyncio.Serializer') as mock_serializer:
-            i.write_response(MagicMock(), MagicMock())
+            mock_serializer.return_value.file = None
+            run(i.write_response(MagicMock(), MagicMock()))
             assert mock_serializer.mock_calls
 
     def test_gzip_encoding(self):
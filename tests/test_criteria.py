@@ -1,12 +1,26 @@
+import json
+import re
+import time
 import urllib.parse
 
-from unittest.mock import MagicMock
+import pytest
+
+from unittest.mock import MagicMock, patch
 
 from icap import (
     RegexCriteria, DomainCriteria, handler, ContentTypeCriteria,
     MethodCriteria, HeaderCriteria, HeadersDict, HTTPRequestCriteria,
-    HTTPResponseCriteria, StatusCodeCriteria)
-from icap.criteria import _HANDLERS, sort_handlers, get_handler
+    HTTPResponseCriteria, StatusCodeCriteria, DomainListCriteria,
+    URLListCriteria, BloomFilterCriteria, RegexSetCriteria)
+from icap.errors import ICAPAbort
+from icap.listindex import build_index
+from icap.parsing import ICAPRequestParser
+from icap.criteria import (_HANDLERS, sort_handlers, get_handler,
+                           RoutingTable, AlwaysCriteria, normalize_host,
+                           RequestFacts, get_facts, AllOfCriteria,
+                           AnyOfCriteria, enable_adaptive_ordering,
+                           disable_adaptive_ordering, criteria_stats,
+                           enable_routing_cache, disable_routing_cache)
 
 
 class FakeRequest(object):
@@ -43,6 +57,70 @@ def test_AllOfCriteria():
     assert c(FakeRequest('https://google.com'))
 
 
+class TestAdaptiveOrdering(object):
+    def setup_method(self, method):
+        enable_adaptive_ordering(interval=10)
+
+    def teardown_method(self, method):
+        disable_adaptive_ordering()
+
+    def test_AllOfCriteria_reordered(self):
+        calls = []
+
+        def rarely_false(request):
+            calls.append('rarely_false')
+            time.sleep(0.001)
+            return request.session['url'].path != '/miss'
+
+        def often_false(request):
+            calls.append('often_false')
+            return request.session['url'].path == '/hit'
+
+        c = AllOfCriteria(rarely_false, often_false)
+
+        for i in range(10):
+            assert not c(FakeRequest('http://google.com/other'))
+
+        # cheap and usually decisive, so it now runs first.
+        assert c.order == [1, 0]
+
+        del calls[:]
+        assert not c(FakeRequest('http://google.com/other'))
+        assert calls == ['often_false']
+
+        # results are unchanged.
+        assert c(FakeRequest('http://google.com/hit'))
+        assert not c(FakeRequest('http://google.com/miss'))
+
+        stats = c.stats()
+        assert [s['calls'] for s in stats] == [8, 6]
+        assert stats[0]['match_rate'] == 1 / 8
+
+    def test_AnyOfCriteria_reordered(self):
+        c = AnyOfCriteria(RegexCriteria('.*/never'), RegexCriteria('.*'))
+
+        for i in range(10):
+            assert c(FakeRequest('http://google.com/'))
+
+        assert c.order == [1, 0]
+        assert c(FakeRequest('http://google.com/never'))
+
+    def test_criteria_stats(self):
+        _HANDLERS.clear()
+
+        @handler(DomainCriteria('google.com') & (RegexCriteria('.*/a') |
+                                                 RegexCriteria('.*/b')))
+        def reqmod(message):
+            pass  # pragma: no cover
+
+        stats = criteria_stats()
+        assert [s['path'] for s in stats] == ['/reqmod', '/reqmod']
+        assert stats[0]['handler'] == reqmod.__qualname__
+        assert len(stats[0]['children']) == 2
+        assert stats[1]['children'][0]['calls'] == 0
+        json.dumps(stats)
+
+
 def test_HTTPRequestCriteria():
     a = HTTPRequestCriteria()
 
@@ -92,6 +170,55 @@ class TestDomainCriteria(object):
         assert r(FakeRequest('http://goggle.com'))
         assert not r(FakeRequest('http://giggle.com'))
 
+    def test_subdomain_glob(self):
+        r = DomainCriteria('*.google.com', '*.co.uk')
+        assert r(FakeRequest('http://www.google.com'))
+        assert r(FakeRequest('http://a.b.google.com'))
+        assert r(FakeRequest('http://bbc.co.uk'))
+        assert not r(FakeRequest('http://google.com'))
+        assert not r(FakeRequest('http://co.uk'))
+        assert not r(FakeRequest('http://wwwgoogle.com'))
+        assert not r(FakeRequest('http://www.google.com.au'))
+
+    def test_mixed_patterns(self):
+        r = DomainCriteria('bing.com', '*.google.com', 'ya?oo.com')
+        assert r(FakeRequest('http://bing.com'))
+        assert r(FakeRequest('http://www.google.com'))
+        assert r(FakeRequest('http://yahoo.com'))
+        assert not r(FakeRequest('http://www.bing.com'))
+        assert r.constraints() == {}
+
+    @pytest.mark.parametrize('host', [
+        'GOOGLE.com',
+        'google.com.',
+        'google.com:8080',
+        'Www.Google.Com.:443',
+    ])
+    def test_normalization(self, host):
+        r = DomainCriteria('google.com', '*.google.com')
+        request = FakeRequest('http://%s' % host)
+        assert r(request)
+
+    @pytest.mark.parametrize(('host', 'expected'), [
+        ('Google.COM', 'google.com'),
+        ('google.com.', 'google.com'),
+        ('google.com:80', 'google.com'),
+        ('[::1]:8080', '[::1]'),
+        ('[::1]', '[::1]'),
+        ('', ''),
+    ])
+    def test_normalize_host(self, host, expected):
+        assert normalize_host(host) == expected
+
+    def test_many_globs(self):
+        # the globs are compiled once, not each time one is added.
+        start = time.time()
+        r = DomainCriteria(*('www%d.ex?mple.com' % i for i in range(3000)))
+        assert time.time() - start < 5
+
+        assert r(FakeRequest('http://www2999.example.com'))
+        assert not r(FakeRequest('http://www3000.example.com'))
+
     def test_missing_host_header(self):
         request = MagicMock()
 
@@ -104,6 +231,44 @@ class TestDomainCriteria(object):
         assert not r(request)
 
 
+@pytest.mark.parametrize('subdomains', [True, False])
+def test_DomainListCriteria(tmpdir, subdomains):
+    path = str(tmpdir.join('domains.idx'))
+    build_index(['google.com', 'bing.com'], path)
+
+    c = DomainListCriteria(path, subdomains=subdomains)
+
+    assert c(FakeRequest('http://google.com'))
+    assert c(FakeRequest('http://Bing.com:80'))
+    assert c(FakeRequest('http://www.google.com')) == subdomains
+    assert c(FakeRequest('http://a.b.bing.com')) == subdomains
+    assert not c(FakeRequest('http://google.com.au'))
+    assert not c(FakeRequest('http://wwwgoogle.com'))
+    assert not c(FakeRequest('http://com'))
+
+
+def test_URLListCriteria(tmpdir):
+    path = str(tmpdir.join('urls.idx'))
+    build_index(['http://google.com/bad', 'http://bing.com/'], path)
+
+    c = URLListCriteria(path)
+
+    assert c(FakeRequest('http://google.com/bad'))
+    assert c(FakeRequest('http://bing.com/'))
+    assert not c(FakeRequest('http://google.com/bad/'))
+    assert not c(FakeRequest('http://google.com/'))
+
+
+def test_URLListCriteria_query(tmpdir):
+    path = str(tmpdir.join('urls.idx'))
+    build_index(['/search?q=cats'], path)
+
+    c = URLListCriteria(path)
+
+    assert c(parse_request_with_uri('/search?q=cats'))
+    assert not c(parse_request_with_uri('/search?q=dogs'))
+
+
 class TestContentTypeCriteria:
     def test_no_match_on_request(self):
         r = ContentTypeCriteria()
@@ -146,6 +311,191 @@ def test_RegexCriteria():
     assert not r(FakeRequest('http://google.com5'))
 
 
+def test_RegexSetCriteria():
+    r = RegexSetCriteria(r'http://google.com$', r'http://(www\.)?bing.com',
+                         re.compile(r'http://yahoo.com[1-4]'))
+
+    assert r(FakeRequest('http://google.com'))
+    assert r(FakeRequest('http://www.bing.com/search'))
+    assert r(FakeRequest('http://yahoo.com2'))
+    assert not r(FakeRequest('http://google.com.au'))
+    assert not r(FakeRequest('http://yahoo.com5'))
+
+    assert r.matching(FakeRequest('http://google.com')) == \
+        r'http://google.com$'
+    assert r.matching(FakeRequest('http://www.bing.com')) == \
+        r'http://(www\.)?bing.com'
+    assert r.matching(FakeRequest('http://yahoo.com1')) == \
+        r'http://yahoo.com[1-4]'
+    assert r.matching(FakeRequest('http://yahoo.com5')) is None
+
+
+def test_RegexSetCriteria_query():
+    r = RegexSetCriteria(r'/search\?q=cats$', r'/other')
+
+    assert r(parse_request_with_uri('/search?q=cats'))
+    assert r.matching(parse_request_with_uri('/search?q=cats')) == \
+        r'/search\?q=cats$'
+    assert not r(parse_request_with_uri('/search?q=dogs'))
+
+
+def test_RegexSetCriteria_flags():
+    r = RegexSetCriteria(r'http://google.com$', r'(?i)http://BING.com',
+                         re.compile(r'http://YAHOO.com', re.I),
+                         r'(?x) http://duck  # comment')
+
+    assert r.regex is not None and not r.separate
+    assert r.matching(FakeRequest('http://bing.com')) == r'(?i)http://BING.com'
+    assert r(FakeRequest('http://yahoo.com'))
+    assert r(FakeRequest('http://duck.com'))
+
+    # the flags are scoped to their own regex.
+    assert not r(FakeRequest('http://GOOGLE.com'))
+
+
+def test_RegexSetCriteria_separate():
+    r = RegexSetCriteria(r'http://(?P<host>a)\.com', r'http://(b)\1\.com',
+                         r'http://(?P<host>c)\.com', r'http://.*')
+
+    assert r(FakeRequest('http://a.com'))
+    assert r(FakeRequest('http://c.com'))
+    assert r.matching(FakeRequest('http://bb.com')) == r'http://(b)\1\.com'
+    assert r.matching(FakeRequest('http://b.com')) == r'http://.*'
+    assert not RegexSetCriteria(r'http://(b)\1')(FakeRequest('http://b.com'))
+
+    # the first regex to match wins, whether combined or not.
+    r = RegexSetCriteria(r'http://.*', r'http://(?P<host>a)\.com')
+    assert r.matching(FakeRequest('http://a.com')) == r'http://.*'
+
+
+def test_RequestFacts():
+    request = FakeRequest('http://Google.com:80/a', method='POST',
+                          headers={'Content-Type': 'text/html',
+                                   'X-Foo': 'bar'})
+    request.headers = HeadersDict([('X-Client-IP', '10.0.0.1')])
+    request.http.status_line.code = 200
+
+    facts = RequestFacts(request)
+
+    assert facts.host == 'google.com'
+    assert facts.content_type == 'text/html'
+    assert facts.method == 'POST'
+    assert facts.status_code == 200
+    assert facts.url == 'http://Google.com:80/a'
+    assert facts.client_ip == '10.0.0.1'
+    assert facts.header_values('x-FOO') == {'bar'}
+    assert facts.header_values('x-bar') == frozenset()
+
+
+def parse_request_with_uri(uri):
+    """Return a real parsed REQMOD request for ``uri``, whose query is
+    parsed by `~icap.models.RequestLine`, unlike `FakeRequest`'s.
+
+    """
+    with open('tests/data/request_with_http_request_no_payload.request',
+              'rb') as f:
+        data = f.read()
+
+    request_line = b'GET %s HTTP' % uri.encode('utf8')
+    offset = 170 + len(request_line) - len(b'GET / HTTP')
+    return ICAPRequestParser.from_bytes(
+        data.replace(b'GET / HTTP', request_line).replace(
+            b'null-body=170', b'null-body=%d' % offset))
+
+
+def test_RequestFacts_url_with_query():
+    request = parse_request_with_uri('/a?b=1&b=2&c=%20')
+
+    # the request line parses the query into a dict.
+    assert request.http.request_line.query == {'b': ['1', '2'], 'c': [' ']}
+    assert RequestFacts(request).url == '/a?b=1&b=2&c=+'
+
+
+def test_RequestFacts_computed_once():
+    request = FakeRequest('http://google.com/a')
+
+    with patch('urllib.parse.urlunparse',
+               side_effect=urllib.parse.urlunparse) as urlunparse:
+        request.facts = RequestFacts(request)
+
+        criteria = [RegexCriteria('.*/b'), RegexSetCriteria('.*/c'),
+                    RegexCriteria('.*/a')]
+        assert [c(request) for c in criteria] == [False, False, True]
+        assert urlunparse.call_count == 1
+
+        # without facts attached, they're built for every call.
+        del request.facts
+        criteria[0](request)
+        criteria[0](request)
+        assert urlunparse.call_count == 3
+
+
+def test_get_handler_attaches_facts():
+    _HANDLERS.clear()
+
+    request = FakeRequest('http://google.com/')
+    request.is_options = False
+    request.request_line = MagicMock()
+    request.request_line.uri.path = '/reqmod'
+
+    @handler(DomainCriteria('bing.com') | DomainCriteria('google.com'))
+    def reqmod(message):
+        pass  # pragma: no cover
+
+    get_handler(request)
+    assert request.facts.host == 'google.com'
+    assert get_facts(request) is request.facts
+
+    # attached facts refer back to the request weakly, to avoid a cycle.
+    facts = request.facts
+    del request
+    assert facts.request is None
+
+
+class TestBloomFilterCriteria(object):
+    def test_prefilter(self):
+        inner = MagicMock(side_effect=RegexCriteria('.*/ads/'))
+        c = BloomFilterCriteria(inner, ['Example.com/ads/', 'bing.com'])
+
+        assert c(FakeRequest('http://example.com/ads/banner.gif'))
+        assert c(FakeRequest('http://www.example.com/ads/'))
+        assert not c(FakeRequest('http://bing.com/search'))
+        assert not c(FakeRequest('http://example.com/'))
+        assert not c(FakeRequest('http://example.com/adsense'))
+        assert not c(FakeRequest('http://google.com/ads/'))
+
+        # only the requests that could match reach the wrapped criteria.
+        assert inner.call_count == 3
+        assert c.stats() == {
+            'skipped': 3,
+            'checked': 3,
+            'matched': 2,
+            'false_positives': 1,
+            'hit_rate': 0.5,
+            'miss_rate': 0.5,
+        }
+
+    def test_false_positive_rate(self):
+        c = BloomFilterCriteria(lambda request: True,
+                                ['%d.example.com' % i for i in range(1000)],
+                                error_rate=0.01)
+
+        for i in range(1000):
+            assert c(FakeRequest('http://%d.example.com/' % i))
+
+        for i in range(1000):
+            c(FakeRequest('http://%d.example.org/' % i))
+
+        assert c.checked - 1000 < 50
+
+    def test_priority_and_constraints(self):
+        inner = DomainCriteria('example.com')
+        c = BloomFilterCriteria(inner, ['example.com'])
+
+        assert c.priority == inner.priority
+        assert c.constraints() == inner.constraints()
+
+
 def test_sort_handlers():
     _HANDLERS.clear()
 
@@ -162,6 +512,172 @@ def test_sort_handlers():
     assert isinstance(second[0], DomainCriteria)
 
 
+def test_constraints():
+    reqmod = HTTPRequestCriteria()
+    domain = DomainCriteria('google.com', 'bing.com')
+    content_type = ContentTypeCriteria('text/html')
+
+    assert DomainCriteria('*.google.com').constraints() == {}
+    assert (reqmod & domain).constraints() == {
+        'is_reqmod': {True},
+        'host': {'google.com', 'bing.com'},
+    }
+    assert (domain & DomainCriteria('google.com')).constraints() == {
+        'host': {'google.com'},
+    }
+    assert (domain | content_type).constraints() == {}
+    assert (domain | DomainCriteria('yahoo.com')).constraints() == {
+        'host': {'google.com', 'bing.com', 'yahoo.com'},
+    }
+    assert (reqmod | (lambda request: True)).constraints() == {}
+
+
+def test_RoutingTable():
+    request = FakeRequest('http://google.com/')
+    request.is_reqmod = False
+    request.http.request_headers = request.http.headers
+    request.http.headers['Content-Type'] = 'text/html'
+
+    called = []
+
+    def criteria(name, inner):
+        def wrapped(request):
+            called.append(name)
+            return inner(request)
+        wrapped.constraints = inner.constraints
+        return wrapped
+
+    table = RoutingTable([
+        (criteria('bing', DomainCriteria('bing.com')), 'bing', False),
+        (criteria('reqmod', HTTPRequestCriteria()), 'reqmod', False),
+        (criteria('image', ContentTypeCriteria('image/png')), 'image', False),
+        (criteria('never', HTTPRequestCriteria() & HTTPResponseCriteria()),
+         'never', False),
+        (criteria('google', DomainCriteria('google.com') &
+                  ContentTypeCriteria('text/plain')), 'google', False),
+        (criteria('html', ContentTypeCriteria('text/html')), 'html', False),
+        (criteria('always', AlwaysCriteria()), 'always', True),
+    ])
+
+    assert table.match(request) == ('html', False)
+    assert called == ['google', 'html']
+
+    request.http.headers.replace('Content-Type', 'text/plain')
+    del called[:]
+
+    assert table.match(request) == ('google', False)
+    assert called == ['google']
+
+    request.http.headers.replace('Host', 'yahoo.com')
+    del called[:]
+
+    assert table.match(request) == ('always', True)
+    assert called == ['always']
+
+
+class TestRoutingCache(object):
+    def setup_method(self, method):
+        _HANDLERS.clear()
+        enable_routing_cache(size=2)
+
+    def teardown_method(self, method):
+        disable_routing_cache()
+
+    def request(self, url, **kwargs):
+        request = FakeRequest(url, **kwargs)
+        request.is_options = False
+        request.request_line = MagicMock()
+        request.request_line.uri.path = '/reqmod'
+        return request
+
+    def test_cached(self):
+        domain = DomainCriteria('google.com')
+
+        def criteria(request):
+            criteria.call_count += 1
+            return domain(request)
+        criteria.call_count = 0
+        criteria.depends_on = domain.depends_on
+
+        @handler(AllOfCriteria(criteria, HeaderCriteria('X-Foo')))
+        def reqmod(message):
+            pass  # pragma: no cover
+
+        request = self.request('http://google.com/a', headers={'X-Foo': '1'})
+        assert get_handler(request) == (reqmod, False)
+        request = self.request('http://google.com/b', headers={'X-Foo': '1'})
+        assert get_handler(request) == (reqmod, False)
+        assert criteria.call_count == 1
+
+        # no match is cached too.
+        for i in range(2):
+            with pytest.raises(ICAPAbort) as e:
+                get_handler(self.request('http://bing.com/'))
+            assert e.value.status_code == 204
+        assert criteria.call_count == 2
+
+        # the header is part of the key.
+        with pytest.raises(ICAPAbort):
+            get_handler(self.request('http://google.com/a'))
+        assert criteria.call_count == 3
+
+        # least recently used entries are evicted.
+        request = self.request('http://google.com/a', headers={'X-Foo': '1'})
+        assert get_handler(request) == (reqmod, False)
+        assert criteria.call_count == 4
+
+    def test_invalidated(self):
+        @handler(DomainCriteria('google.com'))
+        def reqmod(message):
+            pass  # pragma: no cover
+
+        with pytest.raises(ICAPAbort):
+            get_handler(self.request('http://bing.com/'))
+
+        @handler(DomainCriteria('bing.com'))
+        def reqmod(message):
+            pass  # pragma: no cover
+
+        assert get_handler(self.request('http://bing.com/')) == \
+            (reqmod, False)
+
+    def test_undeclared_criteria_not_cached(self):
+        calls = []
+
+        @handler(DomainCriteria('google.com') &
+                 (lambda request: calls.append(request) or True))
+        def reqmod(message):
+            pass  # pragma: no cover
+
+        get_handler(self.request('http://google.com/'))
+        get_handler(self.request('http://google.com/'))
+        assert len(calls) == 2
+
+
+def test_get_handler_compiles_routes():
+    _HANDLERS.clear()
+
+    request = FakeRequest('http://google.com/')
+    request.is_options = False
+    request.request_line = MagicMock()
+    request.request_line.uri.path = '/reqmod'
+
+    @handler(DomainCriteria('bing.com'))
+    def reqmod(message):
+        pass  # pragma: no cover
+
+    with pytest.raises(ICAPAbort) as e:
+        get_handler(request)
+    assert e.value.status_code == 204
+
+    @handler(DomainCriteria('google.com'))
+    def reqmod(message):
+        pass  # pragma: no cover
+
+    sort_handlers()
+    assert get_handler(request) == (reqmod, False)
+
+
 def test_MethodCriteria():
     c = MethodCriteria('POST', 'GET')
 
@@ -282,3 +798,24 @@ class TestHandlers:
         assert get_handler(respmod)[0] == _HANDLERS['/respmod'][0][1]
         assert isinstance(Foo, type)
 
+
+    def test_handle_invalid_executor(self):
+        with pytest.raises(ValueError):
+            @handler(executor='fibre')
+            def reqmod(message):
+                pass  # pragma: no cover
+
+        assert not _HANDLERS
+
+    def test_handle_executor_wraps_sync_only(self):
+        @handler(executor='thread')
+        def reqmod(message):
+            pass  # pragma: no cover
+
+        @handler(executor='thread')
+        def respmod(message):
+            yield  # pragma: no cover
+
+        assert _HANDLERS['/reqmod'][0][1] is not reqmod
+        assert _HANDLERS['/reqmod'][0][1].__wrapped__ is reqmod
+        assert _HANDLERS['/respmod'][0][1] is respmod
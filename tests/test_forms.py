@@ -0,0 +1,202 @@
+import pickle
+
+import pytest
+
+from icap import HeadersDict, HTTPRequest, FileBody
+from icap.errors import MalformedRequestError
+from icap.forms import FormPart, MultipartForm, MultipartParser, URLEncodedParser
+from icap.parsing import HTTPMessageParser
+
+
+multipart_body = (
+    b'preamble\r\n'
+    b'--xyz\r\n'
+    b'Content-Disposition: form-data; name="comment"\r\n'
+    b'\r\n'
+    b'hello\r\n--xy\r\n'
+    b'--xyz  \r\n'
+    b'Content-Disposition: form-data; name="upload"; filename="a.txt"\r\n'
+    b'Content-Type: text/plain\r\n'
+    b'\r\n'
+    b'\x00\x01\r\n\r\n'
+    b'--xyz\r\n'
+    b'\r\n'
+    b'no headers\r\n'
+    b'--xyz--\r\n'
+    b'epilogue'
+)
+
+
+def parse(body, size, **kwargs):
+    parser = MultipartParser('xyz', **kwargs)
+    for i in range(0, len(body), size):
+        parser.feed(body[i:i + size])
+    return parser.close()
+
+
+@pytest.mark.parametrize('size', [1, 2, 7, len(multipart_body)])
+def test_multipart_parsing(size):
+    form = parse(multipart_body, size)
+
+    assert len(form) == 3
+    assert form['comment'].text == 'hello\r\n--xy'
+    assert form['upload'].filename == 'a.txt'
+    assert form['upload'].content == b'\x00\x01\r\n'
+    assert form.parts[2].name is None
+    assert form.parts[2].content == b'no headers'
+
+    assert form.fields == {'comment': ['hello\r\n--xy'], None: ['no headers']}
+    assert form.files == {'upload': [form['upload']]}
+    assert 'upload' in form and 'missing' not in form
+
+    assert not form.modified
+
+
+def test_multipart_spooling():
+    content = b'x' * 5000
+    body = (b'--xyz\r\nContent-Disposition: form-data; name="f"; '
+            b'filename="big"\r\n\r\n' + content + b'\r\n--xyz--\r\n')
+
+    form = parse(body, 1000, max_memory=1024)
+    part = form['f']
+
+    assert part.size == 5000
+    assert part.file._rolled
+    assert b''.join(part.chunks(1024)) == content
+
+    # the form is written to a file too, when it's this large.
+    part.content = content[:-1]
+    body = form.body()
+    assert isinstance(body, FileBody)
+    assert body.read() == bytes(form)
+
+    # each body has its own file, which stays open until it's closed.
+    expected = bytes(form)
+    part.content = content
+    other = form.body()
+    assert body.read() == expected
+    assert other.read() == bytes(form)
+    body.close()
+    assert body.file.closed and not other.file.closed
+    other.close()
+
+    part.content = b'small'
+    assert form.body() == bytes(form)
+
+
+@pytest.mark.parametrize('body', [
+    b'--xyz\r\n\r\nno end',
+    b'--xyz\r\n\r\nno end\r\n--xyz',
+    b'no boundary at all',
+])
+def test_multipart_incomplete(body):
+    parser = MultipartParser('xyz')
+    parser.feed(body)
+    with pytest.raises(MalformedRequestError):
+        parser.close()
+
+
+@pytest.mark.parametrize('body', [
+    b'--xyz\r\ninvalid header\r\n\r\n',
+    b'--xyzabc\r\n\r\n',
+    b'--xyz\r\n' + b'a' * 20000,
+])
+def test_multipart_malformed(body):
+    with pytest.raises(MalformedRequestError):
+        MultipartParser('xyz').feed(body)
+
+
+def test_multipart_on_part():
+    parts = []
+    parser = MultipartParser('xyz', on_part=parts.append)
+    parser.feed(multipart_body[:100])
+
+    assert [part.name for part in parts] == ['comment']
+    assert parts[0].text == 'hello\r\n--xy'
+
+
+def test_multipart_serialization():
+    form = parse(multipart_body, len(multipart_body))
+
+    assert bytes(parse(bytes(form), 3)) == bytes(form)
+    assert bytes(form) == (
+        b'--xyz\r\n'
+        b'Content-Disposition: form-data; name="comment"\r\n'
+        b'\r\n'
+        b'hello\r\n--xy\r\n'
+        b'--xyz\r\n'
+        b'Content-Disposition: form-data; name="upload"; filename="a.txt"\r\n'
+        b'Content-Type: text/plain\r\n'
+        b'\r\n'
+        b'\x00\x01\r\n\r\n'
+        b'--xyz\r\n'
+        b'\r\n'
+        b'no headers\r\n'
+        b'--xyz--\r\n'
+    )
+
+    form['comment'].text = 'changed'
+    assert form.modified
+    form.mark_unmodified()
+
+    form['upload'].headers.replace('Content-Type', 'application/octet-stream')
+    assert form.modified
+    form.mark_unmodified()
+
+    form.parts.append(FormPart(HeadersDict([
+        ('Content-Disposition', 'form-data; name="new"')]), b'value'))
+    assert form.modified
+    assert parse(bytes(form), 5).fields['new'] == ['value']
+
+
+def test_pickle():
+    form = parse(multipart_body, len(multipart_body))
+    copy = pickle.loads(pickle.dumps(form))
+
+    assert bytes(copy) == bytes(form)
+    assert not copy.modified
+
+
+def test_urlencoded_parsing():
+    body = b'foo=bar&foo=b%C3%A9z&empty=&q=a+b'
+
+    for size in (1, 3, len(body)):
+        parser = URLEncodedParser()
+        for i in range(0, len(body), size):
+            parser.feed(memoryview(body)[i:i + size])
+        assert parser.close() == {'foo': ['bar', 'béz'], 'q': ['a b']}
+
+    parser = URLEncodedParser(None)
+    parser.feed(b'foo=bar&q=a+b')
+    assert parser.close() == {b'foo': [b'bar'], b'q': [b'a b']}
+
+
+def test_request_post_multipart():
+    data = (b'POST / HTTP/1.1\r\n'
+            b'Content-Type: multipart/form-data; boundary=xyz\r\n'
+            b'\r\n'
+            b'%x\r\n%s\r\n' % (len(multipart_body[:50]), multipart_body[:50]) +
+            b'%x\r\n%s\r\n' % (len(multipart_body[50:]), multipart_body[50:]) +
+            b'0\r\n\r\n')
+
+    request = HTTPMessageParser.from_bytes(data)
+    body = request._received
+
+    assert isinstance(request.post, MultipartForm)
+    assert request.post is request.post
+    assert request.post.fields['comment'] == ['hello\r\n--xy']
+
+    # unmodified forms aren't written back.
+    assert not request.modified
+    request.pre_serialization()
+    assert request._received is body
+    assert request.received_chunks() is not None
+
+    del request.post.parts[2]
+    assert request.modified
+    request.pre_serialization()
+    assert request.body_bytes == bytes(request.post)
+    assert request.body_bytes.endswith(b'\r\n\x00\x01\r\n\r\n--xyz--\r\n')
+
+    assert HTTPRequest(headers=HeadersDict([
+        ('Content-Type', 'multipart/form-data')])).post is None
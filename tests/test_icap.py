@@ -39,6 +39,44 @@ def test_chunked_messages(input_bytes, expected_body):
     assert_bodies_match(m, expected_body)
 
 
+def test_chunked_messages_fed_in_pieces():
+    input_bytes = (b'4;bar\r\nWiki\r\n5;foo\r\npedia\r\nE;qwer\r\n in\r\n\r\n'
+                   b'chunks.\r\n0\r\n\r\n')
+
+    for size in (1, 3, 7):
+        p = HTTPMessageParser()
+        p.feed_line(b'GET / HTTP/1.1\r\n')
+        p.feed_line(b'\r\n')
+
+        for i in range(0, len(input_bytes), size):
+            p.feed_body(input_bytes[i:i+size])
+
+        assert p.complete()
+        assert p.payload == b'Wikipedia in\r\n\r\nchunks.'
+        assert [c.header for c in p.chunks] == [b'bar', b'foo', b'qwer']
+
+
+def test_chunks_are_views_of_received_data():
+    data = b'4\r\nWiki\r\n5\r\npedia\r\n0\r\n\r\n'
+    p = HTTPMessageParser()
+    p.feed_line(b'GET / HTTP/1.1\r\n')
+    p.feed_line(b'\r\n')
+    p.feed_body(data)
+
+    assert p.complete()
+    assert all(c.content.obj is data for c in p.chunks)
+
+    m = p.to_http()
+    assert m.received_chunks() is p.chunks
+    assert not m.modified
+    assert m.body_bytes == b'Wikipedia'
+    assert m.received_chunks() is p.chunks
+
+    m.body = b'Wikipedia'
+    assert not m.modified
+    assert m.received_chunks() is None
+
+
 def test_multiline_headers():
     s = (
         b'OPTIONS / ICAP/1.0\r\n'
@@ -49,6 +87,19 @@ def test_multiline_headers():
     m = ICAPRequestParser.from_bytes(s)
     assert m.headers['great-header'] == 'foo bar'
 
+    # continuations belong to the line before, wherever its key was first.
+    s = (
+        b'OPTIONS / ICAP/1.0\r\n'
+        b'Foo: a\r\n'
+        b'Bar: b\r\n'
+        b'Foo: c\r\n'
+        b' d\r\n'
+        b'\r\n'
+    )
+    m = ICAPRequestParser.from_bytes(s)
+    assert m.headers.getlist('foo') == ['a', 'cd']
+    assert m.headers['bar'] == 'b'
+
 
 @pytest.mark.parametrize(('input_bytes', 'expected_headers', 'expected_sline'), [
     (
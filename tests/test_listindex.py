@@ -0,0 +1,68 @@
+import pytest
+
+from icap.listindex import ListIndex, build_index, main
+
+
+def test_build_and_search(tmpdir):
+    path = str(tmpdir.join('list.idx'))
+
+    entries = ['b.com', 'a.com', 'c.com', 'a.com', 'ünicode.com']
+    assert build_index(entries, path) == 4
+
+    index = ListIndex(path)
+
+    assert len(index) == 4
+    assert list(index) == ['a.com', 'b.com', 'c.com', 'ünicode.com']
+
+    for entry in entries:
+        assert entry in index
+
+    assert 'd.com' not in index
+    assert '' not in index
+    assert 'a.co' not in index
+    assert 'a.comm' not in index
+
+    index.close()
+
+
+def test_empty(tmpdir):
+    path = str(tmpdir.join('list.idx'))
+    build_index([], path)
+
+    index = ListIndex(path)
+    assert len(index) == 0
+    assert 'a.com' not in index
+
+
+@pytest.mark.parametrize('data', [
+    b'not an index at all',
+    b'',
+    b'ICAPLST1',
+    b'ICAPLST1\x05\x00\x00\x00\x00\x00\x00\x00',
+])
+def test_invalid_file(tmpdir, data):
+    path = tmpdir.join('list.idx')
+    path.write_binary(data)
+
+    with pytest.raises(ValueError):
+        ListIndex(str(path))
+
+
+def test_truncated_file(tmpdir):
+    path = tmpdir.join('list.idx')
+    build_index(['a.com', 'b.com'], str(path))
+    path.write_binary(path.read_binary()[:20])
+
+    with pytest.raises(ValueError):
+        ListIndex(str(path))
+
+
+def test_main(tmpdir, capsys):
+    source = tmpdir.join('domains.txt')
+    source.write('# comment\nGoogle.COM.\n\nwww.bing.com:80\n')
+    path = str(tmpdir.join('list.idx'))
+
+    main(['--domains', path, str(source)])
+
+    assert list(ListIndex(path)) == ['google.com', 'www.bing.com']
+    assert 'wrote 2 entries' in capsys.readouterr()[0]
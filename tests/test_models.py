@@ -1,10 +1,13 @@
+import pickle
+
 import pytest
 
 from http.cookies import SimpleCookie
 
 from icap import ICAPRequest, ICAPResponse, RequestLine, HeadersDict, HTTPRequest, HTTPResponse, StatusLine
 from icap.errors import ICAPAbort
-from icap.models import ICAPMessage, HTTPMessage
+from icap.models import FileBody, ICAPMessage, HTTPMessage
+from icap.parsing import HTTPMessageParser
 
 
 class TestHTTPMessage(object):
@@ -34,6 +37,57 @@ class TestHTTPMessage(object):
             assert m.request_headers == HeadersDict()
             assert m.status_line == StatusLine('HTTP/1.1', 200, 'OK')
 
+    @pytest.mark.parametrize('cls', [
+        HTTPRequest,
+        HTTPResponse,
+        ICAPRequest,
+        ICAPResponse,
+    ])
+    def test_slots(self, cls):
+        m = cls()
+
+        assert not hasattr(m, '__dict__')
+        with pytest.raises(AttributeError):
+            m.lamps = True
+
+    def test_lazy_defaults(self):
+        m = HTTPResponse()
+        assert not hasattr(m, '_request_line')
+        assert not hasattr(m, '_request_headers')
+
+        assert m.request_line is m.request_line
+        assert m.request_headers is m.request_headers
+
+        request_line = RequestLine('POST', '/', 'HTTP/1.1')
+        m.request_line = request_line
+        assert m.request_line is request_line
+
+        copy = pickle.loads(pickle.dumps(m))
+        assert copy.request_line == request_line
+        assert copy.request_headers == HeadersDict()
+
+    def test_post(self):
+        m = HTTPRequest(headers=HeadersDict([
+            ('Content-Type',
+             'application/x-www-form-urlencoded; charset=utf-8')]),
+            body=b'foo=bar&foo=baz')
+
+        assert not m.parsed_post_data
+        assert m.post is m.post == {'foo': ['bar', 'baz']}
+        assert m.parsed_post_data
+
+        m.post['foo'].append('qux')
+        m.pre_serialization()
+        assert m.body_bytes == b'foo=bar&foo=baz&foo=qux'
+
+        # the written POST data replaces a file body.
+        m.body = FileBody(__file__)
+        m.pre_serialization()
+        assert m.body_file is None
+        assert m.body_bytes == b'foo=bar&foo=baz&foo=qux'
+
+        assert HTTPRequest(body=b'foo=bar').post is None
+
     def test_body_setter(self):
         m = HTTPMessage()
 
@@ -67,6 +121,67 @@ class TestHTTPMessage(object):
         else:
             assert False, "Content-Type with no charset should raise TypeError"
 
+    def test_body_cached(self):
+        m = HTTPMessageParser.from_bytes(
+            b'HTTP/1.1 200 OK\r\n'
+            b'Content-Type: text/html; charset=utf-8\r\n'
+            b'Transfer-Encoding: chunked\r\n'
+            b'\r\n'
+            b'5\r\n\xc3\xa9t\xc3\xa9\r\n0\r\n\r\n')
+
+        assert m.content_type == ('text/html', 'utf-8')
+        assert m.content_type is m.content_type
+        assert m.body == 'été'
+        assert m.body is m.body
+        assert not m.modified
+
+        m.headers.replace('Content-Type', 'text/html; charset=latin-1')
+        assert m.content_type == ('text/html', 'latin-1')
+        assert m.body == 'Ã©tÃ©'
+
+        m.body = 'abc'
+        assert m.body == 'abc'
+
+        m.headers = HeadersDict([('Content-Type', 'image/png')])
+        assert m.content_type == ('image/png', '')
+        assert m.body == b'abc'
+
+    def test_file_body(self, tmpdir):
+        path = tmpdir.join('body')
+        path.write_binary(b'0123456789')
+
+        m = HTTPMessageParser.from_bytes(
+            b'HTTP/1.1 200 OK\r\n\r\n3\r\nabc\r\n0\r\n\r\n')
+
+        body = FileBody(str(path), offset=2, length=5)
+        m.body = body
+        assert m.body_file is body
+        assert m.has_body
+        assert m.received_chunks() is None
+        assert m.modified
+        assert m.body_bytes == b'23456'
+
+        with open(str(path), 'rb') as f:
+            m.body = FileBody(f.fileno(), offset=8)
+            assert m.body_bytes == b'89'
+            assert not f.closed
+
+        # file objects belong to the body, and are closed with it.
+        f = open(str(path), 'rb')
+        m.body = FileBody(f, offset=4)
+        assert len(m.body_file) == 6
+        assert m.body_bytes == b'456789'
+        m.body_file.close()
+        assert f.closed
+
+        m.body = FileBody(str(path), offset=10)
+        assert not m.has_body
+        assert len(m.body_file) == 0
+
+        m.body = b'lamps'
+        assert m.body_file is None
+        assert m.body_bytes == b'lamps'
+
     def test_cookies_set(self):
         m = HTTPResponse()
         m.set_cookie('foo', 'bar')
@@ -89,6 +204,99 @@ class TestHTTPMessage(object):
         assert b'Cookie foo=' not in bytes(m)
 
 
+    def test_cookies_lazy(self):
+        data = (b'HTTP/1.1 200 OK\r\n'
+                b'Set-Cookie: a=b; Path=/\r\n'
+                b'Set-Cookie: e=f\r\n'
+                b'Cookie: c="d"\r\n'
+                b'\r\n')
+        m = HTTPMessageParser.from_bytes(data)
+
+        assert m._cookies is None and m._set_cookies is None
+        assert bytes(m) + b'\r\n' == data
+
+        # parsing them isn't a change, headers are written as they came.
+        assert m.cookies['c'].value == 'd'
+        assert m.set_cookies['a']['path'] == '/'
+        assert not m.modified
+        assert bytes(m) + b'\r\n' == data
+
+        m.cookies['g'] = 'h'
+        del m.set_cookies['a']
+        assert m.modified
+        assert bytes(m) == (b'HTTP/1.1 200 OK\r\n'
+                            b'Cookie: c="d"; g=h\r\n'
+                            b'Set-Cookie: e=f\r\n')
+
+        m = HTTPMessageParser.from_bytes(data)
+        m.cookies.clear()
+        m.set_cookies = SimpleCookie()
+        assert bytes(m) == b'HTTP/1.1 200 OK\r\n'
+
+    def test_modified(self):
+        assert HTTPRequest().modified
+        assert HTTPResponse().modified
+
+        def parse(s=b'GET /?q=foo HTTP/1.1\r\nFoo: bar\r\n\r\n'):
+            m = HTTPMessageParser.from_bytes(s)
+            assert not m.modified
+            return m
+
+        m = parse()
+        m.headers['Baz'] = 'qux'
+        assert m.modified
+
+        m = parse()
+        m.headers.replace('Foo', 'bar')
+        assert m.modified
+
+        m = parse()
+        m.headers = m.headers.copy()
+        assert m.modified
+
+        m = parse()
+        m.body = b''
+        assert not m.modified
+        m.body = b'lamps'
+        assert m.modified
+
+        m = parse()
+        m.request_line.query['q'][0] = 'bar'
+        assert m.modified
+
+        m = parse()
+        m.cookies['foo'] = 'bar'
+        assert m.modified
+
+        m = parse()
+        m.set_cookie('foo', 'bar')
+        assert m.modified
+
+        m = parse(b'HTTP/1.1 200 OK\r\n\r\n')
+        m.status_line = StatusLine('HTTP/1.1', 200, 'OK')
+        assert not m.modified
+        m.status_line = StatusLine('HTTP/1.1', 404)
+        assert m.modified
+
+        m = parse()
+        assert not pickle.loads(pickle.dumps(m)).modified
+
+    def test_pickle(self):
+        m = HTTPRequest(RequestLine('GET', '/foo?bar=baz&bar=qux', 'HTTP/1.1'),
+                        HeadersDict([('Foo', 'bar'), ('foo', 'baz')]),
+                        body=b'lamps')
+        m.cookies['foo'] = 'bar'
+
+        copy = pickle.loads(pickle.dumps(m))
+
+        assert copy.request_line == m.request_line
+        assert copy.request_line.query == {'bar': ['baz', 'qux']}
+        assert copy.headers == m.headers
+        assert copy.headers.getlist('foo') == ['bar', 'baz']
+        assert copy.body_bytes == b'lamps'
+        assert bytes(copy) == bytes(m)
+
+
 class TestICAPMessage(object):
     def test_is_response_and_is_response(self):
         m = ICAPMessage()
@@ -147,6 +355,13 @@ class TestICAPRequest(object):
         assert not self.request('RESPMOD').is_options
         assert self.request('OPTIONS').is_options
 
+    def test_is_flags_follow_request_line(self):
+        request = self.request('REQMOD')
+        request.request_line = RequestLine('RESPMOD', '/', 'ICAP/1.0')
+
+        assert request.is_respmod
+        assert not (request.is_reqmod or request.is_options)
+
     def request(self, method, *args, **kwargs):
         return ICAPRequest(RequestLine(method, '/', 'ICAP/1.0'), *args, **kwargs)
 
@@ -250,3 +465,84 @@ def test_HeadersDict():
     assert e['foo'] == 'bar'
     assert e[b'bar'] == 'baz'
     assert b'bar' in e
+
+
+def test_HeadersDict_order():
+    h = HeadersDict([('B', '1'), ('a', '2'), ('b', '3'), ('C', '4')])
+
+    # values are grouped under the position their key was first added at.
+    assert list(h) == ['b', 'a', 'c']
+    assert sorted(h) == ['a', 'b', 'c']
+    assert dict(h) == {'b': '1', 'a': '2', 'c': '4'}
+    assert len(h) == 3
+    assert h.items_multi() == [('B', '1'), ('b', '3'), ('a', '2'), ('C', '4')]
+    assert bytes(h) == b'B: 1\r\nb: 3\r\na: 2\r\nC: 4\r\n'
+
+    h.replace('A', '5')
+    h.replace('b', '6')
+    assert h.items_multi() == [('b', '6'), ('A', '5'), ('C', '4')]
+
+    del h['b']
+    h['B'] = '7'
+    assert h.items_multi() == [('A', '5'), ('C', '4'), ('B', '7')]
+
+    assert h == HeadersDict([('A', '5'), ('C', '4'), ('B', '7')])
+    assert h != HeadersDict([('C', '4'), ('A', '5'), ('B', '7')])
+    assert h != HeadersDict([('a', '5'), ('C', '4'), ('B', '7')])
+
+
+def test_HeadersDict_pop():
+    h = HeadersDict([('Cookie', 'a=b'), ('X-Foo', 'bar'), ('cookie', 'c=d')])
+    version = h.version
+
+    assert h.pop('COOKIE') == 'a=b'
+    assert 'cookie' not in h
+    assert h.items_multi() == [('X-Foo', 'bar')]
+    assert h.version > version
+
+    assert h.pop('cookie', '') == ''
+    with pytest.raises(KeyError):
+        h.pop('cookie')
+    with pytest.raises(KeyError):
+        del h['cookie']
+
+
+def test_HeadersDict_update():
+    h = HeadersDict([('Foo', 'bar')])
+    h.update({'foo': 'baz', 'Bar': 'qux'})
+
+    assert h.getlist('foo') == ['bar', 'baz']
+    assert h['bar'] == 'qux'
+
+
+def test_HeadersDict_copy():
+    h = HeadersDict([('Foo', 'bar'), ('Baz', 'qux'), ('foo', 'baz')])
+
+    copy = h.copy()
+    assert copy == h
+    assert copy.getlist('foo') == ['bar', 'baz']
+    assert copy._values is h._values
+
+    # copies share storage until either side is modified.
+    copy['Foo'] = 'lamps'
+    h.replace('Baz', 'quux')
+    copy.extend_last('!')
+
+    assert h.items_multi() == [('Foo', 'bar'), ('foo', 'baz'), ('Baz', 'quux')]
+    assert copy.items_multi() == [('Foo', 'bar'), ('foo', 'baz'),
+                                  ('Foo', 'lamps!'), ('Baz', 'qux')]
+
+    h = HeadersDict([('Foo', 'bar')])
+    copy = h.copy()
+    del h['foo']
+    h.clear()
+    assert copy['foo'] == 'bar'
+
+
+def test_HeadersDict_pickle():
+    h = HeadersDict([('Foo', 'bar'), ('Baz', 'qux'), ('foo', 'baz')])
+    copy = pickle.loads(pickle.dumps(h))
+
+    assert copy == h
+    assert copy.version == h.version
+    assert not hasattr(copy, '__dict__')
@@ -1,11 +1,13 @@
 import pytest
 
+from io import BytesIO
 from unittest.mock import MagicMock, call
 
-from icap import ICAPResponse, HTTPResponse, HeadersDict
+from icap import FileBody, ICAPResponse, HTTPResponse, HeadersDict
+from icap.parsing import HTTPMessageParser
 from icap.serialization import (
     Serializer, response_headers, options_response_headers,
-    remove_invalid_headers)
+    remove_invalid_headers, error_templates, write_file)
 
 
 class TestSerializer(object):
@@ -47,10 +49,70 @@ class TestSerializer(object):
             call.write(b'\r\n'),
             call.write(b'HTTP/1.1 200 OK\r\n\r\n'),
             call.write(b'3\r\n'),
-            call.write(b'abc\r\n'),
+            call.write(b'abc'),
+            call.write(b'\r\n'),
             call.write(b'0\r\n\r\n')
         ]
 
+    def test_serialize_received_chunks_to_stream(self):
+        data = (b'HTTP/1.1 200 OK\r\n\r\n'
+                b'3\r\nabc\r\n2; ext\r\nde\r\n0\r\n\r\n')
+        s = ICAPResponse(http=HTTPMessageParser.from_bytes(data))
+
+        stream = MagicMock()
+        Serializer(s, 'asdf', is_options=False).serialize_to_stream(stream)
+
+        calls = stream.mock_calls
+
+        print(calls)
+        assert calls[3:] == [
+            call.write(b'3\r\n'),
+            call.write(b'abc'),
+            call.write(b'\r\n'),
+            call.write(b'2\r\n'),
+            call.write(b'de'),
+            call.write(b'\r\n'),
+            call.write(b'0\r\n\r\n')
+        ]
+
+        # the chunks are written straight from the received buffer.
+        assert calls[4][1][0].obj is data
+        assert calls[7][1][0].obj is data
+        assert s.http._body is None
+
+    def test_serialize_file_body_to_stream(self, tmpdir):
+        path = tmpdir.join('body')
+        path.write_binary(b'0123456789')
+
+        s = ICAPResponse(http=HTTPResponse())
+        s.http.body = FileBody(str(path), offset=1, length=8)
+
+        stream = MagicMock()
+        Serializer(s, 'asdf').serialize_to_stream(stream)
+
+        assert stream.mock_calls[3:] == [
+            call.write(b'8\r\n'),
+            call.write(b'12345678'),
+            call.write(b'\r\n'),
+            call.write(b'0\r\n\r\n')
+        ]
+
+        # with sendfile, the content is left for send_file.
+        stream = MagicMock()
+        serializer = Serializer(s, 'asdf', sendfile=True)
+        serializer.serialize_to_stream(stream)
+
+        assert stream.mock_calls[-1] == call.write(b'8\r\n')
+        assert serializer.file is s.http.body_file
+
+    def test_write_file(self):
+        stream = BytesIO()
+        assert write_file(stream, BytesIO(b'abcdef'), 5, block_size=2) == 5
+        assert stream.getvalue() == b'abcde'
+
+        with pytest.raises(EOFError):
+            write_file(stream, BytesIO(b'abc'), 5)
+
 
 @pytest.mark.parametrize('is_options', [True, False])
 def test_remove_invalid_headers(is_options):
@@ -78,3 +140,19 @@ def test_remove_invalid_headers(is_options):
     assert 'bad-key' not in headers
     assert 'transfer-encoding' not in headers
     assert sorted(headers) == valid_keys
+
+
+@pytest.mark.parametrize('code', [204, 400, 404, 500])
+def test_error_templates(code):
+    status_line = ICAPResponse.from_error(code).status_line
+
+    rendered = error_templates[code].render('"tag"',
+                                            b'X-Session-ID: abc\r\n')
+    status, rest = rendered.split(b'\r\n', 1)
+
+    assert status == ' '.join(map(str, status_line)).encode('utf8')
+    assert rendered.endswith(b'\r\n\r\n')
+    assert b'ISTag: "tag"\r\n' in rest
+    assert b'Date: ' in rest
+    assert b'Encapsulated: null-body=0\r\n' in rest
+    assert b'X-Session-ID: abc\r\n' in rest
@@ -1,10 +1,15 @@
+import asyncio
 import signal
 import pytest
 
 from unittest.mock import MagicMock, patch
 
+from werkzeug import http_date
+
 from icap import hooks
-from icap.server import is_tag, _fallback_is_tag, stop, run, signal_handlers
+from icap.server import (is_tag, _fallback_is_tag, stop, run, signal_handlers,
+                         invalidate_is_tag, Hooks)
+from icap.serialization import DateCache
 
 
 class TestISTag:
@@ -30,6 +35,149 @@ class TestISTag:
 
         assert is_tag(None) == '"%s"' % _fallback_is_tag
 
+    def test_is_tag__cached(self):
+        calls = []
+
+        @hooks('is_tag')
+        def is_tag_hook(request):
+            calls.append(request)
+            return 'tag %d' % len(calls)
+
+        assert is_tag(None) == '"tag 1"'
+        assert is_tag(None) == '"tag 1"'
+
+        invalidate_is_tag()
+
+        assert is_tag(None) == '"tag 2"'
+        assert is_tag(None) == '"tag 2"'
+        assert len(calls) == 2
+
+
+class TestHooks:
+    def test_empty_hook_is_noop(self):
+        hooks = Hooks()
+        assert hooks['foo'] is hooks['bar']
+        assert hooks['foo'](1, a=2) is None
+
+    def test_hook_dispatcher_is_prebound(self):
+        hooks = Hooks()
+        hooks('foo')(lambda: 1)
+        assert hooks['foo'] is hooks['foo']
+        assert hooks['foo']() == 1
+
+    def test_replace(self):
+        hooks = Hooks()
+        hooks('foo')(lambda: 1)
+        hooks('foo')(lambda: 2)
+        assert hooks['foo']() == 2
+
+    def test_multiple_listeners(self):
+        hooks = Hooks()
+        calls = []
+
+        @hooks('foo', default='default')
+        def first(value):
+            calls.append(('first', value))
+            return 1
+
+        @hooks('foo', append=True)
+        def second(value):
+            calls.append(('second', value))
+            raise ValueError
+
+        @hooks('foo', append=True)
+        def third(value):
+            calls.append(('third', value))
+            return 3
+
+        assert hooks['foo']('x') == 3
+        assert calls == [('first', 'x'), ('second', 'x'), ('third', 'x')]
+
+    def test_multiple_listeners_error_in_last(self):
+        hooks = Hooks()
+        hooks('foo', default='default')(lambda: 1)
+        hooks('foo', append=True)(lambda: 1/0)
+
+        assert hooks['foo']() == 'default'
+
+    def test_delete(self):
+        hooks = Hooks()
+        hooks('foo')(lambda: 1)
+        del hooks['foo']
+        assert hooks['foo']() is None
+
+    def test_dict_methods(self):
+        hooks = Hooks()
+        hooks('foo')(lambda: 1)
+        hooks('bar')(lambda: 2)
+
+        assert hooks.pop('foo')[1] is None
+        assert hooks['foo']() is None
+        assert hooks.pop('foo', None) is None
+
+        hooks.update(foo=([lambda: 3], 'default'))
+        assert hooks['foo']() == 3
+        hooks['foo'] = ([lambda: 1/0], 'default')
+        assert hooks['foo']() == 'default'
+
+        hooks.setdefault('baz', ((lambda: 4,), None))
+        hooks.setdefault('baz', ((lambda: 5,), None))
+        assert hooks['baz']() == 4
+
+        hooks |= {'baz': ((lambda: 6,), None)}
+        assert hooks['baz']() == 6
+
+        name, _ = hooks.popitem()
+        assert hooks[name]() is None
+
+        version = hooks.version
+        hooks.clear()
+        assert hooks.version > version
+        assert hooks['bar']() is None and hooks['foo']() is None
+
+    def test_async_listeners(self):
+        hooks = Hooks()
+        calls = []
+
+        @hooks('foo')
+        def first():
+            calls.append('first')
+
+        @hooks('foo', append=True)
+        async def second():
+            await asyncio.sleep(0)
+            calls.append('second')
+            return 2
+
+        result = hooks['foo']()
+        assert not calls
+
+        loop = asyncio.get_event_loop()
+        assert loop.run_until_complete(result) == 2
+        assert calls == ['first', 'second']
+
+
+def test_date_cache_timer():
+    loop = MagicMock()
+    cache = DateCache()
+
+    cache.start(loop)
+    assert cache.handle is loop.call_later.return_value
+    (delay, callback, arg), _ = loop.call_later.call_args
+    assert 0 <= delay <= 1
+    assert arg is loop
+
+    with patch('icap.serialization.time.time') as mock_time:
+        # while the timer runs, the value isn't checked against the clock.
+        later = mock_time.return_value = cache.expires + 10
+        assert cache.get() == cache.value
+
+        cache.stop()
+        assert cache.handle is None
+        assert cache.get() == http_date(later)
+
+    loop.call_later.return_value.cancel.assert_any_call()
+
 
 def test_stop():
     m = MagicMock()